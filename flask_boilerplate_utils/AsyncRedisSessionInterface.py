@@ -0,0 +1,170 @@
+import asyncio
+from inspect import isawaitable
+from uuid import uuid4
+
+from .RedisSessionInterface import RedisSessionInterface
+
+
+class AsyncRedisSessionInterface(RedisSessionInterface):
+    """
+    An asyncio counterpart of RedisSessionInterface for frameworks which
+    await the session interface, such as Quart. Backed by a redis.asyncio
+    client, so loading a session never blocks the event loop. Flask calls
+    its session interface synchronously, so this can't be used with Flask;
+    install it with init_async_sessions.
+
+    Sessions are stored under the same keys, with the same envelope, as
+    RedisSessionInterface, so both can share one store while an app is
+    migrated.
+
+    Takes the same parameters as RedisSessionInterface except for
+    ``lazy`` and ``cache``, which need synchronous access to Redis, plus:
+
+    :param cache_validation: Set this to the cache_validation of any
+                             RedisSessionInterface sharing the store with
+                             a local cache, so that sessions saved here
+                             invalidate their cached copies.
+    :param prefetch_body: Read the request body while the session is
+                          fetched, rather than after it. The body is
+                          cached on the request for the view to use.
+    """
+
+    def __init__(self, redis=None, prefix='session:', pickle_protocol=None,
+                 serializer=None, legacy_pickle=True, compressor=None,
+                 compression_threshold=1024, write_back=False,
+                 refresh_interval=None, cache_validation=None,
+                 version_prefix='session-version:', user_key=None,
+                 user_index_prefix='session-user:',
+                 max_lifetime=31 * 24 * 3600, prefetch_body=False):
+        if redis is None:
+            from redis.asyncio import Redis
+            redis = Redis()
+        super(AsyncRedisSessionInterface, self).__init__(
+            redis=redis, prefix=prefix, pickle_protocol=pickle_protocol,
+            serializer=serializer, legacy_pickle=legacy_pickle,
+            compressor=compressor,
+            compression_threshold=compression_threshold,
+            write_back=write_back, refresh_interval=refresh_interval,
+            cache_validation=cache_validation, version_prefix=version_prefix,
+            user_key=user_key, user_index_prefix=user_index_prefix,
+            max_lifetime=max_lifetime)
+        self.prefetch_body = prefetch_body
+        self._origin = uuid4().hex
+
+    @property
+    def invalidates(self):
+        return self.cache_validation is not None
+
+    def start_invalidation_listener(self):
+        # Nothing is cached locally, so there is nothing to invalidate.
+        pass
+
+    async def make_null_session(self, app):
+        return self.null_session_class()
+
+    async def open_session(self, app, request):
+        sid = request.cookies.get(app.config['SESSION_COOKIE_NAME'])
+        if not sid:
+            sid = self.generate_sid()
+            return self.session_class(sid=sid, new=True)
+
+        session = self.session_class(sid=sid)
+        body = None
+        if self.prefetch_body and request.content_length:
+            body = request.get_data(cache=True)
+        if isawaitable(body):
+            await asyncio.gather(self.load_session(session), body)
+        else:
+            await self.load_session(session)
+        return session
+
+    async def load_session(self, session):
+        key = self.prefix + session.sid
+        if self.write_back:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                pipe.get(key)
+                pipe.ttl(key)
+                val, ttl = await pipe.execute()
+        else:
+            val, ttl = await self.redis.get(key), None
+        self.fill_session(session, val, ttl)
+
+    async def write_session(self, session, val, redis_exp):
+        key = self.prefix + session.sid
+        if not self.invalidates and self.user_key is None:
+            await self.redis.set(key, val, ex=redis_exp)
+            return
+
+        async with self.redis.pipeline(
+                transaction=self.transactions) as pipe:
+            pipe.set(key, val, ex=redis_exp)
+            if self.invalidates:
+                self.queue_invalidation(pipe, session.sid, redis_exp)
+            self.queue_user_index(pipe, session)
+            await pipe.execute()
+
+    async def delete_session(self, session, redis_exp):
+        key = self.prefix + session.sid
+        if not self.invalidates:
+            await self.redis.delete(key)
+            return
+
+        async with self.redis.pipeline(
+                transaction=self.transactions) as pipe:
+            pipe.delete(key)
+            self.queue_invalidation(pipe, session.sid, redis_exp)
+            await pipe.execute()
+
+    async def save_session(self, app, session, response):
+        cookie_name = app.config['SESSION_COOKIE_NAME']
+        domain = self.get_cookie_domain(app)
+        redis_exp = int(
+            self.get_redis_expiration_time(app, session).total_seconds())
+        if not session:
+            if not (self.write_back and session.new):
+                await self.delete_session(session, redis_exp)
+            if session.modified:
+                response.delete_cookie(cookie_name, domain=domain)
+            return
+        cookie_exp = self.get_expiration_time(app, session)
+        val = self.codec.encode(dict(session))
+
+        if (self.write_back and session.digest is not None and
+                self.get_digest(val) == session.digest):
+            if not self.should_refresh(session, redis_exp):
+                return
+            async with self.redis.pipeline(transaction=False) as pipe:
+                pipe.expire(self.prefix + session.sid, redis_exp)
+                if self.cache_validation == 'version':
+                    pipe.expire(self.version_prefix + session.sid, redis_exp)
+                self.queue_user_index(pipe, session)
+                await pipe.execute()
+        else:
+            await self.write_session(session, val, redis_exp)
+
+        response.set_cookie(cookie_name, session.sid,
+                            expires=cookie_exp, httponly=True,
+                            domain=domain)
+
+
+def init_async_sessions(app):
+    """
+    Install an AsyncRedisSessionInterface on a Quart app, configured by the
+    same REDIS_SESSIONS config keys as Boilerplate's synchronous sessions.
+    ``REDIS_SESSIONS_LAZY`` and the local cache's size limits don't apply,
+    but with ``REDIS_SESSIONS_LOCAL_CACHE`` saves still invalidate the
+    caches of synchronous processes sharing the store.
+    """
+    from . import Boilerplate
+    from .redis_client import create_redis
+
+    boilerplate = Boilerplate()
+    boilerplate.init_session_config(app)
+    options, cache_validation = boilerplate.session_options(app)
+    app.session_interface = AsyncRedisSessionInterface(
+        redis=create_redis(app.config, 'REDIS_SESSIONS_', asyncio=True),
+        cache_validation=cache_validation,
+        prefetch_body=app.config.get('REDIS_SESSIONS_PREFETCH_BODY'),
+        **options
+    )
+    return app.session_interface
@@ -0,0 +1,231 @@
+from .RedisSessionInterface import RedisSession, RedisSessionInterface, \
+    LazySessionMixin
+from .serializers import SerializationError
+
+
+class RedisHashSession(LazySessionMixin, RedisSession):
+    """
+    A session stored as a Redis hash, one field per session key.
+
+    Remembers the raw value of every field loaded from Redis so that
+    only changed and deleted fields need to be written back.
+
+    :param stored: A dict of field name to the raw value held in Redis.
+    :param loader: If given, fields are loaded lazily. Called as
+                   ``loader(session, keys)`` to load specific fields, or
+                   ``loader(session, None)`` to load every field.
+    """
+
+    def __init__(self, initial=None, sid=None, new=False, stored=None,
+                 loader=None):
+        RedisSession.__init__(self, initial, sid=sid, new=new)
+        self.stored = stored if stored is not None else {}
+        self.loader = loader
+        self.complete = loader is None
+        self.probed = set()
+        self.cleared = False
+
+    def _load_key(self, key):
+        if (self.complete or key in self.probed or
+                dict.__contains__(self, key)):
+            return
+        self.loader(self, [key])
+
+    def _load_all(self):
+        if not self.complete:
+            self.loader(self, None)
+
+    def clear(self):
+        # The whole hash is deleted on save, so nothing needs loading.
+        self.complete = True
+        self.cleared = True
+        self.stored = {}
+        RedisSession.clear(self)
+
+    def get_changes(self, codec):
+        """
+        Return a tuple of (changed, deleted) where changed is a dict of
+        field name to the encoded value that must be written, and
+        deleted is a list of field names that must be removed.
+
+        Values are compared by their encoded form, so changes to nested
+        values are detected as well.
+        """
+        changed = {}
+        for key, value in dict.items(self):
+            encoded = codec.encode(value)
+            if self.stored.get(key) != encoded:
+                changed[key] = encoded
+        deleted = [key for key in self.stored
+                   if not dict.__contains__(self, key)]
+        return changed, deleted
+
+
+class RedisHashSessionInterface(RedisSessionInterface):
+    """
+    Stores each session key as a field of a Redis hash, so saving a
+    session only sends the fields that changed or were deleted. Useful
+    when sessions hold large values next to small, frequently changing
+    ones. Session keys must be strings.
+
+    Takes the same parameters as RedisSessionInterface. With ``lazy``,
+    fields are loaded individually (HMGET) on first access instead of
+    loading the whole hash (HGETALL) when the session is opened. The
+    ``write_back`` parameter has no effect, as only changed fields are
+    ever written, and ``refresh_interval`` always applies, defaulting to
+    60 seconds. Sessions can't be cached locally, so ``cache`` must be
+    None.
+    """
+    session_class = RedisHashSession
+
+    def __init__(self, redis=None, refresh_interval=60, cache=None,
+                 **kwargs):
+        if cache is not None:
+            raise ValueError('RedisHashSessionInterface does not support a '
+                             'local session cache.')
+        super(RedisHashSessionInterface, self).__init__(
+            redis=redis, refresh_interval=refresh_interval, **kwargs)
+
+    def decode_fields(self, session, raw_fields):
+        """
+        Decode raw hash fields into the session. Fields which cannot be
+        decoded are left out of the session, and so deleted on save.
+        """
+        for field, raw in raw_fields.items():
+            if raw is None:
+                continue
+            field = _field_name(field)
+            session.stored[field] = raw
+            try:
+                value = self.codec.decode(raw)
+            except SerializationError:
+                continue
+            dict.__setitem__(session, field, value)
+
+    def load_fields(self, session, keys):
+        """
+        The loader for lazy sessions. Loads the given keys, or the whole
+        hash if keys is None. The remaining TTL is fetched along with the
+        first load, and '_permanent' is always fetched with it so that
+        computing the expiry on save needs no extra round trip.
+        """
+        key = self.prefix + session.sid
+        pipe = self.redis.pipeline(transaction=False)
+        if keys is None:
+            pipe.hgetall(key)
+        else:
+            keys = [k for k in keys if k not in session.probed]
+            if '_permanent' not in session.probed and '_permanent' not in keys:
+                keys.append('_permanent')
+            pipe.hmget(key, keys)
+        if session.ttl is None:
+            pipe.ttl(key)
+        results = self.execute_reads(pipe)
+        if session.ttl is None:
+            session.ttl = results[-1]
+
+        if keys is None:
+            # Fields already loaded or set locally take precedence.
+            raw_fields = dict(
+                (_field_name(f), v) for f, v in results[0].items())
+            for field in list(raw_fields):
+                if field in session.probed or dict.__contains__(session,
+                                                                field):
+                    if field not in session.stored:
+                        session.stored[field] = raw_fields[field]
+                    del raw_fields[field]
+            session.complete = True
+        else:
+            raw_fields = dict(zip(keys, results[0]))
+            session.probed.update(keys)
+        self.decode_fields(session, raw_fields)
+
+    def read_sessions(self, sids, redis=None):
+        pipe = (redis or self.redis).pipeline(transaction=False)
+        for sid in sids:
+            pipe.hgetall(self.prefix + sid)
+        results = []
+        for raw_fields in pipe.execute():
+            if not raw_fields:
+                results.append(None)
+                continue
+            session = self.session_class()
+            self.decode_fields(session, raw_fields)
+            results.append(dict(session))
+        return results
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(app.session_cookie_name)
+        if not sid:
+            sid = self.generate_sid()
+            return self.session_class(sid=sid, new=True)
+
+        if self.lazy:
+            return self.session_class(sid=sid, loader=self.load_fields)
+
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hgetall(self.prefix + sid)
+        pipe.ttl(self.prefix + sid)
+        raw_fields, ttl = self.execute_reads(pipe)
+        if not raw_fields:
+            return self.session_class(sid=sid, new=True)
+
+        session = self.session_class(sid=sid)
+        self.decode_fields(session, raw_fields)
+        session.ttl = ttl
+        return session
+
+    def save_session(self, app, session, response):
+        domain = self.get_cookie_domain(app)
+        key = self.prefix + session.sid
+        changed, deleted = session.get_changes(self.codec)
+
+        if session.complete and not dict.__len__(session):
+            if session.stored or session.cleared:
+                pipe = self.pipeline(transaction=False)
+                pipe.delete(key)
+                self.execute(pipe)
+            if session.modified:
+                response.delete_cookie(app.session_cookie_name,
+                                       domain=domain)
+            return
+
+        unchanged = not (changed or deleted or session.cleared)
+        # Lazy sessions which were never loaded have no known TTL and
+        # are left alone.
+        if unchanged and (session.new or session.ttl is None):
+            return
+
+        redis_exp = int(
+            self.get_redis_expiration_time(app, session).total_seconds())
+        cookie_exp = self.get_expiration_time(app, session)
+
+        if unchanged:
+            if not self.should_refresh(session, redis_exp):
+                return
+            pipe = self.pipeline(transaction=False)
+            pipe.expire(key, redis_exp)
+            self.queue_user_index(pipe, session)
+            self.execute(pipe)
+        else:
+            pipe = self.pipeline()
+            if session.cleared:
+                pipe.delete(key)
+            if deleted:
+                pipe.hdel(key, *deleted)
+            if changed:
+                pipe.hset(key, mapping=changed)
+            pipe.expire(key, redis_exp)
+            self.queue_user_index(pipe, session)
+            self.execute(pipe)
+
+        response.set_cookie(app.session_cookie_name, session.sid,
+                            expires=cookie_exp, httponly=True,
+                            domain=domain)
+
+
+def _field_name(field):
+    # Clients created with decode_responses return str field names.
+    if isinstance(field, bytes):
+        return field.decode('utf-8')
+    return field
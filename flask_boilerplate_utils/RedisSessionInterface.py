@@ -1,9 +1,14 @@
-import pickle
+import hashlib
+import os
 from datetime import timedelta
 from uuid import uuid4
 from redis import Redis
 from werkzeug.datastructures import CallbackDict
 from flask.sessions import SessionInterface, SessionMixin
+from .redis_batch import QueuedPipeline
+from .redis_client import is_cluster
+from .serializers import SessionCodec, SerializationError, get_serializer, \
+    get_compressor
 
 
 class RedisSession(CallbackDict, SessionMixin):
@@ -15,19 +20,288 @@ class RedisSession(CallbackDict, SessionMixin):
         self.sid = sid
         self.new = new
         self.modified = False
+        # Set by the interface in write-back mode: the digest of the
+        # stored payload and its remaining TTL when it was loaded.
+        self.digest = None
+        self.ttl = None
+        # Set by the interface when a local cache is used.
+        self.version = None
+
+    #: Whether the session's data has been fetched from Redis.
+    loaded = True
+
+
+class LazySessionMixin(object):
+    """
+    Defers loading a session's data until it is first used. Reading a
+    key calls ``_load_key``, anything which needs the whole session
+    calls ``_load_all``.
+    """
+
+    def _load_key(self, key):
+        self._load_all()
+
+    def _load_all(self):
+        raise NotImplementedError()
+
+    def __getitem__(self, key):
+        self._load_key(key)
+        return super(LazySessionMixin, self).__getitem__(key)
+
+    def __contains__(self, key):
+        self._load_key(key)
+        return super(LazySessionMixin, self).__contains__(key)
+
+    def get(self, key, default=None):
+        self._load_key(key)
+        return super(LazySessionMixin, self).get(key, default)
+
+    def setdefault(self, key, default=None):
+        self._load_key(key)
+        return super(LazySessionMixin, self).setdefault(key, default)
+
+    def pop(self, key, *default):
+        self._load_key(key)
+        return super(LazySessionMixin, self).pop(key, *default)
+
+    def __delitem__(self, key):
+        self._load_key(key)
+        super(LazySessionMixin, self).__delitem__(key)
+
+    def popitem(self):
+        self._load_all()
+        return super(LazySessionMixin, self).popitem()
+
+    def __iter__(self):
+        self._load_all()
+        return super(LazySessionMixin, self).__iter__()
+
+    def __len__(self):
+        self._load_all()
+        return super(LazySessionMixin, self).__len__()
+
+    def __eq__(self, other):
+        self._load_all()
+        return super(LazySessionMixin, self).__eq__(other)
+
+    def __ne__(self, other):
+        self._load_all()
+        return super(LazySessionMixin, self).__ne__(other)
+
+    __hash__ = None
+
+    def keys(self):
+        self._load_all()
+        return super(LazySessionMixin, self).keys()
+
+    def values(self):
+        self._load_all()
+        return super(LazySessionMixin, self).values()
+
+    def items(self):
+        self._load_all()
+        return super(LazySessionMixin, self).items()
+
+    def copy(self):
+        self._load_all()
+        return super(LazySessionMixin, self).copy()
+
+    def __repr__(self):
+        self._load_all()
+        return super(LazySessionMixin, self).__repr__()
+
+
+class LazyRedisSession(LazySessionMixin, RedisSession):
+    """
+    A RedisSession which is only fetched from Redis when it is first
+    read or written.
+
+    :param loader: Called as ``loader(session)`` to fetch the data.
+    """
+
+    def __init__(self, sid=None, loader=None):
+        RedisSession.__init__(self, sid=sid)
+        self.loader = loader
+        self.loaded = False
+
+    def _load_all(self):
+        if not self.loaded:
+            # Only marked loaded once the fetch succeeds, so a session
+            # whose fetch failed isn't saved, or deleted, as empty.
+            self.loader(self)
+            self.loaded = True
+
+    def __setitem__(self, key, value):
+        self._load_all()
+        RedisSession.__setitem__(self, key, value)
+
+    def update(self, *args, **kwargs):
+        self._load_all()
+        RedisSession.update(self, *args, **kwargs)
+
+    def clear(self):
+        # Clearing discards whatever is stored, so there is no need to
+        # fetch it first.
+        self.loaded = True
+        RedisSession.clear(self)
 
 
 class RedisSessionInterface(SessionInterface):
-    serializer = pickle
+    """
+    Server side sessions stored in Redis. The cookie only holds the
+    session id.
+
+    :param redis: A Redis client. Defaults to a local Redis.
+    :param prefix: The key prefix for stored sessions.
+    :param pickle_protocol: The protocol to write with when using
+                            the pickle serializer.
+    :param serializer: A registered serializer name (see
+                       :mod:`flask_boilerplate_utils.serializers`) or a
+                       Serializer instance.
+    :param legacy_pickle: Whether sessions previously written with
+                          pickle may still be read.
+    :param compressor: A registered compressor name (e.g. 'zlib') or a
+                       Compressor instance to compress sessions with.
+    :param compression_threshold: Sessions smaller than this many bytes
+                                  when serialized are not compressed.
+    :param write_back: Only write sessions back to Redis when their
+                       contents changed. Changes are detected by comparing
+                       a digest of the serialized session, so mutations of
+                       nested values are caught too.
+    :param refresh_interval: In write-back mode, the minimum number of
+                             seconds between TTL refreshes of an unchanged
+                             session. None never refreshes unchanged
+                             sessions, 0 refreshes on every request.
+    :param lazy: Only fetch the session from Redis when it is first
+                 used. Requests which never touch the session make no
+                 Redis calls at all.
+    :param cache: A LocalSessionCache of decoded sessions. Cached sessions
+                  are validated before use as set by cache_validation.
+    :param cache_validation: 'version' keeps a version counter per session
+                             in Redis, and a cached session is used when
+                             the counter is unchanged. This costs a GET of
+                             the counter instead of the whole session.
+                             'pubsub' publishes the id of every saved
+                             session, and cached sessions are used without
+                             asking Redis until another process saves them.
+                             Messages are not delivered reliably, so a
+                             cached session may be stale for up to the
+                             cache's max_age.
+    :param version_prefix: The key prefix for session version counters.
+    :param user_key: The session key holding the id of the logged in user.
+                     When set, the ids of each user's sessions are kept in
+                     a Redis set so they can be found without scanning
+                     every session (see
+                     :mod:`flask_boilerplate_utils.session_admin`).
+    :param user_index_prefix: The key prefix for the sets of user sessions.
+    :param max_lifetime: The longest a session may live in Redis, in
+                         seconds. Used as the expiry of the user sets.
+    :param batcher: A RedisBatcher. Sessions are then fetched in the same
+                    round trip as the request's prefetched keys, and
+                    written with the request's other queued writes.
+    """
+    serializer = 'pickle'
     session_class = RedisSession
+    lazy_session_class = LazyRedisSession
 
-    def __init__(self, redis=None, prefix='session:', pickle_protocol=None):
+    def __init__(self, redis=None, prefix='session:', pickle_protocol=None,
+                 serializer=None, legacy_pickle=True, compressor=None,
+                 compression_threshold=1024, write_back=False,
+                 refresh_interval=None, lazy=False, cache=None,
+                 cache_validation='version',
+                 version_prefix='session-version:', user_key=None,
+                 user_index_prefix='session-user:',
+                 max_lifetime=31 * 24 * 3600, batcher=None):
         if redis is None:
             redis = Redis()
         self.redis = redis
         self.prefix = prefix
         self.pickle_protocol = pickle_protocol
 
+        serializer = serializer or self.serializer
+        if isinstance(serializer, str):
+            options = {}
+            if serializer == 'pickle':
+                options['protocol'] = pickle_protocol
+            serializer = get_serializer(serializer, **options)
+        if isinstance(compressor, str):
+            compressor = get_compressor(compressor)
+        self.codec = SessionCodec(
+            serializer, legacy_pickle=legacy_pickle, compressor=compressor,
+            compression_threshold=compression_threshold)
+        self.write_back = write_back
+        self.refresh_interval = refresh_interval
+        self.lazy = lazy
+        self.cache = cache
+        self.cache_validation = cache_validation
+        self.version_prefix = version_prefix
+        self.invalidation_channel = prefix + 'invalidate'
+        self.user_key = user_key
+        self.user_index_prefix = user_index_prefix
+        self.max_lifetime = max_lifetime
+        self.batcher = batcher
+        self._listener_pid = None
+
+    @property
+    def invalidates(self):
+        """
+        Whether saving or deleting a session must invalidate locally
+        cached copies of it.
+        """
+        return self.cache is not None
+
+    def get_batch(self):
+        """
+        Return the current request's RequestBatch, or None when not
+        batching.
+        """
+        if self.batcher is None:
+            return None
+        return self.batcher.current()
+
+    @property
+    def transactions(self):
+        """
+        Whether writes touching several keys may use MULTI transactions.
+        A session's keys live in different slots of a Redis Cluster.
+        """
+        return not is_cluster(self.redis)
+
+    def pipeline(self, transaction=True):
+        """
+        Return a pipeline for writes. While batching, the commands of
+        pipelines which don't need a transaction are queued on the
+        request's batch instead.
+        """
+        transaction = transaction and self.transactions
+        batch = self.get_batch()
+        if batch is not None and not transaction:
+            return QueuedPipeline(batch)
+        return self.redis.pipeline(transaction=transaction)
+
+    def execute(self, pipe, callback=None, errback=None):
+        """
+        Execute a pipeline from pipeline(), calling callback with its
+        results. Queued pipelines are executed when the batch is flushed,
+        calling errback instead if any of their commands failed.
+        """
+        if isinstance(pipe, QueuedPipeline):
+            pipe.defer(callback, errback)
+            return
+        results = pipe.execute()
+        if callback is not None:
+            callback(results)
+
+    def execute_reads(self, pipe):
+        """
+        Execute a pipeline of reads, adding the keys the app prefetches to
+        the same round trip while batching.
+        """
+        batch = self.get_batch()
+        if batch is None:
+            return pipe.execute()
+        return batch.execute_reads(pipe)
+
     def generate_sid(self):
         return str(uuid4())
 
@@ -36,30 +310,275 @@ class RedisSessionInterface(SessionInterface):
             return app.permanent_session_lifetime
         return timedelta(days=1)
 
+    def get_digest(self, val):
+        """
+        Return the digest used to detect changes to a serialized session.
+        """
+        return hashlib.blake2b(val, digest_size=16).digest()
+
+    def should_refresh(self, session, redis_exp):
+        """
+        Whether the TTL of an unchanged session should be refreshed.
+
+        :param redis_exp: The full expiry of the session in seconds.
+        """
+        if self.refresh_interval is None:
+            return False
+        if session.ttl is None or session.ttl < 0:
+            return True
+        return redis_exp - session.ttl >= self.refresh_interval
+
+    def decode(self, val):
+        """
+        Decode a stored payload, returning None if it is missing or
+        cannot be read.
+        """
+        if val is None:
+            return None
+        try:
+            return self.codec.decode(val)
+        except SerializationError:
+            return None
+
     def open_session(self, app, request):
         sid = request.cookies.get(app.session_cookie_name)
         if not sid:
             sid = self.generate_sid()
             return self.session_class(sid=sid, new=True)
-        val = self.redis.get(self.prefix + sid)
-        if val is not None:
-            data = self.serializer.loads(val)
-            return self.session_class(data, sid=sid)
-        return self.session_class(sid=sid, new=True)
+
+        if self.lazy:
+            return self.lazy_session_class(sid=sid, loader=self.load_session)
+
+        session = self.session_class(sid=sid)
+        self.load_session(session)
+        return session
+
+    def load_session(self, session):
+        """
+        Fetch a session's data from Redis into the session.
+        """
+        if self.cache is not None and self.load_cached_session(session):
+            return
+
+        key = self.prefix + session.sid
+        fetch_ttl = self.write_back or self.cache is not None
+        fetch_version = (self.cache is not None and
+                         self.cache_validation == 'version')
+        if fetch_ttl or self.batcher is not None:
+            # Fetch everything in the same round trip. The TTL lets
+            # save_session tell when the session was last written or
+            # refreshed.
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.get(key)
+            pipe.ttl(key)
+            if fetch_version:
+                pipe.get(self.version_prefix + session.sid)
+            results = self.execute_reads(pipe)
+            val, ttl = results[:2]
+            if fetch_version:
+                session.version = _parse_version(results[2])
+        else:
+            val, ttl = self.redis.get(key), None
+        self.fill_session(session, val, ttl)
+
+    def read_sessions(self, sids, redis=None):
+        """
+        Return the data of each of the given sessions, fetched in one
+        round trip, with None for sessions which are missing or unreadable.
+        Does not use or affect the local cache.
+
+        :param redis: The client to read with. Defaults to the interface's.
+        """
+        pipe = (redis or self.redis).pipeline(transaction=False)
+        for sid in sids:
+            pipe.get(self.prefix + sid)
+        return [self.decode(val) for val in pipe.execute()]
+
+    def fill_session(self, session, val, ttl):
+        """
+        Populate a session from its stored payload and remaining TTL.
+        """
+        data = self.decode(val)
+        if data is None:
+            session.new = True
+            return
+
+        dict.update(session, data)
+        session.ttl = ttl
+        if self.write_back:
+            session.digest = self.get_digest(val)
+
+    def load_cached_session(self, session):
+        """
+        Load a session from the local cache if it has a valid entry.
+        Returns whether the session was loaded.
+        """
+        if self.cache_validation == 'pubsub':
+            self.start_invalidation_listener()
+
+        entry = self.cache.take(session.sid)
+        if entry is None:
+            self.cache.misses += 1
+            return False
+
+        if self.cache_validation == 'version':
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.get(self.version_prefix + session.sid)
+            version = self.execute_reads(pipe)[0]
+            if _parse_version(version) != entry.version:
+                self.cache.misses += 1
+                return False
+
+        self.cache.hits += 1
+        dict.update(session, entry.data)
+        session.digest = entry.digest
+        session.ttl = entry.remaining_ttl()
+        session.version = entry.version
+        return True
+
+    def start_invalidation_listener(self):
+        """
+        Subscribe to the invalidation channel, dropping cached sessions
+        saved by other processes. Started once per process.
+        """
+        pid = os.getpid()
+        if self._listener_pid == pid:
+            return
+        self._listener_pid = pid
+        self._origin = uuid4().hex
+        self.cache.clear()
+
+        def on_message(message):
+            data = message['data']
+            if isinstance(data, bytes):
+                data = data.decode('utf-8')
+            origin, _, sid = data.partition(':')
+            if origin != self._origin:
+                self.cache.discard(sid)
+
+        pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{self.invalidation_channel: on_message})
+        self._listener = pubsub.run_in_thread(sleep_time=1, daemon=True)
+
+    def cache_session(self, session, size, ttl):
+        """
+        Put a saved session back into the local cache.
+        """
+        if self.cache is not None:
+            self.cache.put(session.sid, dict(session), session.version, size,
+                           digest=session.digest, ttl=ttl)
+
+    def write_session(self, session, val, redis_exp):
+        """
+        Store a serialized session, along with its version counter or an
+        invalidation message when a local cache is used, and put it in
+        the local cache once written.
+        """
+        key = self.prefix + session.sid
+        if (not self.invalidates and self.user_key is None and
+                self.batcher is None):
+            self.redis.set(key, val, ex=redis_exp)
+            return
+
+        def written(results):
+            if self.invalidates and self.cache_validation == 'version':
+                session.version = results[1]
+            self.cache_session(session, len(val), redis_exp)
+
+        def failed(error):
+            if self.cache is not None:
+                self.cache.discard(session.sid)
+
+        # The session and its invalidation are written together or not
+        # at all.
+        pipe = self.pipeline(transaction=self.invalidates)
+        pipe.set(key, val, ex=redis_exp)
+        if self.invalidates:
+            self.queue_invalidation(pipe, session.sid, redis_exp)
+        self.queue_user_index(pipe, session)
+        self.execute(pipe, written, failed)
+
+    def delete_session(self, session, redis_exp):
+        key = self.prefix + session.sid
+        if self.cache is None and self.batcher is None:
+            self.redis.delete(key)
+            return
+
+        pipe = self.pipeline(transaction=self.cache is not None)
+        pipe.delete(key)
+        if self.cache is not None:
+            self.cache.discard(session.sid)
+            self.queue_invalidation(pipe, session.sid, redis_exp)
+        self.execute(pipe)
+
+    def queue_invalidation(self, pipe, sid, redis_exp):
+        if self.cache_validation == 'version':
+            # Deleting a session bumps its version too, so that the
+            # counter outlives the session and stale entries can't match.
+            pipe.incr(self.version_prefix + sid)
+            pipe.expire(self.version_prefix + sid, redis_exp)
+        else:
+            self.start_invalidation_listener()
+            pipe.publish(self.invalidation_channel,
+                         '%s:%s' % (self._origin, sid))
+
+    def queue_user_index(self, pipe, session):
+        """
+        Add the session to its user's set of sessions, if it has a user.
+        Sessions are not removed from the set when they expire or change
+        user; stale members are pruned when the set is next read.
+        """
+        if self.user_key is None:
+            return
+        user_id = session.get(self.user_key)
+        if user_id is None:
+            return
+        index = self.user_index_prefix + str(user_id)
+        pipe.sadd(index, session.sid)
+        pipe.expire(index, self.max_lifetime)
 
     def save_session(self, app, session, response):
+        if not session.loaded:
+            # A lazy session which was never used is left as it is.
+            return
         domain = self.get_cookie_domain(app)
+        redis_exp = int(
+            self.get_redis_expiration_time(app, session).total_seconds())
         if not session:
-            self.redis.delete(self.prefix + session.sid)
+            # A new session was never stored, so there is nothing to delete.
+            if not (self.write_back and session.new):
+                self.delete_session(session, redis_exp)
             if session.modified:
                 response.delete_cookie(app.session_cookie_name,
                                        domain=domain)
             return
-        redis_exp = self.get_redis_expiration_time(app, session)
         cookie_exp = self.get_expiration_time(app, session)
-        val = self.serializer.dumps(dict(session), protocol=self.pickle_protocol)
-        self.redis.setex(self.prefix + session.sid, val,
-                         int(redis_exp.total_seconds()))
+        val = self.codec.encode(dict(session))
+        digest = self.get_digest(val) if self.write_back else None
+
+        if (self.write_back and session.digest is not None and
+                digest == session.digest):
+            refresh = self.should_refresh(session, redis_exp)
+            if refresh:
+                pipe = self.pipeline(transaction=False)
+                pipe.expire(self.prefix + session.sid, redis_exp)
+                if (self.cache is not None and
+                        self.cache_validation == 'version'):
+                    pipe.expire(self.version_prefix + session.sid, redis_exp)
+                self.queue_user_index(pipe, session)
+                self.execute(pipe)
+                session.ttl = redis_exp
+            self.cache_session(session, len(val), session.ttl)
+            if not refresh:
+                return
+        else:
+            session.digest = digest
+            self.write_session(session, val, redis_exp)
+
         response.set_cookie(app.session_cookie_name, session.sid,
                             expires=cookie_exp, httponly=True,
                             domain=domain)
+
+
+def _parse_version(version):
+    return int(version) if version is not None else None
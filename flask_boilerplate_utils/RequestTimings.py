@@ -0,0 +1,214 @@
+import hmac
+from bisect import bisect_left
+from functools import wraps
+from threading import Lock
+from time import perf_counter
+
+from flask import has_request_context, request
+
+ENVIRON_KEY = 'boilerplate.timings'
+
+# Histogram bucket upper bounds, in seconds.
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0)
+
+
+def _current_timings():
+    if not has_request_context():
+        return None
+    return request.environ.get(ENVIRON_KEY)
+
+
+def record(phase, seconds):
+    """
+    Add time spent in a phase to the current request's timings.
+    """
+    timings = _current_timings()
+    if timings is not None:
+        timings[phase] = timings.get(phase, 0.0) + seconds
+
+
+def timed(phase, func):
+    """
+    Wrap a function so that the time spent in it is added to the current
+    request's timings for a phase.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        timings = _current_timings()
+        if timings is None:
+            return func(*args, **kwargs)
+        start = perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            timings[phase] = timings.get(phase, 0.0) + perf_counter() - start
+    return wrapper
+
+
+class Histogram(object):
+    """
+    A Prometheus style histogram of durations in seconds.
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = Lock()
+
+    def observe(self, seconds):
+        index = bisect_left(self.buckets, seconds)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += seconds
+            self.count += 1
+
+    def cumulative(self):
+        """
+        Return a list of (upper bound, count) tuples, ending with '+Inf'.
+        """
+        with self._lock:
+            counts = list(self.counts)
+        total = 0
+        result = []
+        for bound, count in zip(self.buckets + ('+Inf',), counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+class RequestTimings(object):
+    """
+    Wrap the application in this middleware to time where requests spend
+    their time: opening and saving the session, CSRF validation, the
+    view, template rendering, and the render_field and csrf_setup
+    template globals.
+
+    Each response gets a Server-Timing header with its request's phases,
+    which browser developer tools show alongside the request, and the
+    timings are collected into per-process histograms served in the
+    Prometheus text format at metrics_path, to requests with an
+    ``Authorization: Bearer <metrics_token>`` header.
+
+    Phases overlap: the view includes the templates it renders, which
+    include render_field. total is the time until the response's headers
+    are sent.
+
+    :param app: the WSGI application
+    :param flask_app: the Flask app to instrument.
+    :param server_timing: add the Server-Timing header to responses.
+    :param metrics_path: the path to serve the histograms at, or None.
+    :param metrics_token: the bearer token needed to read the histograms.
+                          Required with a metrics_path.
+    """
+
+    def __init__(self, app, flask_app=None, server_timing=True,
+                 metrics_path=None, metrics_token=None):
+        if metrics_path and not metrics_token:
+            raise ValueError('A metrics_path needs a metrics_token.')
+        self.app = app
+        self.server_timing = server_timing
+        self.metrics_path = metrics_path
+        self.metrics_token = metrics_token
+        self.histograms = {}
+        self.collectors = []
+        self._lock = Lock()
+        if flask_app is not None:
+            self.instrument(flask_app)
+
+    def instrument(self, flask_app):
+        """
+        Time the phases of a Flask app's requests.
+        """
+        interface = flask_app.session_interface
+        interface.open_session = timed('session-open', interface.open_session)
+        interface.save_session = timed('session-save', interface.save_session)
+
+        # CsrfProtect validates the token in a before_request function.
+        before = flask_app.before_request_funcs.get(None, [])
+        for index, func in enumerate(before):
+            if getattr(func, '__module__', '').startswith('flask_wtf'):
+                before[index] = timed('csrf', func)
+
+        flask_app.dispatch_request = timed('view',
+                                           flask_app.dispatch_request)
+
+        env = flask_app.jinja_env
+        env.template_class = type('TimedTemplate', (env.template_class,), {
+            'render': timed('template', env.template_class.render)})
+        for name in ('render_field', 'csrf_setup'):
+            if name in env.globals:
+                env.globals[name] = timed(name.replace('_', '-'),
+                                          env.globals[name])
+
+    def add_collector(self, collector):
+        """
+        Serve more metrics along with the histograms. collector is called
+        for every scrape, and returns a list of lines in the Prometheus
+        text format.
+        """
+        self.collectors.append(collector)
+
+    def observe(self, timings):
+        for phase, seconds in timings.items():
+            histogram = self.histograms.get(phase)
+            if histogram is None:
+                with self._lock:
+                    histogram = self.histograms.setdefault(phase, Histogram())
+            histogram.observe(seconds)
+
+    def server_timing_header(self, timings):
+        return ', '.join('%s;dur=%.3f' % (phase, seconds * 1000)
+                         for phase, seconds in timings.items())
+
+    def __call__(self, environ, start_response):
+        if self.metrics_path and environ.get('PATH_INFO') == self.metrics_path:
+            return self.serve_metrics(environ, start_response)
+
+        timings = environ[ENVIRON_KEY] = {}
+        start = perf_counter()
+
+        def timed_start_response(status, headers, exc_info=None):
+            if 'total' not in timings:
+                timings['total'] = perf_counter() - start
+                if self.server_timing:
+                    headers.append(('Server-Timing',
+                                    self.server_timing_header(timings)))
+                self.observe(timings)
+            return start_response(status, headers, exc_info)
+
+        return self.app(environ, timed_start_response)
+
+    def prometheus(self):
+        """
+        Return the histograms in the Prometheus text format.
+        """
+        name = 'boilerplate_request_phase_seconds'
+        lines = ['# HELP %s Time spent in each phase of a request.' % name,
+                 '# TYPE %s histogram' % name]
+        for phase, histogram in sorted(self.histograms.items()):
+            for bound, count in histogram.cumulative():
+                lines.append('%s_bucket{phase="%s",le="%s"} %d' % (
+                    name, phase, bound, count))
+            lines.append('%s_sum{phase="%s"} %.6f' % (
+                name, phase, histogram.sum))
+            lines.append('%s_count{phase="%s"} %d' % (
+                name, phase, histogram.count))
+        for collector in self.collectors:
+            lines.extend(collector())
+        return '\n'.join(lines) + '\n'
+
+    def serve_metrics(self, environ, start_response):
+        # The remote address can't be trusted behind a reverse proxy.
+        given = environ.get('HTTP_AUTHORIZATION', '').encode('latin-1')
+        expected = ('Bearer ' + self.metrics_token).encode('utf-8')
+        if not hmac.compare_digest(given, expected):
+            start_response('404 NOT FOUND', [('Content-Type', 'text/plain')])
+            return [b'Not Found']
+        body = self.prometheus().encode('utf-8')
+        start_response('200 OK', [
+            ('Content-Type', 'text/plain; version=0.0.4; charset=utf-8'),
+            ('Content-Length', str(len(body)))])
+        return [body]
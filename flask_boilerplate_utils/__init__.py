@@ -1,6 +1,6 @@
 from flask import Blueprint
-from .jinja_globals import render_field, csrf_setup
-from .filters import timesince, percent_escape
+from .jinja_globals import render_field, CsrfSetup
+from .filters import timesince, timesince_batch, percent_escape
 from .overrides import FlaskView
 class Boilerplate(object):
 
@@ -13,25 +13,49 @@ class Boilerplate(object):
         self.app = app
 
         app.config.setdefault('CSRF_ENABLED', True)
+        app.config.setdefault('CSRF_SETUP_MODE', 'inline')
         app.config.setdefault('SENTRY_ENABLED', False)
         app.config.setdefault('BEHIND_REVERSE_PROXY', False)
         app.config.setdefault('REDIS_SESSIONS_ENABLED', False)
-        app.config.setdefault('REDIS_SESSIONS_DB', 1)
-        app.config.setdefault('REDIS_SESSIONS_HOST', '127.0.0.1')
-        app.config.setdefault('REDIS_SESSIONS_PORT', 6379)
-        app.config.setdefault('REDIS_SESSIONS_PICKLE_PROTO', 3)
+        app.config.setdefault('REDIS_BATCH_ENABLED', False)
+        app.config.setdefault('REDIS_PREFETCH_KEYS', [])
+        app.config.setdefault('TEMPLATE_CACHE_DIR', None)
+        app.config.setdefault('TEMPLATE_PRELOAD', None)
+        app.config.setdefault('UPLOAD_GUARD_ENABLED', False)
+        app.config.setdefault('UPLOAD_MAX_FILE_SIZE', None)
+        app.config.setdefault('UPLOAD_ALLOWED_TYPES', None)
+        app.config.setdefault('UPLOAD_HASH', None)
         app.config.setdefault('BABEL_ENABLED', False)
+        app.config.setdefault('PROFILER_ENABLED', False)
+        app.config.setdefault('PROFILER_INTERVAL', 0.005)
+        app.config.setdefault('PROFILER_ALL_THREADS', False)
+        app.config.setdefault('PROFILER_SIGNAL', 'SIGUSR2')
+        app.config.setdefault('PROFILER_OUTPUT_DIR', None)
+        app.config.setdefault('PROFILER_ENDPOINT', None)
+        app.config.setdefault('PROFILER_TOKEN', None)
+        app.config.setdefault('INSTRUMENTATION_ENABLED', False)
+        app.config.setdefault('INSTRUMENTATION_SERVER_TIMING', True)
+        app.config.setdefault('INSTRUMENTATION_METRICS_PATH', None)
+        app.config.setdefault('INSTRUMENTATION_METRICS_TOKEN', None)
 
         
 
-        bp = Blueprint('boilerplate', __name__, template_folder='templates')
+        bp = Blueprint('boilerplate', __name__, template_folder='templates',
+                       static_folder='static',
+                       static_url_path='/_boilerplate/static')
         self.app.register_blueprint(bp)
 
+        if app.config.get('TEMPLATE_CACHE_DIR'):
+            from .template_cache import init_template_cache
+            init_template_cache(app)
+
         # Inject various globals into jinja
-        app.jinja_env.globals['csrf_setup'] = csrf_setup
+        app.jinja_env.globals['csrf_setup'] = CsrfSetup(
+            app, mode=app.config.get('CSRF_SETUP_MODE'))
         app.jinja_env.globals['render_field'] = render_field
         app.jinja_env.filters['percent_escape'] = percent_escape
         app.jinja_env.filters['time_since'] = timesince
+        app.jinja_env.filters['time_since_batch'] = timesince_batch
 
 
         if app.config.get('CSRF_ENABLED'):
@@ -44,30 +68,185 @@ class Boilerplate(object):
             app.wsgi_app = ReverseProxied(app.wsgi_app)
 
 
+        if app.config.get('UPLOAD_GUARD_ENABLED'):
+            from .uploads import init_upload_guard
+            init_upload_guard(app)
+
+
+        self.init_session_config(app)
+
         if app.config.get('SENTRY_ENABLED') and not app.debug:
             from raven.contrib.flask import Sentry
             app.sentry = Sentry(app)
 
         if app.config.get('REDIS_SESSIONS_ENABLED'):
+            if app.config.get('REDIS_SESSIONS_ASYNC'):
+                # Flask opens and saves sessions synchronously, so it would
+                # never await the async interface's coroutines.
+                raise RuntimeError(
+                    'REDIS_SESSIONS_ASYNC needs an app which awaits its '
+                    'session interface, such as Quart. Use '
+                    'AsyncRedisSessionInterface.init_async_sessions there.')
+            from .redis_client import create_redis
             from .RedisSessionInterface import RedisSessionInterface
-            from redis import Redis
 
-
-            redis = Redis(
-                host=app.config.get('REDIS_SESSIONS_HOST'),
-                port=app.config.get('REDIS_SESSIONS_PORT'),
-                db=app.config.get('REDIS_SESSIONS_DB')
-            )
-            app.session_interface = RedisSessionInterface(
-                redis=redis, 
-                pickle_protocol=app.config.get('REDIS_SESSIONS_PICKLE_PROTO')
+            options, cache_validation = self.session_options(app)
+            cache = None
+            if cache_validation:
+                from .session_cache import LocalSessionCache
+                cache = LocalSessionCache(
+                    max_entries=app.config.get(
+                        'REDIS_SESSIONS_LOCAL_CACHE_ENTRIES'),
+                    max_bytes=app.config.get(
+                        'REDIS_SESSIONS_LOCAL_CACHE_BYTES'),
+                    max_age=app.config.get(
+                        'REDIS_SESSIONS_LOCAL_CACHE_MAX_AGE')
+                )
+
+            interface_class = RedisSessionInterface
+            if app.config.get('REDIS_SESSIONS_STORAGE') == 'hash':
+                from .RedisHashSessionInterface import \
+                    RedisHashSessionInterface
+                interface_class = RedisHashSessionInterface
+
+            app.session_interface = interface_class(
+                redis=create_redis(app.config, 'REDIS_SESSIONS_'),
+                lazy=app.config.get('REDIS_SESSIONS_LAZY'),
+                cache=cache,
+                cache_validation=cache_validation or 'version',
+                **options
             )
 
+        if app.config.get('REDIS_BATCH_ENABLED'):
+            from .redis_batch import RedisBatcher
+            from .RedisSessionInterface import RedisSessionInterface
+
+            session_interface = app.session_interface
+            if isinstance(session_interface, RedisSessionInterface):
+                redis = session_interface.redis
+            else:
+                from .redis_client import create_redis
+                redis = create_redis(app.config, 'REDIS_SESSIONS_')
+                session_interface = None
+
+            app.redis_batch = RedisBatcher(
+                app, redis, prefetch=app.config.get('REDIS_PREFETCH_KEYS'))
+            if session_interface is not None:
+                session_interface.batcher = app.redis_batch
+
         if app.config.get('BABEL_ENABLED'):
-            from flask.ext.babel import Babel
-            from .filters import local_date, local_date_time
+            from flask_babel import Babel
+            from .filters import local_date, local_date_time, \
+                local_date_batch, local_date_time_batch
             app.babel = Babel(app)
             app.jinja_env.filters['local_date'] = local_date
             app.jinja_env.filters['local_date_time'] = local_date_time
+            app.jinja_env.filters['local_date_batch'] = local_date_batch
+            app.jinja_env.filters['local_date_time_batch'] = \
+                local_date_time_batch
+
+        if app.config.get('PROFILER_ENABLED'):
+            from .profiler import init_profiler
+            init_profiler(app)
+
+        if app.config.get('INSTRUMENTATION_ENABLED'):
+            # Installed last, so that it times the other features and its
+            # total includes every middleware.
+            from .RequestTimings import RequestTimings
+            app.request_timings = RequestTimings(
+                app.wsgi_app, app,
+                server_timing=app.config.get('INSTRUMENTATION_SERVER_TIMING'),
+                metrics_path=app.config.get('INSTRUMENTATION_METRICS_PATH'),
+                metrics_token=app.config.get('INSTRUMENTATION_METRICS_TOKEN'))
+            app.wsgi_app = app.request_timings
+            if app.config.get('REDIS_SESSIONS_ENABLED'):
+                from .redis_client import prometheus_pool_stats
+                app.request_timings.add_collector(
+                    lambda: prometheus_pool_stats(app.session_interface.redis))
 
         return True
+
+    def init_session_config(self, app):
+        """
+        Set the defaults of the REDIS_SESSIONS config keys.
+        """
+        from .redis_client import init_config
+        app.config.setdefault('REDIS_SESSIONS_DB', 1)
+        app.config.setdefault('REDIS_SESSIONS_HOST', '127.0.0.1')
+        app.config.setdefault('REDIS_SESSIONS_PORT', 6379)
+        app.config.setdefault('REDIS_SESSIONS_PICKLE_PROTO', 3)
+        app.config.setdefault('REDIS_SESSIONS_SERIALIZER', 'pickle')
+        app.config.setdefault('REDIS_SESSIONS_ALLOW_PICKLE', True)
+        app.config.setdefault('REDIS_SESSIONS_WRITE_BACK', False)
+        app.config.setdefault('REDIS_SESSIONS_REFRESH_INTERVAL', 60)
+        app.config.setdefault('REDIS_SESSIONS_STORAGE', 'string')
+        app.config.setdefault('REDIS_SESSIONS_LAZY', False)
+        app.config.setdefault('REDIS_SESSIONS_LOCAL_CACHE', False)
+        app.config.setdefault('REDIS_SESSIONS_LOCAL_CACHE_ENTRIES', 1000)
+        app.config.setdefault('REDIS_SESSIONS_LOCAL_CACHE_BYTES', 16 * 1024 * 1024)
+        app.config.setdefault('REDIS_SESSIONS_LOCAL_CACHE_MAX_AGE', 300)
+        app.config.setdefault('REDIS_SESSIONS_LOCAL_CACHE_VALIDATION', 'version')
+        app.config.setdefault('REDIS_SESSIONS_COMPRESSION', None)
+        app.config.setdefault('REDIS_SESSIONS_COMPRESSION_THRESHOLD', 1024)
+        app.config.setdefault('REDIS_SESSIONS_COMPRESSION_LEVEL', None)
+        app.config.setdefault('REDIS_SESSIONS_COMPRESSION_DICT', None)
+        app.config.setdefault('REDIS_SESSIONS_COMPRESSION_OLD_DICTS', [])
+        app.config.setdefault('REDIS_SESSIONS_USER_KEY', None)
+        app.config.setdefault('REDIS_SESSIONS_USER_INDEX_PREFIX', 'session-user:')
+        app.config.setdefault('REDIS_SESSIONS_PREFETCH_BODY', False)
+        init_config(app.config, 'REDIS_SESSIONS_')
+
+    def session_options(self, app):
+        """
+        Return a tuple of the session interface options set by the
+        REDIS_SESSIONS config keys, and the local cache validation mode, or
+        None without a local cache.
+        """
+        options = dict(
+            pickle_protocol=app.config.get('REDIS_SESSIONS_PICKLE_PROTO'),
+            serializer=app.config.get('REDIS_SESSIONS_SERIALIZER'),
+            legacy_pickle=app.config.get('REDIS_SESSIONS_ALLOW_PICKLE'),
+            compressor=self.create_session_compressor(app),
+            compression_threshold=app.config.get(
+                'REDIS_SESSIONS_COMPRESSION_THRESHOLD'),
+            write_back=app.config.get('REDIS_SESSIONS_WRITE_BACK'),
+            refresh_interval=app.config.get(
+                'REDIS_SESSIONS_REFRESH_INTERVAL'),
+            user_key=app.config.get('REDIS_SESSIONS_USER_KEY'),
+            user_index_prefix=app.config.get(
+                'REDIS_SESSIONS_USER_INDEX_PREFIX'),
+            max_lifetime=max(
+                int(app.permanent_session_lifetime.total_seconds()),
+                24 * 3600)
+        )
+        cache_validation = None
+        if app.config.get('REDIS_SESSIONS_LOCAL_CACHE'):
+            cache_validation = app.config.get(
+                'REDIS_SESSIONS_LOCAL_CACHE_VALIDATION')
+        return options, cache_validation
+
+    def create_session_compressor(self, app):
+        """
+        Create the session compressor from the REDIS_SESSIONS_COMPRESSION
+        config keys. Setting REDIS_SESSIONS_COMPRESSION_DICT to the path
+        of a trained dictionary selects zstd with that dictionary.
+        """
+        name = app.config.get('REDIS_SESSIONS_COMPRESSION')
+        if not name:
+            return None
+
+        from .serializers import get_compressor
+        options = {}
+        if app.config.get('REDIS_SESSIONS_COMPRESSION_LEVEL') is not None:
+            options['level'] = app.config.get(
+                'REDIS_SESSIONS_COMPRESSION_LEVEL')
+        if app.config.get('REDIS_SESSIONS_COMPRESSION_DICT'):
+            name = 'zstd-dict'
+            with open(app.config.get('REDIS_SESSIONS_COMPRESSION_DICT'),
+                      'rb') as fh:
+                options['dictionary'] = fh.read()
+            options['dictionaries'] = []
+            for path in app.config.get('REDIS_SESSIONS_COMPRESSION_OLD_DICTS'):
+                with open(path, 'rb') as fh:
+                    options['dictionaries'].append(fh.read())
+        return get_compressor(name, **options)
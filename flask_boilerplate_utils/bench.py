@@ -0,0 +1,207 @@
+"""
+Measure the app's throughput and latency in-process, through its WSGI
+interface, without a server or network in the way.
+
+The boilerplate features ``Boilerplate.init_app`` wires in can be
+switched on and off between runs, given an app factory which takes a dict
+of config overrides and returns a new app::
+
+    manager = MainManager(app, app_factory=lambda config: create_app(
+        overrides=config))
+
+    $ python manage.py bench -r / -r "POST /login" -n 2000 --compare \\
+        --json bench.json
+"""
+import threading
+import time
+
+from werkzeug.test import EnvironBuilder
+
+# Boilerplate features and the config keys which enable them.
+FEATURES = {
+    'csrf': 'CSRF_ENABLED',
+    'reverse_proxy': 'BEHIND_REVERSE_PROXY',
+    'redis_sessions': 'REDIS_SESSIONS_ENABLED',
+    'sentry': 'SENTRY_ENABLED',
+    'babel': 'BABEL_ENABLED',
+}
+
+
+def feature_config(features):
+    """
+    Return the config overrides for a dict of feature names to booleans.
+    """
+    config = {}
+    for name, enabled in features.items():
+        if name not in FEATURES:
+            raise ValueError('Unknown feature %r, expected one of %s' % (
+                name, ', '.join(sorted(FEATURES))))
+        config[FEATURES[name]] = enabled
+    return config
+
+
+def make_environ(route):
+    """
+    Build a WSGI environ for a route such as '/', or 'POST /login'.
+    """
+    method, _, path = route.strip().rpartition(' ')
+    return EnvironBuilder(path=path, method=method or 'GET').get_environ()
+
+
+def percentile(values, q):
+    """
+    Return the q-th percentile of a sorted list, interpolating between
+    the closest values.
+    """
+    if not values:
+        return None
+    position = (len(values) - 1) * q / 100.0
+    low = int(position)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (position - low)
+
+
+def call_app(app, environ):
+    """
+    Make one request to a WSGI app, consuming the response. Returns the
+    status code.
+    """
+    status = []
+
+    def start_response(code, headers, exc_info=None):
+        status.append(code)
+        return lambda data: None
+
+    response = app(dict(environ), start_response)
+    try:
+        for _ in response:
+            pass
+    finally:
+        if hasattr(response, 'close'):
+            response.close()
+    return int(status[0].split(' ', 1)[0])
+
+
+def _drive(app, environs, count, latencies, statuses, lock):
+    timer = time.perf_counter
+    local_latencies = []
+    local_statuses = {}
+    for index in range(count):
+        start = timer()
+        code = call_app(app, environs[index % len(environs)])
+        local_latencies.append(timer() - start)
+        local_statuses[code] = local_statuses.get(code, 0) + 1
+    with lock:
+        latencies.extend(local_latencies)
+        for code, seen in local_statuses.items():
+            statuses[code] = statuses.get(code, 0) + seen
+
+
+def measure_allocations(app, environs, count):
+    """
+    Return a tuple of the mean peak traced memory of a request and the
+    mean memory it leaves allocated, in bytes, measured with tracemalloc.
+    """
+    import tracemalloc
+    tracemalloc.start()
+    try:
+        peaks = 0
+        start_size = tracemalloc.get_traced_memory()[0]
+        for index in range(count):
+            before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            call_app(app, environs[index % len(environs)])
+            peaks += tracemalloc.get_traced_memory()[1] - before
+        retained = tracemalloc.get_traced_memory()[0] - start_size
+    finally:
+        tracemalloc.stop()
+    return peaks // count, retained // count
+
+
+def benchmark(app, routes, requests=1000, concurrency=1, warmup=50,
+              allocations=False):
+    """
+    Make requests to an app in-process and return a dict of the results:
+    requests, seconds, rps, the mean, p50, p95 and p99 latency in
+    milliseconds, the count of each status code, and with allocations
+    the peak and retained bytes per request.
+
+    :param app: A WSGI app.
+    :param routes: A list of routes, ie ['/', 'POST /login'], requested
+                   in turn.
+    :param requests: The number of requests to measure.
+    :param concurrency: The number of threads making requests at once.
+    :param warmup: The number of requests to make before measuring.
+    :param allocations: Measure memory allocations per request, with a
+                        separate run of requests under tracemalloc.
+    """
+    environs = [make_environ(route) for route in routes]
+    for index in range(warmup):
+        call_app(app, environs[index % len(environs)])
+
+    latencies = []
+    statuses = {}
+    lock = threading.Lock()
+    counts = [requests // concurrency] * concurrency
+    for index in range(requests % concurrency):
+        counts[index] += 1
+    threads = [threading.Thread(target=_drive, args=(
+        app, environs, count, latencies, statuses, lock))
+        for count in counts]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - start
+
+    latencies.sort()
+    result = {
+        'routes': list(routes),
+        'requests': len(latencies),
+        'concurrency': concurrency,
+        'seconds': round(seconds, 4),
+        'rps': round(len(latencies) / seconds, 1) if seconds else None,
+        'mean_ms': round(sum(latencies) * 1000 / len(latencies), 3)
+        if latencies else None,
+        'statuses': dict((str(code), seen)
+                         for code, seen in sorted(statuses.items())),
+    }
+    for q in (50, 95, 99):
+        value = percentile(latencies, q)
+        result['p%d_ms' % q] = round(value * 1000, 3) \
+            if value is not None else None
+    if allocations:
+        peak, retained = measure_allocations(
+            app, environs, min(requests, 200))
+        result['alloc_peak_bytes'] = peak
+        result['alloc_retained_bytes'] = retained
+    return result
+
+
+def compare_features(app_factory, routes, base=None, features=None,
+                     **options):
+    """
+    Benchmark an app built with the base features, then with each of the
+    features flipped in turn. Returns a list of (name, result) tuples,
+    starting with ('base', result).
+
+    :param app_factory: A function taking a dict of config overrides and
+                        returning a new app.
+    :param base: A dict of feature names to booleans for the base app.
+    :param features: The features to flip. Defaults to all of them.
+    :param options: Passed to benchmark.
+    """
+    base = dict(base or {})
+    config = feature_config(base)
+    base_app = app_factory(dict(config))
+    results = [('base', benchmark(base_app, routes, **options))]
+    for name in features or sorted(FEATURES):
+        enabled = base.get(name)
+        if enabled is None:
+            enabled = bool(base_app.config.get(FEATURES[name]))
+        flipped = dict(base, **{name: not enabled})
+        app = app_factory(feature_config(flipped))
+        results.append(('%s=%s' % (name, 'off' if enabled else 'on'),
+                        benchmark(app, routes, **options)))
+    return results
@@ -1,11 +1,14 @@
-from flask.ext.script import Option, Manager, Command
+from flask.ext.script import Option, Manager, Command, prompt_bool
 
 # Manager Factory.
-def MainManager(app, tests_module=None, **kwargs):
+def MainManager(app, tests_module=None, app_factory=None, **kwargs):
     """
     A factory which creates a flask-script manager and configure it for use
     with the boilerplate. 
 
+    :param app_factory: A function which takes a dict of config overrides
+                        and returns a new app, used by the bench command to
+                        switch boilerplate features on and off.
     :param kwargs: keyword arguments to send to flask-script's Manager
                    class initialiser
     """
@@ -17,10 +20,22 @@ def MainManager(app, tests_module=None, **kwargs):
     manager.add_command('server', Run(app))
     manager.add_command('meinheld', Host(app))
     manager.add_command('info', info_manager)
-    if tests_module:
-        tests_command = Test(app)
-        tests_command.tests_module = tests_module
-        manager.add_command('test', tests_command)
+    manager.add_command('precompile', Precompile(app))
+    bench_command = Bench(app)
+    bench_command.app_factory = app_factory
+    manager.add_command('bench', bench_command)
+    manager.add_command('profile', Profile(app))
+    if app.config.get('REDIS_SESSIONS_ENABLED'):
+        sessions_manager = SessionsManager(app, **kwargs)
+        sessions_manager.add_command('list', ListSessions(app))
+        sessions_manager.add_command('purge', PurgeSessions(app))
+        sessions_manager.add_command('revoke', RevokeSessions(app))
+        sessions_manager.add_command('train-dictionary', TrainDictionary(app))
+        manager.add_command('sessions', sessions_manager)
+    tests_command = Test(app)
+    tests_command.tests_module = tests_module
+    tests_command.app_factory = app_factory
+    manager.add_command('test', tests_command)
 
     if not app.config.get('IS_CLEAN', True):
         manager.add_command('cleanup', Cleanup(app))
@@ -73,6 +88,326 @@ class GetRoutes(BaseCommand):
                 methods.ljust(largest[2])))
 
 
+class SessionsManager(Manager):
+    """
+    Manage the app's Redis sessions.
+    """
+
+class SessionsCommand(BaseCommand):
+    """
+    Base class for commands which manage the stored sessions.
+    """
+
+    def get_admin(self):
+        from .AsyncRedisSessionInterface import AsyncRedisSessionInterface
+        from .session_admin import SessionAdmin
+        redis = None
+        if isinstance(self.app.session_interface, AsyncRedisSessionInterface):
+            # Commands run synchronously, so they need a client of their own.
+            from .redis_client import create_redis
+            redis = create_redis(self.app.config, 'REDIS_SESSIONS_')
+        return SessionAdmin(self.app.session_interface, redis=redis)
+
+class ListSessions(SessionsCommand):
+    """
+    List the stored sessions and their remaining TTLs, without blocking
+    Redis.
+    """
+
+    option_list = (
+        Option('--match', '-m', dest='match', default='*', type=str,
+               help='A glob pattern of session ids to list.'),
+        Option('--user', '-u', dest='user', default=None, type=str,
+               help='Only list the sessions of this user id.'),
+        Option('--memory', dest='memory', default=False, action='store_true',
+               help='Show the memory used by each session.'),
+    ) + BaseCommand.option_list
+
+    def run(self, match, user, memory, **kwargs):
+        admin = self.get_admin()
+        if user is not None:
+            for sid in admin.user_sessions(user):
+                print(sid)
+            return
+
+        count = 0
+        total = 0
+        for info in admin.iter_sessions(match, memory=memory):
+            count += 1
+            if memory:
+                total += info.memory or 0
+                print("{} ttl={} memory={}".format(
+                    info.sid, info.ttl, info.memory))
+            else:
+                print("{} ttl={}".format(info.sid, info.ttl))
+        if memory:
+            print(" * {} sessions using {} bytes".format(count, total))
+        else:
+            print(" * {} sessions".format(count))
+
+class PurgeSessions(SessionsCommand):
+    """
+    Delete every stored session matching a pattern, logging their users
+    out.
+    """
+
+    option_list = (
+        Option('--match', '-m', dest='match', default='*', type=str,
+               help='A glob pattern of session ids to delete.'),
+        Option('--yes', '-y', dest='yes', default=False, action='store_true',
+               help='Do not ask for confirmation.'),
+    ) + BaseCommand.option_list
+
+    def run(self, match, yes, **kwargs):
+        if not yes and not prompt_bool(
+                "Delete all sessions matching '{}'".format(match)):
+            return
+        print(" * Deleted {} sessions".format(self.get_admin().purge(match)))
+
+class RevokeSessions(SessionsCommand):
+    """
+    Delete a user's sessions, logging them out everywhere, or delete
+    individual sessions.
+    """
+
+    option_list = (
+        Option('--user', '-u', dest='user', default=None, type=str,
+               help='Delete every session of this user id.'),
+        Option('sids', nargs='*', help='Session ids to delete.'),
+    ) + BaseCommand.option_list
+
+    def run(self, user, sids, **kwargs):
+        admin = self.get_admin()
+        deleted = admin.delete(sids)
+        if user is not None:
+            deleted += admin.revoke_user(user)
+        print(" * Deleted {} sessions".format(deleted))
+
+class TrainDictionary(SessionsCommand):
+    """
+    Train a zstd dictionary from a sample of the stored sessions, for use
+    with REDIS_SESSIONS_COMPRESSION_DICT.
+    """
+
+    option_list = (
+        Option('--output', '-o', dest='output', required=True, type=str),
+        Option('--samples', '-n', dest='samples', default=5000, type=int),
+        Option('--size', '-s', dest='size', default=16 * 1024, type=int),
+    ) + BaseCommand.option_list
+
+    def run(self, output, samples, size, **kwargs):
+        from .serializers import train_zstd_dictionary
+        interface = self.app.session_interface
+        redis = self.get_admin().redis
+        hashes = self.app.config.get('REDIS_SESSIONS_STORAGE') == 'hash'
+
+        payloads = []
+        keys = []
+        print(" * Sampling up to %d sessions" % samples)
+        # SCAN rather than KEYS so that Redis is never blocked, fetching
+        # the values of each batch of keys in one round trip.
+        for key in redis.scan_iter(match=interface.prefix + '*', count=500):
+            keys.append(key)
+            if len(keys) >= 500 or len(payloads) + len(keys) >= samples:
+                payloads.extend(self.fetch(interface, redis, keys, hashes))
+                keys = []
+            if len(payloads) >= samples:
+                break
+        if keys:
+            payloads.extend(self.fetch(interface, redis, keys, hashes))
+        payloads = payloads[:samples]
+
+        if not payloads:
+            print(" * No sessions found")
+            return
+        print(" * Training a %d byte dictionary from %d sessions" % (
+            size, len(payloads)))
+        dictionary = train_zstd_dictionary(payloads, size)
+        with open(output, 'wb') as fh:
+            fh.write(dictionary)
+        print(" * Written to %s" % output)
+
+    def fetch(self, interface, redis, keys, hashes):
+        from .serializers import SerializationError
+        pipe = redis.pipeline(transaction=False)
+        for key in keys:
+            if hashes:
+                pipe.hvals(key)
+            else:
+                pipe.get(key)
+        for value in pipe.execute():
+            for raw in (value if hashes else [value]):
+                if not raw:
+                    continue
+                # Train on the uncompressed payloads.
+                try:
+                    yield interface.codec.unwrap(raw)[1]
+                except SerializationError:
+                    continue
+
+class Precompile(BaseCommand):
+    """
+    Compile every template of the app and its blueprints ahead of time,
+    into the TEMPLATE_CACHE_DIR bytecode cache or a module directory.
+    """
+
+    option_list = (
+        Option('--cache-dir', dest='cache_dir', default=None, type=str,
+               help='The bytecode cache directory. Defaults to '
+                    'TEMPLATE_CACHE_DIR.'),
+        Option('--modules', dest='modules', default=None, type=str,
+               help='Compile to Python modules in this directory instead, '
+                    'for use with jinja2.ModuleLoader.'),
+    ) + BaseCommand.option_list
+
+    def run(self, cache_dir, modules, **kwargs):
+        from .template_cache import compile_templates, compile_to_modules, \
+            init_template_cache
+
+        if modules:
+            compiled, errors = compile_to_modules(self.app, modules)
+            for name, error in errors:
+                print(" ! {}: {}".format(name, error))
+            print(" * Compiled {} templates to {}".format(compiled, modules))
+            return
+
+        if cache_dir:
+            self.app.config['TEMPLATE_CACHE_DIR'] = cache_dir
+        if not init_template_cache(self.app):
+            print(" * Set TEMPLATE_CACHE_DIR or pass --cache-dir or --modules")
+            return
+        compiled, errors = compile_templates(self.app)
+        for name, error in errors:
+            print(" ! {}: {}".format(name, error))
+        print(" * Compiled {} templates into {}".format(
+            compiled, self.app.config['TEMPLATE_CACHE_DIR']))
+
+class Bench(BaseCommand):
+    """
+    Benchmark the app in-process through its WSGI interface, reporting
+    req/s, latency percentiles and allocations per request.
+    """
+
+    app_factory = None
+
+    option_list = (
+        Option('--route', '-r', dest='routes', action='append', default=None,
+               help='A route to request, ie / or "POST /login". Can be '
+                    'given more than once.'),
+        Option('--requests', '-n', dest='requests', default=1000, type=int),
+        Option('--concurrency', dest='concurrency', default=1, type=int),
+        Option('--warmup', dest='warmup', default=50, type=int),
+        Option('--feature', '-f', dest='features', action='append',
+               default=None,
+               help='Switch a boilerplate feature on or off, ie csrf=off. '
+                    'Needs an app_factory.'),
+        Option('--compare', dest='compare', default=False,
+               action='store_true',
+               help='Also benchmark with each feature not set by --feature '
+                    'switched in turn. Needs an app_factory.'),
+        Option('--allocations', dest='allocations', default=False,
+               action='store_true',
+               help='Measure the memory allocated per request.'),
+        Option('--json', dest='json_path', default=None, type=str,
+               help='Write the results as JSON to this file, or - for '
+                    'stdout.'),
+    ) + BaseCommand.option_list
+
+    def run(self, routes, requests, concurrency, warmup, features, compare,
+            allocations, json_path, **kwargs):
+        from .bench import FEATURES, benchmark, compare_features, \
+            feature_config
+        routes = routes or ['/']
+        if requests < 1 or concurrency < 1:
+            print(" ! --requests and --concurrency must be at least 1")
+            return
+        options = dict(requests=requests, concurrency=concurrency,
+                       warmup=warmup, allocations=allocations)
+        base = {}
+        for feature in features or ():
+            name, _, value = feature.partition('=')
+            base[name] = value.lower() not in ('off', 'false', '0', 'no')
+
+        if (base or compare) and self.app_factory is None:
+            print(" ! Switching features needs MainManager's app_factory")
+            return
+        if compare:
+            # Features set with --feature stay as they are.
+            results = compare_features(
+                self.app_factory, routes, base,
+                features=[name for name in sorted(FEATURES)
+                          if name not in base], **options)
+        else:
+            app = self.app
+            if base:
+                app = self.app_factory(feature_config(base))
+            results = [('base', benchmark(app, routes, **options))]
+
+        if json_path:
+            import json
+            output = json.dumps(dict(results), indent=2, sort_keys=True)
+            if json_path == '-':
+                print(output)
+                return
+            with open(json_path, 'w') as fh:
+                fh.write(output)
+
+        for name, result in results:
+            line = " * {:<22} {:>9} req/s  p50 {:.3f}ms  p95 {:.3f}ms  " \
+                "p99 {:.3f}ms".format(name, result['rps'], result['p50_ms'],
+                                      result['p95_ms'], result['p99_ms'])
+            if allocations:
+                line += "  {} bytes peak".format(result['alloc_peak_bytes'])
+            print(line)
+            errors = sum(seen for code, seen in result['statuses'].items()
+                         if int(code) >= 500)
+            if errors:
+                print(" ! {} requests failed".format(errors))
+
+class Profile(BaseCommand):
+    """
+    Profile requests to the app in-process with the sampling profiler,
+    writing collapsed stacks for flamegraph tools.
+    """
+
+    option_list = (
+        Option('--route', '-r', dest='routes', action='append', default=None,
+               help='A route to request, ie / or "POST /login". Can be '
+                    'given more than once.'),
+        Option('--requests', '-n', dest='requests', default=100, type=int),
+        Option('--interval', dest='interval', default=0.001, type=float,
+               help='The CPU time between samples, in seconds.'),
+        Option('--output', '-o', dest='output', default=None, type=str,
+               help='Write the collapsed stacks to this file.'),
+        Option('--top', dest='top', default=20, type=int,
+               help='Show the functions with the most self time.'),
+    ) + BaseCommand.option_list
+
+    def run(self, routes, requests, interval, output, top, **kwargs):
+        from .bench import call_app, make_environ
+        from .profiler import SamplingProfiler
+        environs = [make_environ(route) for route in routes or ['/']]
+        # Warm up, so that first request costs aren't profiled.
+        for environ in environs:
+            call_app(self.app, environ)
+
+        profiler = SamplingProfiler(interval)
+        profiler.start()
+        try:
+            for index in range(requests):
+                call_app(self.app, environs[index % len(environs)])
+        finally:
+            profiler.stop()
+
+        total = sum(profiler.samples.values())
+        print(" * {} samples from {} requests".format(total, requests))
+        for function, samples in profiler.top(top):
+            print("{:>6.1f}% {}".format(samples * 100.0 / (total or 1),
+                                        function))
+        if output:
+            profiler.write(output)
+            print(" * Collapsed stacks written to {}".format(output))
+
 class Run(BaseCommand):
     "Run the Flask Builtin Server (Not for production)"
 
@@ -93,10 +428,48 @@ class Run(BaseCommand):
         self.app.run(debug=debug, host=hostname, port=port, threaded=threaded)
 
 class Test(BaseCommand):
-    def run(self, **kwargs):
-        import unittest
-        suite = unittest.TestLoader().loadTestsFromModule(self.tests_module)
-        unittest.TextTestRunner(verbosity=2).run(suite)
+    """
+    Run the tests of the tests_module given to MainManager, or tests
+    discovered in directories or packages, optionally sharded across
+    worker processes. See flask_boilerplate_utils.testing.
+    """
+
+    tests_module = None
+    app_factory = None
+
+    option_list = (
+        Option('--discover', '-d', dest='start_dirs', action='append',
+               default=None,
+               help='A directory or package to discover tests in. Can be '
+                    'given more than once.'),
+        Option('--pattern', dest='pattern', default='test*.py', type=str),
+        Option('--workers', '-j', dest='workers', default=1, type=int,
+               help='Shard the tests across this many processes.'),
+        Option('--failfast', '-f', dest='failfast', default=False,
+               action='store_true'),
+        Option('--slowest', dest='slowest', default=10, type=int,
+               help='Report the slowest N tests.'),
+        Option('--timings-file', dest='timings_path', default=None,
+               type=str,
+               help='Where test durations are cached, to balance shards. '
+                    'Defaults to TEST_TIMINGS_FILE, or not caching them.'),
+    ) + BaseCommand.option_list
+
+    def run(self, start_dirs, pattern, workers, failfast, slowest,
+            timings_path, **kwargs):
+        from .testing import TestRun, load_tests, report
+        module = self.tests_module
+        if module is None and not start_dirs:
+            start_dirs = ['.']
+        suite = load_tests(module if not start_dirs else None, start_dirs,
+                           pattern)
+        if timings_path is None:
+            timings_path = self.app.config.get('TEST_TIMINGS_FILE')
+        test_run = TestRun(suite, workers=workers, failfast=failfast,
+                           timings_path=timings_path,
+                           app_factory=self.app_factory)
+        passed = report(test_run.run(), test_run.elapsed, slowest)
+        return 0 if passed else 1
 
 class Cleanup(BaseCommand):
     """
@@ -158,21 +531,63 @@ class Cleanup(BaseCommand):
 class Host(BaseCommand):
     """
     Run a Web Server for Hosting using meinheld.
+
+    With more than one worker, or --max-requests, the app is served by
+    a pre-fork supervisor. See flask_boilerplate_utils.prefork.
     """
 
     option_list = (
         Option('--hostname', '-h', dest='hostname', default='0.0.0.0', type=str),
         Option('--port', '-p', dest='port', default=8000, type=int),
+        Option('--workers', '-w', dest='workers', default=None, type=int,
+               help='The number of worker processes. Defaults to '
+                    'LISTEN_WORKERS, or 1.'),
+        Option('--backlog', dest='backlog', default=None, type=int,
+               help='The listen backlog. Defaults to LISTEN_BACKLOG, '
+                    'or 2048.'),
+        Option('--max-requests', dest='max_requests', default=None, type=int,
+               help='Restart workers after about this many requests.'),
+        Option('--timeout', '-t', dest='timeout', default=30, type=int,
+               help='Kill workers which are unresponsive for this many '
+                    'seconds.'),
+        Option('--reuse-port', dest='reuse_port', default=False,
+               action='store_true',
+               help='Give each worker its own SO_REUSEPORT socket.'),
     ) + BaseCommand.option_list
-    def run(self, port, hostname, **kwargs):
+    def run(self, port, hostname, workers, backlog, max_requests, timeout,
+            reuse_port, **kwargs):
         if port is None:
             port = self.app.config.setdefault('LISTEN_PORT', 8000)
         if hostname is None:
             hostname = self.app.config.setdefault('LISTEN_HOST', '127.0.0.1')
+        if workers is None:
+            workers = self.app.config.setdefault('LISTEN_WORKERS', 1)
+        if backlog is None:
+            backlog = self.app.config.setdefault('LISTEN_BACKLOG', 2048)
+        if max_requests is None:
+            max_requests = self.app.config.setdefault('LISTEN_MAX_REQUESTS', 0)
 
         from meinheld import server, patch
+        from .template_cache import preload_templates
+        # Templates are loaded before forking so the workers share them.
+        if self.app.config.get('TEMPLATE_PRELOAD'):
+            print(" - Preloaded %d templates" % preload_templates(self.app))
+
+        if workers > 1 or max_requests or reuse_port:
+            from .prefork import PreforkServer
+            print(" - Running Hosting Server using Meinheld with %d workers"
+                  % workers)
+            print(" - http://%s:%s/" % (hostname, port))
+            prefork = PreforkServer(
+                self.app, (hostname, port), workers=workers,
+                backlog=backlog, max_requests=max_requests, timeout=timeout,
+                reuse_port=reuse_port, on_fork=patch.patch_all)
+            prefork.run()
+            return 1 if prefork.gave_up else None
+
         patch.patch_all()
         print(" - Running Hosting Server using Meinheld")
         print(" - http://%s:%s/" % (hostname, port))
+        server.set_backlog(backlog)
         server.listen((hostname, port))
         server.run(self.app)
@@ -1,43 +1,110 @@
-from datetime import datetime
+import time
+from datetime import datetime, timezone
+
+from flask import current_app, has_request_context, request
 
 try:
     from urllib.parse import quote
 except ImportError:
     from urllib import quote
 
-def timesince(dt, default="Just now."):
+# Periods measured in whole days, then in seconds of the remaining day.
+_DAY_PERIODS = (
+    (365, "year", "years"),
+    (30, "month", "months"),
+    (7, "week", "weeks"),
+    (1, "day", "days"),
+)
+_SECOND_PERIODS = (
+    (3600, "hour", "hours"),
+    (60, "minute", "minutes"),
+    (1, "second", "seconds"),
+)
+# Formatted phrases by (count, unit), shared by every row they apply to.
+_phrases = {}
+
+
+def request_now():
+    """
+    Returns a tuple of (naive local time, aware UTC time) for the current
+    request. The time is read once per request so every value formatted
+    during it is compared against the same "now".
+    """
+    if has_request_context():
+        now = getattr(request, '_boilerplate_now', None)
+        if now is None:
+            now = request._boilerplate_now = _now()
+        return now
+    return _now()
+
+
+def _now():
+    timestamp = time.time()
+    return (datetime.fromtimestamp(timestamp),
+            datetime.fromtimestamp(timestamp, timezone.utc))
+
+
+def _phrase(count, singular, plural):
+    key = (count, singular)
+    phrase = _phrases.get(key)
+    if phrase is None:
+        phrase = _phrases[key] = "%d %s ago" % (
+            count, singular if count == 1 else plural)
+    return phrase
+
+
+def timesince(dt, default="Just now.", now=None):
     """
     Returns a string representing "time since" e.g.
     3 days ago, 5 hours ago etc.
+
+    :param dt: A naive datetime in local time, or an aware datetime.
+    :param default: Returned for times less than a second ago, or in
+                    the future.
+    :param now: The (naive, aware) tuple to compare against. Defaults to
+                the time of the current request.
     """
-    now = datetime.now()
-    diff = now - dt
-    
-    periods = (
-        (diff.days / 365, "year", "years"),
-        (diff.days / 30, "month", "months"),
-        (diff.days / 7, "week", "weeks"),
-        (diff.days, "day", "days"),
-        (diff.seconds / 3600, "hour", "hours"),
-        (diff.seconds / 60, "minute", "minutes"),
-        (diff.seconds, "second", "seconds"),
-    )
-
-    for period, singular, plural in periods:
-        period = round(period)
-        if period >= 1:
-            return "%d %s ago" % (period, singular if period == 1 else plural)
+    local_now, utc_now = now or request_now()
+    diff = (utc_now if dt.tzinfo is not None else local_now) - dt
+    days = diff.days
+    if days < 0:
+        return default
+
+    if days:
+        for length, singular, plural in _DAY_PERIODS:
+            if days >= length:
+                return _phrase(days // length, singular, plural)
+
+    seconds = diff.seconds
+    for length, singular, plural in _SECOND_PERIODS:
+        if seconds >= length:
+            return _phrase(seconds // length, singular, plural)
 
     return default
 
+def timesince_batch(dts, default="Just now."):
+    """
+    Returns a list of "time since" strings for a list or column of
+    datetimes, all compared against the same "now". None values are
+    formatted as an empty string.
+    """
+    now = request_now()
+    return [timesince(dt, default, now) if dt is not None else ''
+            for dt in dts]
+
 def local_date(datestamp):
     """
     Returns a babel formatted local date
     """
-    from flask.ext.babel import format_date
-
     if datestamp:
-        return format_date(datestamp)
+        return get_date_formatter().format_date(datestamp)
+
+def local_date_batch(datestamps):
+    """
+    Returns a list of babel formatted local dates for a list or column of
+    dates. None values are formatted as an empty string.
+    """
+    return get_date_formatter().format_dates(datestamps)
 
 def percent_escape(string):
     """
@@ -50,8 +117,150 @@ def local_date_time(datestamp):
     """
     Returns a babel formatted local date and time
     """
-    from flask.ext.babel import format_datetime
-
     if datestamp:
-        return format_datetime(datestamp)
+        return get_date_formatter().format_datetime(datestamp)
+
+def local_date_time_batch(datestamps):
+    """
+    Returns a list of babel formatted local dates and times for a list or
+    column of datetimes. None values are formatted as an empty string.
+    """
+    return get_date_formatter().format_datetimes(datestamps)
+
+
+_NAMED_FORMATS = ('short', 'medium', 'full', 'long')
+
+
+class DateFormatter(object):
+    """
+    Formats dates and datetimes like flask_babel's format_date and
+    format_datetime, with the locale, timezone and compiled Babel patterns
+    resolved once instead of for every value.
+
+    :param locale: A babel Locale.
+    :param tzinfo: The timezone datetimes are converted to.
+    :param date_formats: The Babel extension's date_formats.
+    """
+
+    def __init__(self, locale, tzinfo, date_formats):
+        from babel.dates import get_date_format, parse_pattern
+        self.locale = locale
+        self.tzinfo = tzinfo
+
+        date_format = _get_format(date_formats, 'date')
+        if date_format in _NAMED_FORMATS:
+            date_format = get_date_format(date_format, locale=locale)
+        self.date_pattern = parse_pattern(date_format)
+
+        datetime_format = _get_format(date_formats, 'datetime')
+        if datetime_format in _NAMED_FORMATS:
+            datetime_format = _datetime_pattern(datetime_format, locale)
+        self.datetime_pattern = parse_pattern(datetime_format)
+
+    def to_local(self, value):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        value = value.astimezone(self.tzinfo)
+        if hasattr(self.tzinfo, 'normalize'):
+            # pytz
+            value = self.tzinfo.normalize(value)
+        return value
+
+    def format_date(self, value):
+        if isinstance(value, datetime):
+            value = self.to_local(value).date()
+        return self.date_pattern.apply(value, self.locale)
+
+    def format_datetime(self, value):
+        return self.datetime_pattern.apply(self.to_local(value), self.locale)
+
+    def format_dates(self, values):
+        """
+        Format a list or column of dates. None values are formatted as
+        an empty string.
+        """
+        return [self.format_date(value) if value is not None else ''
+                for value in values]
+
+    def format_datetimes(self, values):
+        """
+        Format a list or column of datetimes. None values are formatted as
+        an empty string.
+        """
+        return [self.format_datetime(value) if value is not None else ''
+                for value in values]
+
+
+def get_date_formatter():
+    """
+    Returns the DateFormatter for the current request's locale and
+    timezone, creating it on first use in the request.
+    """
+    from flask_babel import get_locale, get_timezone
+    locale = get_locale()
+    tzinfo = get_timezone()
+    formatter = None
+    if has_request_context():
+        formatter = getattr(request, '_boilerplate_date_formatter', None)
+    # The locale or timezone change if flask_babel.refresh() is called.
+    if (formatter is None or formatter.locale is not locale or
+            formatter.tzinfo is not tzinfo):
+        formatter = DateFormatter(locale, tzinfo, _babel_date_formats())
+        if has_request_context():
+            request._boilerplate_date_formatter = formatter
+    return formatter
+
+
+def _babel_date_formats():
+    babel = current_app.extensions['babel']
+    date_formats = getattr(babel, 'date_formats', None)
+    if date_formats is None:
+        # flask-babel 3 and later register a BabelConfiguration, whose
+        # Babel instance holds the formats.
+        date_formats = babel.instance.date_formats
+    return date_formats
+
+
+def _get_format(date_formats, key):
+    # Resolves the configured format as flask_babel does.
+    format = date_formats[key]
+    if format in _NAMED_FORMATS:
+        custom = date_formats['%s.%s' % (key, format)]
+        if custom is not None:
+            format = custom
+    return format
+
+
+def _datetime_pattern(format, locale):
+    """
+    Combine a locale's named date and time patterns into one datetime
+    pattern, as babel.dates.format_datetime does when formatting.
+    """
+    from babel.dates import get_date_format, get_datetime_format, \
+        get_time_format
+    time_pattern = get_time_format(format, locale=locale).pattern
+    date_pattern = get_date_format(format, locale=locale).pattern
+    parts = []
+    # format_datetime strips the quotes from the combining format and
+    # uses what remains literally, so each literal part is quoted here.
+    for literal, field in _split_fields(
+            get_datetime_format(format, locale=locale).replace("'", "")):
+        if literal:
+            parts.append("'%s'" % literal)
+        if field == '0':
+            parts.append(time_pattern)
+        elif field == '1':
+            parts.append(date_pattern)
+    return ''.join(parts)
+
 
+def _split_fields(format):
+    # Yields (literal, field) pairs for a format such as '{1}, {0}'.
+    while format:
+        start = format.find('{')
+        if start == -1:
+            yield format, None
+            return
+        end = format.index('}', start)
+        yield format[:start], format[start + 1:end]
+        format = format[end + 1:]
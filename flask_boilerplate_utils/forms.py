@@ -1,7 +1,10 @@
 from wtforms.validators import Optional, ValidationError, StopValidation
 from wtforms import DateTimeField
+from werkzeug.datastructures import MultiDict
 import os
+import re
 import datetime
+from collections import namedtuple
 
 
 # TODO: RenderErrorsForOtherField validator.
@@ -51,6 +54,93 @@ class ValidFileFormat(Optional):
         if not self.fileupload.extension_allowed(extension[1:].lower()):
             raise ValidationError(self.message)
 
+class FileSize(object):
+    """
+    Limits the size of an uploaded file. With UPLOAD_GUARD_ENABLED the
+    size counted while the file was streamed is used, otherwise the file
+    is measured without reading it. Ignores validation if a file is not
+    provided.
+
+    :throws ValidationError: ValidationError if the file is too large.
+
+    :param max_size: The largest size allowed, in bytes.
+    :param message: message to display upon validation error.
+    """
+
+    def __init__(self, max_size, message=None):
+        self.max_size = max_size
+        self.message = message or \
+            'The selected file is too large. Files must be under %s.' % (
+                _format_size(max_size))
+
+    def __call__(self, form, field):
+        from .uploads import get_upload_info
+        if not _has_file(field):
+            return
+        if get_upload_info(field.data)[0] > self.max_size:
+            raise ValidationError(self.message)
+
+class FileContent(object):
+    """
+    Checks an uploaded file's type from its content, by its magic number,
+    rather than trusting its filename or the browser. Only the start of
+    the file is read. Ignores validation if a file is not provided.
+
+    :throws ValidationError: ValidationError if the file is not one of the
+                             allowed types.
+
+    :param types: A list of allowed mimetypes, which may use wildcards,
+                  ie ['image/png', 'image/jpeg'] or ['image/*'].
+    :param message: message to display upon validation error.
+    """
+
+    def __init__(self, types, message=None):
+        self.types = types
+        self.message = message or \
+            'The selected file is not a valid %s file.' % (
+                ', '.join(types))
+
+    def __call__(self, form, field):
+        from .uploads import get_upload_info, mimetype_allowed
+        if not _has_file(field):
+            field.mimetype = None
+            return
+        field.mimetype = get_upload_info(field.data)[1]
+        if not mimetype_allowed(field.mimetype, self.types):
+            raise ValidationError(self.message)
+
+class FileDigest(object):
+    """
+    Stores the hex digest of an uploaded file on the field as
+    field.digest, e.g. to find duplicate uploads. The digest made while
+    the file was streamed is used if UPLOAD_HASH is the same algorithm.
+    field.digest is None if a file is not provided.
+
+    :param hash: The name of a hashlib algorithm.
+    """
+
+    def __init__(self, hash='sha256'):
+        self.hash = hash
+
+    def __call__(self, form, field):
+        from .uploads import get_upload_info
+        if not _has_file(field):
+            field.digest = None
+            return
+        field.digest = get_upload_info(field.data, self.hash)[2]
+
+def _has_file(field):
+    # Nothing to check when no file was chosen; DataRequired or
+    # FileRequired decide whether one must be.
+    return bool(getattr(field.data, 'filename', None))
+
+def _format_size(size):
+    for unit in ('bytes', 'KB', 'MB'):
+        if size < 1024:
+            return '%g %s' % (size, unit)
+        size /= 1024.0
+    return '%g GB' % size
+
 class StopIfEqualTo(object):
     """
     A validator for WTForms which will stop validating 
@@ -77,25 +167,255 @@ class Unique(object):
     """
     Database Unique Validator for WTForms / SQLAlchemy.
 
+    Checks with an EXISTS query, or with the results of resolve_unique,
+    resolve_batch or validate_rows when they were run for the form.
+
     :throws ValidationError: ValidationError if the data already 
                              exists in the database for the specified field.
 
     :param model: SQL Alchemy ORM Model to target
     :param field: SQL Alchemy ORM Field to compare
-                  ie, Model.field
+                  ie, Model.field, or a list of fields which must be
+                  unique together, ie [Model.first, Model.last]
+    :param form_fields: For a list of fields, the names of the form fields
+                        holding their values, in the same order. Defaults
+                        to the names of the model fields.
     :param message: message to display upon validation error.
     """
     def __init__(self, model, field, *args, **kwargs):
         self.model = model
         self.field = field
+        self.composite = isinstance(field, (list, tuple))
+        self.form_fields = None
+        if self.composite:
+            self.form_fields = kwargs.get('form_fields') or \
+                [column.key for column in field]
         self.message = 'A record with this information already exists.'
         if 'message' in kwargs:
             self.message = kwargs['message']
 
     def __call__(self, form, field):
-        if self.model.query.filter(self.field == field.data).count() > 0:
+        value = self.get_value(form, field)
+        found, exists = get_batch_result(form, self, field, value)
+        if not found:
+            exists = self.exists(value)
+        if exists:
             raise ValidationError(self.message)
 
+    @property
+    def session(self):
+        return self.model.query.session
+
+    def get_value(self, form, field):
+        """
+        Return the value to check for a field, or a tuple of values for a
+        list of fields.
+        """
+        if self.composite:
+            return tuple(form[name].data for name in self.form_fields)
+        return field.data
+
+    def get_query(self, value):
+        if self.composite:
+            from sqlalchemy import and_
+            return self.model.query.filter(
+                and_(*[column == item
+                       for column, item in zip(self.field, value)]))
+        return self.model.query.filter(self.field == value)
+
+    def exists(self, value):
+        """
+        Whether a record with the value exists.
+        """
+        return self.session.query(self.get_query(value).exists()).scalar()
+
+    def find_existing(self, values, chunk_size=500):
+        """
+        Return the set of values which already exist, checked with one IN
+        query per chunk_size values.
+        """
+        from sqlalchemy import tuple_
+        columns = list(self.field) if self.composite else [self.field]
+        target = tuple_(*columns) if self.composite else self.field
+        existing = set()
+        remaining = []
+        for value in set(values):
+            # NULLs never match IN, so they are checked one by one.
+            if value is None or (self.composite and None in value):
+                if self.exists(value):
+                    existing.add(value)
+            else:
+                remaining.append(value)
+
+        for start in range(0, len(remaining), chunk_size):
+            chunk = remaining[start:start + chunk_size]
+            rows = self.session.query(*columns) \
+                .filter(target.in_(chunk)).distinct()
+            found = set(tuple(row) if self.composite else row[0]
+                        for row in rows)
+            matched = found.intersection(chunk)
+            existing.update(matched)
+            if len(matched) < len(found):
+                # The database matched values which are not equal in
+                # Python, e.g. with a case insensitive collation, so the
+                # unmatched values are checked as the database sees them.
+                for value in chunk:
+                    if value not in matched and self.exists(value):
+                        existing.add(value)
+        return existing
+
+    def resolve_batch(self, values):
+        existing = self.find_existing(values)
+        return dict((value, value in existing) for value in values)
+
+
+def _batch_validators(form, validator_class=None):
+    # The (validator, field) pairs of a form's batch validators, or of its
+    # validators of validator_class.
+    for field in form:
+        for validator in field.validators:
+            if validator_class is not None:
+                wanted = isinstance(validator, validator_class)
+            else:
+                wanted = hasattr(validator, 'resolve_batch')
+            if wanted:
+                yield validator, field
+
+
+def resolve_unique(form):
+    """
+    Resolve every Unique validator of a form with a single query, rather
+    than one query per validator, before the form is validated.
+    """
+    checks = [(validator, field, validator.get_value(form, field))
+              for validator, field in _batch_validators(form, Unique)]
+    if not checks:
+        return
+    results = getattr(form, '_batch_results', {})
+    by_session = {}
+    for check in checks:
+        by_session.setdefault(check[0].session, []).append(check)
+
+    for session, session_checks in by_session.items():
+        row = session.query(*[validator.get_query(value).exists()
+                              for validator, _, value in session_checks]) \
+            .one()
+        for (validator, field, value), exists in zip(session_checks, row):
+            results[(validator, field.name)] = (value, exists)
+    form._batch_results = results
+
+
+def resolve_batch(forms):
+    """
+    Resolve the batch validators of many forms of the same kind, e.g. the
+    rows of a bulk import, with one call per validator for all of their
+    values rather than one check per form and validator.
+
+    A batch validator has a get_value(form, field) method, and a
+    resolve_batch(values) method which returns a dict of each value's
+    result. When the validator is called, it finds its result with
+    get_batch_result.
+    """
+    values = {}
+    checks = []
+    for form in forms:
+        for validator, field in _batch_validators(form):
+            value = validator.get_value(form, field)
+            values.setdefault(validator, set()).add(value)
+            checks.append((form, validator, field, value))
+
+    results = dict((validator, validator.resolve_batch(items))
+                   for validator, items in values.items())
+    for form, validator, field, value in checks:
+        if not hasattr(form, '_batch_results'):
+            form._batch_results = {}
+        form._batch_results[(validator, field.name)] = \
+            (value, results[validator][value])
+
+
+def get_batch_result(form, validator, field, value):
+    """
+    Return a tuple of (True, result) if a batch validator's result for
+    the value was resolved with resolve_batch, otherwise (False, None).
+    """
+    resolved = getattr(form, '_batch_results', {}).get((validator, field.name))
+    if resolved is not None and resolved[0] == value:
+        return True, resolved[1]
+    return False, None
+
+
+class BatchUniqueMixin(object):
+    """
+    A Form mixin which resolves all of the form's Unique validators with
+    a single query when it is validated.
+    """
+
+    def validate(self, *args, **kwargs):
+        resolve_unique(self)
+        return super(BatchUniqueMixin, self).validate(*args, **kwargs)
+
+
+RowResult = namedtuple('RowResult', ['index', 'valid', 'data', 'errors'])
+
+
+def validate_rows(form_class, rows, chunk_size=500, **kwargs):
+    """
+    Validate many rows, e.g. from a CSV or JSON import, against a Form
+    class. Yields a RowResult of (index, valid, data, errors) for each
+    row, in order, as the rows are validated.
+
+    One form instance is reused for every row instead of constructing a
+    form per row, and the batch validators, like Unique, are resolved for
+    chunk_size rows at a time with resolve_batch.
+
+    :param form_class: The Form class to validate the rows with.
+    :param rows: An iterable of dicts (or MultiDicts) of the rows'
+                 form data.
+    :param chunk_size: The number of rows to resolve batch validators for
+                       at once.
+    :param kwargs: Passed to the form_class when it is constructed.
+    """
+    form = form_class(**kwargs)
+    # The fields of the reused form, and so its batch validators, are the
+    # same for every row.
+    plan = list(_batch_validators(form))
+    chunk = []
+    for index, row in enumerate(rows):
+        if not hasattr(row, 'getlist'):
+            row = MultiDict(row)
+        chunk.append((index, row))
+        if len(chunk) >= chunk_size:
+            for result in _validate_chunk(form, plan, chunk):
+                yield result
+            chunk = []
+    for result in _validate_chunk(form, plan, chunk):
+        yield result
+
+
+def _validate_chunk(form, plan, chunk):
+    values = {}
+    if plan:
+        # The rows are processed once to collect the values to resolve in
+        # bulk, and again to validate them.
+        for index, row in chunk:
+            form.process(row)
+            for validator, field in plan:
+                values.setdefault(validator, set()).add(
+                    validator.get_value(form, field))
+    results = dict((validator, validator.resolve_batch(items))
+                   for validator, items in values.items())
+
+    for index, row in chunk:
+        form.process(row)
+        batch_results = {}
+        for validator, field in plan:
+            value = validator.get_value(form, field)
+            batch_results[(validator, field.name)] = \
+                (value, results[validator][value])
+        form._batch_results = batch_results
+        valid = form.validate()
+        yield RowResult(index, valid, form.data, form.errors)
+
 
 class OptionalFileField(Optional):
     """
@@ -145,6 +465,128 @@ def empty_string_none(string):
 
 
 
+# Regular expressions for the strptime directives parse_datetime handles
+# itself, and the datetime argument each sets.
+_DIRECTIVES = {
+    'Y': (r'(?P<year>\d{4})', 'year'),
+    'm': (r'(?P<month>\d{1,2})', 'month'),
+    'd': (r'(?P<day>\d{1,2})', 'day'),
+    'H': (r'(?P<hour>\d{1,2})', 'hour'),
+    'M': (r'(?P<minute>\d{1,2})', 'minute'),
+    'S': (r'(?P<second>\d{1,2})', 'second'),
+    'f': (r'(?P<microsecond>\d{1,6})', 'microsecond'),
+}
+# Compiled formats by format string, or None for formats which need
+# strptime.
+_patterns = {}
+# Formats datetime.fromisoformat parses, by their date and time separator.
+_ISO_FORMATS = {'%Y-%m-%d %H:%M:%S': ' ', '%Y-%m-%dT%H:%M:%S': 'T'}
+# timezone objects by offset in minutes.
+_timezones = {}
+
+
+def _compile_format(format):
+    if format in _patterns:
+        return _patterns[format]
+    parts = []
+    seen = set()
+    index = 0
+    pattern = None
+    while index < len(format):
+        char = format[index]
+        if char != '%':
+            parts.append(re.escape(char))
+            index += 1
+            continue
+        directive = format[index + 1:index + 2]
+        index += 2
+        if directive == '%':
+            parts.append('%')
+        elif directive in _DIRECTIVES and directive not in seen:
+            seen.add(directive)
+            parts.append(_DIRECTIVES[directive][0])
+        else:
+            break
+    else:
+        # A date needs all of its year, month and day.
+        if seen.issuperset('Ymd'):
+            pattern = re.compile(''.join(parts) + r'\Z')
+    _patterns[format] = pattern
+    return pattern
+
+
+def get_timezone(offset):
+    """
+    Return a timezone for an offset from UTC in minutes, shared by every
+    datetime with that offset.
+
+    :param offset: Minutes ahead of UTC, ie the negated value of
+                   javascript's getTimezoneOffset().
+    """
+    tz = _timezones.get(offset)
+    if tz is None:
+        if not -1440 < offset < 1440:
+            raise ValueError('Not a valid timezone offset')
+        tz = _timezones[offset] = datetime.timezone(
+            datetime.timedelta(minutes=offset))
+    return tz
+
+
+def parse_datetime(string, format='%Y-%m-%d %H:%M:%S', tzinfo=None):
+    """
+    Parse a datetime string like datetime.strptime, without strptime's
+    overhead for formats made of %Y, %m, %d, %H, %M, %S and %f. ISO
+    formatted strings are parsed with datetime.fromisoformat.
+
+    :throws ValueError: ValueError if the string does not match the format.
+
+    :param string: The string to parse.
+    :param format: A strptime format.
+    :param tzinfo: The timezone to attach to the datetime.
+    """
+    separator = _ISO_FORMATS.get(format)
+    if (separator is not None and len(string) == 19 and
+            string[10] == separator and string[13] == string[16] == ':'):
+        value = datetime.datetime.fromisoformat(string)
+        return value.replace(tzinfo=tzinfo) if tzinfo is not None else value
+
+    pattern = _compile_format(format)
+    if pattern is None:
+        value = datetime.datetime.strptime(string, format)
+    else:
+        match = pattern.match(string)
+        if match is None:
+            raise ValueError('%r does not match format %r' % (string, format))
+        fields = match.groupdict()
+        microsecond = fields.pop('microsecond', None)
+        value = datetime.datetime(
+            microsecond=int(microsecond.ljust(6, '0')) if microsecond else 0,
+            **dict((name, int(item)) for name, item in fields.items()))
+    if tzinfo is not None:
+        value = value.replace(tzinfo=tzinfo)
+    return value
+
+
+def parse_datetimes(strings, format='%Y-%m-%d %H:%M:%S', offset=None):
+    """
+    Parse a list or column of datetime strings, e.g. from an import.
+    Strings which are empty or don't match the format are returned as None.
+
+    :param format: A strptime format.
+    :param offset: The strings' offset from UTC in minutes, if the
+                   datetimes should be timezone aware.
+    """
+    tzinfo = get_timezone(offset) if offset is not None else None
+    results = []
+    for string in strings:
+        try:
+            results.append(parse_datetime(string, format, tzinfo)
+                           if string else None)
+        except ValueError:
+            results.append(None)
+    return results
+
+
 class TimezoneDateTimeField(DateTimeField):
     """
     A Timezone aware field for WTForms. 
@@ -155,6 +597,9 @@ class TimezoneDateTimeField(DateTimeField):
     This is a offset in minutes from UTC. (-ve means ahead of UTC, 
     +ve means behind UTC)
 
+    The field's data is an aware datetime in that timezone, or a naive
+    datetime without a tzfield.
+
     :param tzfield: The name (as a string) of the variable which containes the 
                     getTimezoneOffset() value.
     """
@@ -166,26 +611,24 @@ class TimezoneDateTimeField(DateTimeField):
 
         super(TimezoneDateTimeField, self).__init__(label, validators, format, **kwargs)
 
+    def get_tzinfo(self):
+        """
+        Return the timezone given by the tzfield, or None without one.
+        """
+        if not self.tzfield:
+            return None
+        try:
+            offset = -int(getattr(self._form, self.tzfield).data)
+        except (TypeError, ValueError):
+            raise ValueError(self.gettext('Not a valid timezone offset'))
+        return get_timezone(offset)
+
     def process_formdata(self, valuelist):
-        print("PROCESSING FORM DATA")
-        
         if valuelist:
-            format = self.format
-            date_str = ' '.join(valuelist)
-
-            if self.tzfield:
-                format = self.format + ' %z'
-                tzoffset = int(getattr(self._form, self.tzfield).data) * -1
-                tz = "{0:+02d}{1:02d}".format(int(tzoffset/60), tzoffset % 60)
-                date_str = date_str + ' {}'.format(tz)
-
-                print(format)
-                print(date_str)
-
+            self.data = None
+            tzinfo = self.get_tzinfo()
             try:
-                self.data = datetime.datetime.strptime(date_str, format)
+                self.data = parse_datetime(' '.join(valuelist), self.format,
+                                           tzinfo)
             except ValueError:
-                self.data = None
                 raise ValueError(self.gettext('Not a valid datetime value'))
-
-
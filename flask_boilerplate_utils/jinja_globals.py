@@ -1,9 +1,133 @@
-from flask import render_template_string, Markup
+from flask import Markup, current_app, escape, request, url_for
+from flask_wtf.csrf import generate_csrf
 
+import wtforms.widgets.core as wt_core
 from wtforms_webwidgets.bootstrap import default_widgets
 from wtforms_webwidgets import FieldRenderer
 
-renderer = FieldRenderer(default_widgets)
+# Placeholders rendered in place of a field's value and errors when it
+# is compiled.
+_VALUE = u'\x00value\x00'
+_ERRORS = u'\x00errors\x00'
+
+
+class CompiledField(object):
+    """
+    The markup of a field with the places its value and errors go in.
+    """
+
+    def __init__(self, html, escape_value=escape):
+        self.parts = [part.split(_ERRORS) for part in html.split(_VALUE)]
+        self.escape_value = escape_value
+
+    def render(self, field):
+        value = self.escape_value(field._value())
+        # The errors are inserted as they are, as wtforms_webwidgets does.
+        errors = u'. '.join(field.errors)
+        html = []
+        for i, part in enumerate(self.parts):
+            if i:
+                html.append(value)
+            html.append(errors.join(part))
+        return Markup(u''.join(html))
+
+
+class CompiledFieldRenderer(FieldRenderer):
+    """
+    A FieldRenderer which renders each distinct field once, with
+    placeholders for its value and errors, and from then on only fills
+    those in.
+
+    Only fields whose markup depends on nothing but their value and
+    errors are compiled, i.e. text-like inputs, hidden inputs (including
+    the CSRF token) and textareas. Other fields, and fields with a custom
+    meta.render_field, are rendered as usual.
+
+    :param lookup_dict: The default widget for each field type.
+    :param max_entries: The cache is cleared when it grows past this
+                        many compiled fields.
+    """
+    compiled_widgets = (wt_core.Input, wt_core.TextArea)
+    dynamic_widgets = (wt_core.CheckboxInput, wt_core.RadioInput)
+
+    def __init__(self, lookup_dict, max_entries=10000):
+        super(CompiledFieldRenderer, self).__init__(lookup_dict)
+        self.max_entries = max_entries
+        self._compiled = {}
+
+    def __call__(self, field, **kwargs):
+        if not hasattr(field.widget, '__webwidget__'):
+            if field.type in self._lookup:
+                field.widget = self._lookup[field.type]
+
+        key = self.get_key(field, kwargs)
+        if key is None:
+            return field(**kwargs)
+        compiled = self._compiled.get(key)
+        if compiled is None:
+            compiled = self.compile(field, kwargs)
+            if len(self._compiled) >= self.max_entries:
+                self._compiled.clear()
+            self._compiled[key] = compiled
+        return compiled.render(field)
+
+    def get_key(self, field, kwargs):
+        """
+        Return the cache key for rendering a field with kwargs, or None if
+        the field cannot be compiled. The key holds everything besides
+        the value and errors that the markup depends on.
+        """
+        widget = field.widget
+        if (not isinstance(widget, self.compiled_widgets) or
+                isinstance(widget, self.dynamic_widgets)):
+            return None
+        meta = getattr(field, 'meta', None)
+        if meta is not None and getattr(type(meta), 'render_field', None) \
+                is not _default_render_field:
+            return None
+
+        render_kw = getattr(field, 'render_kw', None) or {}
+        # Widgets render attributes such as required, maxlength, min and
+        # readonly from the flags set by the field's validators.
+        flags = tuple(sorted(vars(field.flags).items()))
+        key = (type(field), widget, field.name, field.id, field.label.text,
+               field.description, flags, tuple(sorted(render_kw.items())),
+               tuple(sorted(kwargs.items())), bool(field.errors))
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def compile(self, field, kwargs):
+        # Fields can't be copied with copy.copy, as Field.__new__ returns
+        # an UnboundField.
+        placeholder = object.__new__(type(field))
+        placeholder.__dict__.update(field.__dict__)
+        placeholder._value = lambda: _VALUE
+        placeholder.errors = [_ERRORS] if field.errors else []
+        if isinstance(field.widget, wt_core.TextArea):
+            escape_value = _escape_text
+        else:
+            escape_value = _escape_attribute
+        return CompiledField(placeholder(**kwargs), escape_value)
+
+
+def _escape_attribute(value):
+    # Escaped by html_params, as the widgets escape their attributes.
+    return Markup(wt_core.html_params(value=value)[len('value="'):-1])
+
+
+_escape_text = getattr(wt_core, 'escape', escape)
+
+
+try:
+    from wtforms.meta import DefaultMeta
+    _default_render_field = DefaultMeta.render_field
+except ImportError:
+    _default_render_field = None
+
+renderer = CompiledFieldRenderer(default_widgets)
 
 def render_field(field, **kwargs):
     """
@@ -15,14 +139,9 @@ def render_field(field, **kwargs):
     return renderer(field, **kwargs)
 
 
-def csrf_setup(**kwargs):
-    """
-    Return the CSRF setup global for injection into jinja templates.
-    """
-    template = """
-    {% if config.CSRF_ENABLED %}
+CSRF_SCRIPT = """
     <script>
-    var csrftoken = "{{ csrf_token() }}"
+    var csrftoken = "%s"
 
     $.ajaxSetup({
         beforeSend: function(xhr, settings) {
@@ -32,6 +151,54 @@ def csrf_setup(**kwargs):
         }
     });
     </script>
-    {% endif %}
     """
-    return Markup(render_template_string(template, **kwargs))
\ No newline at end of file
+
+
+class CsrfSetup(object):
+    """
+    The CSRF setup global. Everything but the token is built once, when
+    the app is set up, so rendering it only interpolates the token.
+
+    :param app: The Flask app.
+    :param mode: 'inline' emits the setup script with the token inline.
+                 'meta' emits the token in a <meta name="csrf-token"> tag
+                 and loads the setup script from the boilerplate's static
+                 csrf.js, which browsers can cache.
+    """
+
+    def __init__(self, app, mode='inline'):
+        if mode not in ('inline', 'meta'):
+            raise ValueError("CSRF setup mode must be 'inline' or 'meta'")
+        self.enabled = app.config.get('CSRF_ENABLED')
+        self.mode = mode
+        self.prefix, self.suffix = map(Markup, CSRF_SCRIPT.split('%s'))
+        self._script_tags = {}
+
+    def script_tag(self):
+        # The URL depends on the script root, e.g. behind a reverse proxy.
+        script_root = request.script_root
+        tag = self._script_tags.get(script_root)
+        if tag is None:
+            tag = self._script_tags[script_root] = \
+                '<script src="%s"></script>' % escape(
+                    url_for('boilerplate.static', filename='csrf.js'))
+        return tag
+
+    def __call__(self, **kwargs):
+        if not self.enabled:
+            return Markup('')
+        token = escape(generate_csrf())
+        if self.mode == 'meta':
+            return Markup('<meta name="csrf-token" content="%s">%s' % (
+                token, self.script_tag()))
+        return self.prefix + token + self.suffix
+
+
+def csrf_setup(**kwargs):
+    """
+    Return the CSRF setup global for injection into jinja templates.
+    """
+    setup = current_app.jinja_env.globals.get('csrf_setup')
+    if not isinstance(setup, CsrfSetup):
+        setup = CsrfSetup(current_app)
+    return setup(**kwargs)
@@ -1,6 +1,71 @@
-from flask import Blueprint, request
+from flask import Blueprint, request, current_app
 from flask import render_template as _render_template
 
+
+class TemplateResolver(object):
+    """
+    Resolves blueprint relative template names ('.index.html') to the
+    template to render, remembering the result for each blueprint and
+    name so that later renders skip the name rewriting and loader search.
+
+    A nested blueprint (see NestableBlueprint) falls back to its parents'
+    templates: '.index.html' rendered from blueprint 'child' of 'parent'
+    loads 'child/index.html' if it exists, otherwise 'parent/index.html'.
+
+    When templates are auto reloaded (e.g. in debug mode), a remembered
+    template is resolved again once its source changes.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self._resolved = {}
+
+    def candidates(self, blueprint, name):
+        """
+        Return the template names to try, in order, for a blueprint
+        relative name.
+        """
+        names = []
+        while blueprint is not None:
+            names.append(blueprint + "/" + name)
+            parent = getattr(self.app.blueprints.get(blueprint), 'parent', None)
+            blueprint = parent.name if parent is not None else None
+        return names
+
+    def resolve(self, blueprint, name):
+        """
+        Return the Template for a blueprint relative name, without the
+        leading '.'.
+        """
+        key = (blueprint, name)
+        template = self._resolved.get(key)
+        if template is not None:
+            if not self.app.jinja_env.auto_reload or template.is_up_to_date:
+                return template
+
+        env = self.app.jinja_env
+        if blueprint:
+            template = env.select_template(self.candidates(blueprint, name))
+        else:
+            # No blueprint found. Assuming this was a mistake.
+            template = env.get_template(name)
+        self._resolved[key] = template
+        return template
+
+    def clear(self):
+        self._resolved.clear()
+
+
+def get_template_resolver(app):
+    """
+    Return the app's TemplateResolver, creating it on first use.
+    """
+    resolver = getattr(app, 'template_resolver', None)
+    if resolver is None:
+        resolver = app.template_resolver = TemplateResolver(app)
+    return resolver
+
+
 def render_template(filename, *args, **kwargs):
     """Blueprint Patched render_template. 
 
@@ -14,15 +79,13 @@ def render_template(filename, *args, **kwargs):
 
         .index.html will be converted into: <current_blueprint>/index.html
 
+    Nested blueprints fall back to their parents' templates, see
+    TemplateResolver.
     """
 
-    if filename.startswith('.'):
-            if request.blueprint:
-                # Filename started with ., expecting a blueprint relative path.
-                filename = request.blueprint + "/" + filename[1:]
-            else:
-                # No blueprint found. Assuming this was a mistake.
-                filename = filename[1:]
+    if isinstance(filename, str) and filename.startswith('.'):
+        filename = get_template_resolver(current_app).resolve(
+            request.blueprint, filename[1:])
 
     return _render_template(filename, *args, **kwargs)
 
@@ -44,6 +107,9 @@ class NestableBlueprint(Blueprint):
     """
 
     def register_blueprint(self, blueprint, **options):
+        # Lets the nested blueprint fall back to this one's templates.
+        blueprint.parent = self
+
         def deferred(state):
             url_prefix = (state.url_prefix or u"") + (options.get('url_prefix', blueprint.url_prefix) or u"")
             if 'url_prefix' in options:
@@ -0,0 +1,390 @@
+"""
+A pre-fork supervisor for serving the app with meinheld on every core.
+
+The app is loaded once in the master process, which then forks the
+workers, so that they share its memory copy-on-write. The workers accept
+connections from one listening socket, or with ``reuse_port`` each binds
+its own socket with SO_REUSEPORT and the kernel balances between them.
+
+The master keeps the number of workers up, replacing workers which exit,
+for example after ``max_requests``, and killing workers which stop
+responding, or don't start serving, for ``timeout`` seconds. Workers
+which fail to boot are replaced after a growing delay, and the master
+gives up after ``max_boot_failures`` failures in a row. Signals to the
+master:
+
+* ``SIGHUP`` replaces the workers without dropping connections. New
+  workers are started first, and the old ones are stopped gracefully
+  once the new ones are serving.
+* ``SIGTTIN`` and ``SIGTTOU`` add and remove a worker.
+* ``SIGTERM`` stops gracefully, ``SIGINT`` and ``SIGQUIT`` immediately.
+
+Workers share the code loaded by the master, so code changes need a new
+master. With ``reuse_port`` the new master can be started next to the
+old one, which is then stopped with ``SIGTERM``.
+"""
+import errno
+import gc
+import os
+import random
+import select
+import signal
+import socket
+import tempfile
+import time
+
+SIGNALS = (signal.SIGHUP, signal.SIGTERM, signal.SIGINT, signal.SIGQUIT,
+           signal.SIGCHLD, signal.SIGTTIN, signal.SIGTTOU)
+
+#: The exit status of a worker which stopped after max_requests.
+RECYCLED_STATUS = 10
+
+
+class Worker(object):
+    """
+    A worker process, as seen by the master.
+
+    :attr heartbeat: A temporary file whose ctime the worker updates
+                     while its event loop runs.
+    """
+
+    def __init__(self, generation):
+        self.generation = generation
+        self.pid = None
+        self.started = time.time()
+        self.heartbeat = tempfile.TemporaryFile()
+        self.stopping = None
+
+    def last_seen(self):
+        return os.fstat(self.heartbeat.fileno()).st_ctime
+
+    @property
+    def booted(self):
+        # Workers touch their heartbeat for the first time once they are
+        # serving.
+        return self.last_seen() > os.fstat(
+            self.heartbeat.fileno()).st_mtime
+
+    def signal(self, signum):
+        try:
+            os.kill(self.pid, signum)
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                raise
+
+
+class PreforkServer(object):
+    """
+    Serves a WSGI app with a pool of forked meinheld workers.
+
+    :param app: The WSGI app, loaded before the workers are forked.
+    :param address: A (host, port) tuple to listen on.
+    :param workers: The number of worker processes.
+    :param backlog: The listen backlog, ie the number of connections
+                    waiting to be accepted.
+    :param max_requests: Restart a worker after it has served about this
+                         many requests, or 0 to never restart them.
+    :param timeout: Kill a worker which has not responded for this many
+                    seconds. Idle workers respond every 10 seconds.
+    :param graceful_timeout: How long stopping workers are given to
+                             finish their requests.
+    :param reuse_port: Bind a socket per worker with SO_REUSEPORT instead
+                       of sharing one.
+    :param on_fork: Called in each worker after it is forked.
+    :param max_boot_failures: Stop once this many workers in a row have
+                              exited or timed out before serving.
+    """
+
+    #: The longest delay before replacing a worker which failed to boot.
+    max_boot_delay = 30
+
+    def __init__(self, app, address, workers=2, backlog=2048,
+                 max_requests=0, timeout=30, graceful_timeout=30,
+                 reuse_port=False, on_fork=None, max_boot_failures=5):
+        self.app = app
+        self.address = address
+        self.worker_count = workers
+        self.backlog = backlog
+        self.max_requests = max_requests
+        self.timeout = timeout
+        self.graceful_timeout = graceful_timeout
+        self.reuse_port = reuse_port
+        self.on_fork = on_fork
+        self.max_boot_failures = max_boot_failures
+        self.boot_failures = 0
+        self.spawn_after = 0
+        self.gave_up = False
+        self.socket = None
+        self.workers = {}
+        self.generation = 0
+        self.stopping = False
+        self._signals = []
+        self._pipe = None
+
+    def create_socket(self):
+        sock = socket.socket(socket.AF_INET6 if ':' in self.address[0]
+                             else socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(self.address)
+        sock.listen(self.backlog)
+        return sock
+
+    def run(self):
+        """
+        Start the workers and supervise them until the server is stopped.
+        """
+        if not self.reuse_port:
+            self.socket = self.create_socket()
+        self._pipe = os.pipe()
+        for fd in self._pipe:
+            _set_non_blocking(fd)
+        for signum in SIGNALS:
+            signal.signal(signum, self._queue_signal)
+
+        if hasattr(gc, 'freeze'):
+            # Objects loaded so far are never collected, so the collector
+            # doesn't touch, and so copy, the pages the workers share.
+            gc.collect()
+            gc.freeze()
+
+        print(" - Master %d starting %d workers" % (
+            os.getpid(), self.worker_count))
+        self.generation = 1
+        self.maintain_workers()
+        try:
+            while self.workers or not self.stopping:
+                self.handle_signals()
+                self.reap_workers()
+                if not self.stopping:
+                    self.check_workers()
+                    self.maintain_workers()
+                self.kill_stuck_workers()
+                self.sleep()
+        finally:
+            for worker in self.workers.values():
+                worker.signal(signal.SIGKILL)
+            self.reap_workers()
+            if self.socket is not None:
+                self.socket.close()
+        print(" - Master %d stopped" % os.getpid())
+
+    def _queue_signal(self, signum, frame):
+        # SIGCHLD only needs to wake the master up.
+        if signum != signal.SIGCHLD and len(self._signals) < 5:
+            self._signals.append(signum)
+        try:
+            os.write(self._pipe[1], b'.')
+        except OSError:
+            pass
+
+    def sleep(self):
+        try:
+            if select.select([self._pipe[0]], [], [], 1.0)[0]:
+                while os.read(self._pipe[0], 64):
+                    pass
+        except (OSError, select.error) as e:
+            if e.args[0] not in (errno.EAGAIN, errno.EINTR):
+                raise
+
+    def handle_signals(self):
+        while self._signals:
+            signum = self._signals.pop(0)
+            if signum == signal.SIGHUP:
+                self.reload()
+            elif signum == signal.SIGTERM:
+                self.stop(graceful=True)
+            elif signum in (signal.SIGINT, signal.SIGQUIT):
+                self.stop(graceful=False)
+            elif signum == signal.SIGTTIN:
+                self.worker_count += 1
+            elif signum == signal.SIGTTOU and self.worker_count > 1:
+                self.worker_count -= 1
+
+    def reload(self):
+        """
+        Replace every worker with a new one. The old workers keep serving
+        until the new ones are ready.
+        """
+        print(" - Reloading workers")
+        self.generation += 1
+
+    def stop(self, graceful=True):
+        self.stopping = True
+        for worker in self.workers.values():
+            self.stop_worker(worker, graceful)
+
+    def stop_worker(self, worker, graceful=True):
+        if graceful:
+            # meinheld stops accepting on SIGTERM and exits once its open
+            # requests are done.
+            if worker.stopping is None:
+                worker.stopping = time.time()
+                worker.signal(signal.SIGTERM)
+        else:
+            worker.signal(signal.SIGKILL)
+
+    def current_workers(self):
+        return [worker for worker in self.workers.values()
+                if worker.generation == self.generation and
+                worker.stopping is None]
+
+    def maintain_workers(self):
+        current = self.current_workers()
+        if any(worker.booted for worker in current):
+            self.boot_failures = 0
+        if time.time() >= self.spawn_after:
+            for _ in range(self.worker_count - len(current)):
+                self.spawn_worker()
+        for worker in sorted(current, key=lambda w: w.started)[
+                self.worker_count:]:
+            self.stop_worker(worker)
+
+    def check_workers(self):
+        """
+        Stop the previous generation's workers once every current worker
+        is serving.
+        """
+        old = [worker for worker in self.workers.values()
+               if worker.generation != self.generation]
+        if old and all(worker.booted for worker in self.current_workers()):
+            for worker in old:
+                self.stop_worker(worker)
+
+    def kill_stuck_workers(self):
+        now = time.time()
+        for worker in list(self.workers.values()):
+            if worker.stopping is not None:
+                if now - worker.stopping > self.graceful_timeout:
+                    print(" ! Worker %d did not stop, killing it" %
+                          worker.pid)
+                    worker.signal(signal.SIGKILL)
+            elif worker.booted:
+                if now - worker.last_seen() > self.timeout:
+                    print(" ! Worker %d timed out, killing it" % worker.pid)
+                    worker.signal(signal.SIGKILL)
+            elif now - worker.started > self.timeout:
+                print(" ! Worker %d did not boot in time, killing it" %
+                      worker.pid)
+                worker.signal(signal.SIGKILL)
+
+    def reap_workers(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.ECHILD:
+                    return
+                raise
+            if not pid:
+                return
+            worker = self.workers.pop(pid, None)
+            if worker is None:
+                continue
+            booted = worker.booted
+            worker.heartbeat.close()
+            if (os.WIFEXITED(status) and
+                    os.WEXITSTATUS(status) == RECYCLED_STATUS):
+                print(" - Worker %d served its requests, replacing it" %
+                      pid)
+            elif worker.stopping is None and not self.stopping:
+                print(" ! Worker %d exited unexpectedly (status %d)" % (
+                    pid, status))
+                if not booted:
+                    self.boot_failed()
+
+    def boot_failed(self):
+        """
+        Delay replacing a worker which failed to boot, doubling the delay
+        with each failure in a row, and stop after max_boot_failures.
+        """
+        self.boot_failures += 1
+        if self.boot_failures >= self.max_boot_failures:
+            print(" ! %d workers in a row failed to boot, stopping" %
+                  self.boot_failures)
+            self.gave_up = True
+            self.stop(graceful=True)
+            return
+        delay = min(0.5 * 2 ** (self.boot_failures - 1), self.max_boot_delay)
+        print(" ! Worker failed to boot, replacing it in %gs" % delay)
+        self.spawn_after = time.time() + delay
+
+    def spawn_worker(self):
+        worker = Worker(self.generation)
+        pid = os.fork()
+        if pid:
+            worker.pid = pid
+            self.workers[pid] = worker
+            return worker
+
+        # In the worker.
+        worker.pid = os.getpid()
+        status = 0
+        try:
+            status = self.run_worker(worker)
+        except BaseException:
+            import traceback
+            traceback.print_exc()
+            status = 1
+        finally:
+            os._exit(status)
+
+    def run_worker(self, worker):
+        from meinheld import server
+
+        for signum in SIGNALS:
+            signal.signal(signum, signal.SIG_DFL)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        for fd in self._pipe:
+            os.close(fd)
+        for other in self.workers.values():
+            other.heartbeat.close()
+        random.seed()
+
+        sock = self.socket or self.create_socket()
+        if self.on_fork is not None:
+            self.on_fork()
+
+        app = self.app
+        if self.max_requests:
+            # Spread restarts out so the workers don't restart together.
+            app = RequestLimit(app, self.max_requests + random.randint(
+                0, max(self.max_requests // 10, 1)), self.graceful_timeout)
+
+        server.set_listen_socket([sock.fileno()])
+        # Touch the heartbeat every second the event loop runs, and stop
+        # if the master goes away.
+        server.set_fastwatchdog(worker.heartbeat.fileno(), os.getppid(),
+                                self.graceful_timeout)
+        server.run(app)
+        if getattr(app, 'remaining', None) == 0:
+            return RECYCLED_STATUS
+        return 0
+
+
+class RequestLimit(object):
+    """
+    WSGI middleware which stops the meinheld worker once it has served
+    a number of requests, so that the master replaces it.
+    """
+
+    def __init__(self, app, max_requests, graceful_timeout):
+        self.app = app
+        self.remaining = max_requests
+        self.graceful_timeout = graceful_timeout
+
+    def __call__(self, environ, start_response):
+        # Stopping exits the worker with RECYCLED_STATUS, so the master
+        # can tell it apart from a crash.
+        self.remaining -= 1
+        if self.remaining == 0:
+            from meinheld import server
+            server.stop(self.graceful_timeout)
+        return self.app(environ, start_response)
+
+
+def _set_non_blocking(fd):
+    import fcntl
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
@@ -0,0 +1,197 @@
+"""
+A low overhead sampling profiler, for finding CPU hot spots in a live
+worker without attaching external tools.
+
+The profiler samples the stack every ``interval`` seconds of CPU time,
+using the SIGPROF interval timer, and writes the samples as collapsed
+stacks, ie one ``frame;frame;frame count`` line per stack, which
+flamegraph.pl, speedscope and similar tools read.
+
+With ``PROFILER_ENABLED``, a worker can be profiled by:
+
+* sending it ``PROFILER_SIGNAL`` (SIGUSR2 by default) to start sampling,
+  and again to stop and write the stacks to a file in
+  ``PROFILER_OUTPUT_DIR``.
+* POSTing to ``PROFILER_ENDPOINT + '/start'`` and then
+  ``PROFILER_ENDPOINT + '/stop'``, which returns the stacks, with an
+  ``Authorization: Bearer <PROFILER_TOKEN>`` header. The endpoint is off
+  unless both are set. Behind a reverse proxy every request comes from
+  the proxy's address, so the token is the only check.
+
+The ``profile`` command profiles requests to a route in-process.
+
+Only CPU time is sampled, so time a worker spends waiting, e.g. for the
+database, does not show up. Signals are handled by the main thread, so
+only its stack is sampled unless ``all_threads`` is set.
+"""
+import hmac
+import os
+import signal
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+
+class SamplingProfiler(object):
+    """
+    Samples the stack on a CPU time interval timer.
+
+    :param interval: The CPU time between samples, in seconds.
+    :param all_threads: Sample every thread's stack, not only the main
+                        thread's.
+    """
+
+    def __init__(self, interval=0.005, all_threads=False):
+        self.interval = interval
+        self.all_threads = all_threads
+        self.samples = Counter()
+        self.running = False
+        self.started = None
+        self._labels = {}
+        self._installed = False
+
+    def install(self):
+        """
+        Install the SIGPROF handler. This has to be done from the main
+        thread, but start and stop can then be called from any thread.
+        """
+        if not self._installed:
+            signal.signal(signal.SIGPROF, self._sample)
+            self._installed = True
+
+    def start(self):
+        if self.running:
+            return
+        self.install()
+        self.running = True
+        self.started = time.time()
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        if not self.running:
+            return
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        self.running = False
+
+    def clear(self):
+        self.samples = Counter()
+
+    def _sample(self, signum, frame):
+        if self.all_threads:
+            main = threading.main_thread().ident
+            for ident, thread_frame in sys._current_frames().items():
+                # The main thread's current frame is this handler.
+                self._record(frame if ident == main else thread_frame)
+        else:
+            self._record(frame)
+
+    def _record(self, frame):
+        # Stacks are counted by their code objects, and only formatted
+        # when the samples are written out.
+        codes = []
+        while frame is not None:
+            codes.append(frame.f_code)
+            frame = frame.f_back
+        self.samples[tuple(codes)] += 1
+
+    def label(self, code):
+        label = self._labels.get(code)
+        if label is None:
+            label = self._labels[code] = '%s (%s:%d)' % (
+                code.co_name, _short_path(code.co_filename),
+                code.co_firstlineno)
+        return label
+
+    def collapsed(self):
+        """
+        Return the samples as collapsed stacks, outermost frame first.
+        """
+        merged = Counter()
+        for codes, count in self.samples.items():
+            merged[';'.join(self.label(code)
+                            for code in reversed(codes))] += count
+        return ''.join('%s %d\n' % (stack, count)
+                       for stack, count in sorted(merged.items()))
+
+    def top(self, limit=20):
+        """
+        Return a list of (function, samples) tuples for the functions most
+        often on the top of the stack, ie with the most self time.
+        """
+        counts = Counter()
+        for codes, count in self.samples.items():
+            if codes:
+                counts[self.label(codes[0])] += count
+        return counts.most_common(limit)
+
+    def write(self, path):
+        with open(path, 'w') as fh:
+            fh.write(self.collapsed())
+        return path
+
+
+def _short_path(filename):
+    # Paths relative to sys.path are shorter and the same on every box.
+    best = filename
+    for entry in sys.path:
+        if entry and filename.startswith(entry + os.sep):
+            relative = filename[len(entry) + 1:]
+            if len(relative) < len(best):
+                best = relative
+    return best
+
+
+def init_profiler(app):
+    """
+    Create the app's profiler, and set up the control signal and the
+    admin endpoint.
+    """
+    profiler = SamplingProfiler(app.config.get('PROFILER_INTERVAL'),
+                                app.config.get('PROFILER_ALL_THREADS'))
+    profiler.install()
+    output_dir = app.config.get('PROFILER_OUTPUT_DIR') or \
+        tempfile.gettempdir()
+
+    signal_name = app.config.get('PROFILER_SIGNAL')
+    if signal_name:
+        def toggle(signum, frame):
+            if not profiler.running:
+                profiler.clear()
+                profiler.start()
+                return
+            profiler.stop()
+            path = os.path.join(output_dir, 'profile-%d-%d.folded' % (
+                os.getpid(), profiler.started))
+            profiler.write(path)
+            app.logger.warning('Wrote profile to %s', path)
+        signal.signal(getattr(signal, signal_name), toggle)
+
+    endpoint = app.config.get('PROFILER_ENDPOINT')
+    if endpoint:
+        from flask import Response, abort, request
+        token = app.config.get('PROFILER_TOKEN')
+        if not token:
+            raise RuntimeError('PROFILER_ENDPOINT needs a PROFILER_TOKEN.')
+        expected = ('Bearer ' + token).encode('utf-8')
+
+        def profile_control(action):
+            given = request.headers.get('Authorization', '').encode('utf-8')
+            if not hmac.compare_digest(given, expected):
+                abort(404)
+            if action == 'start':
+                profiler.clear()
+                profiler.start()
+                return Response('started\n', mimetype='text/plain')
+            profiler.stop()
+            return Response(profiler.collapsed(), mimetype='text/plain')
+
+        app.add_url_rule(endpoint + '/<any(start, stop):action>',
+                         'boilerplate_profile', profile_control,
+                         methods=['POST'])
+        if getattr(app, 'csrf', None) is not None:
+            app.csrf.exempt(profile_control)
+
+    app.profiler = profiler
+    return profiler
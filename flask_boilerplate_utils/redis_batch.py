@@ -0,0 +1,212 @@
+"""
+Request scoped batching of Redis commands, so that a request makes as
+few round trips to Redis as possible.
+
+Keys declared for prefetching are fetched in the same round trip as the
+session, and writes queued during a request, including the session's
+own, are sent in one pipeline when the request is torn down::
+
+    app.redis_batch.prefetch(['feature-flags'])
+    app.redis_batch.prefetch(lambda request: ['ratelimit:' +
+                                              request.remote_addr])
+
+    @app.route('/')
+    def index():
+        flags = app.redis_batch.get('feature-flags')
+        app.redis_batch.pipeline.incr('ratelimit:' + request.remote_addr)
+        ...
+
+Queued writes are sent after the response has been built, so their
+results and errors are not available to the view, and reads made during
+the request do not see them. Commands are not sent in a MULTI transaction,
+so writes which must be atomic, such as the session's writes along with
+its cache invalidation, are sent on their own. Deferred callers are told
+of the commands which failed, and the errors are logged.
+"""
+from flask import g, has_request_context, request
+
+
+class QueuedPipeline(object):
+    """
+    A view of the request batch's pipeline. Commands are queued on the
+    batch, to be sent when it is flushed.
+    """
+
+    def __init__(self, batch):
+        self._batch = batch
+        self._start = len(batch.pipeline)
+
+    def __getattr__(self, name):
+        return getattr(self._batch.pipeline, name)
+
+    def __len__(self):
+        return len(self._batch.pipeline) - self._start
+
+    def defer(self, callback=None, errback=None):
+        """
+        Call callback with the results of the commands queued through
+        this view once the batch has been flushed, or errback with the
+        first error if any of them failed.
+        """
+        if callback is not None or errback is not None:
+            self._batch.callbacks.append(
+                (self._start, len(self._batch.pipeline), callback, errback))
+
+
+class RequestBatch(object):
+    """
+    The Redis commands of one request.
+
+    :attr pipeline: A pipeline for writes, sent when the request is torn
+                    down.
+    :attr prefetched: A dict of the prefetched keys and their values, or
+                      None before the keys are fetched.
+    """
+
+    def __init__(self, batcher):
+        self.batcher = batcher
+        self.pipeline = batcher.redis.pipeline(transaction=False)
+        self.prefetched = None
+        self.callbacks = []
+        self._prefetch_keys = None
+
+    def prefetch_keys(self):
+        if self._prefetch_keys is None:
+            keys = []
+            for declared in self.batcher.prefetches:
+                if callable(declared):
+                    declared = declared(request)
+                keys.extend(declared or ())
+            self._prefetch_keys = keys
+        return self._prefetch_keys
+
+    def queue_prefetch(self, pipe):
+        """
+        Queue GETs of the prefetch keys on a pipeline. Returns the number
+        of commands queued.
+        """
+        keys = self.prefetch_keys()
+        for key in keys:
+            pipe.get(key)
+        return len(keys)
+
+    def set_prefetched(self, values):
+        self.prefetched = dict(zip(self.prefetch_keys(), values))
+
+    def execute_reads(self, pipe):
+        """
+        Execute a pipeline of reads, fetching the prefetch keys in the same
+        round trip if they have not been fetched yet. Returns the results
+        of the pipeline's own commands.
+        """
+        if self.prefetched is not None:
+            return pipe.execute()
+        count = len(pipe)
+        self.queue_prefetch(pipe)
+        results = pipe.execute()
+        self.set_prefetched(results[count:])
+        return results[:count]
+
+    def get(self, key):
+        """
+        Return the value of a key, prefetching the declared keys first if
+        they have not been fetched yet. Keys which were not declared are
+        fetched with a GET of their own.
+        """
+        if self.prefetched is None:
+            pipe = self.batcher.redis.pipeline(transaction=False)
+            self.execute_reads(pipe)
+        if key not in self.prefetched:
+            self.prefetched[key] = self.batcher.redis.get(key)
+        return self.prefetched[key]
+
+    def flush(self):
+        """
+        Send the queued writes and call the callbacks of deferred
+        pipelines. Raises the first error once every deferred pipeline
+        has been told of its results.
+        """
+        count = len(self.pipeline)
+        if not count:
+            return
+        try:
+            results = self.pipeline.execute(raise_on_error=False)
+        except Exception as e:
+            # Nothing is known to have been written.
+            results = [e] * count
+        errors = [result for result in results
+                  if isinstance(result, Exception)]
+        for start, end, callback, errback in self.callbacks:
+            failed = [result for result in results[start:end]
+                      if isinstance(result, Exception)]
+            if failed:
+                if errback is not None:
+                    errback(failed[0])
+            elif callback is not None:
+                callback(results[start:end])
+        if errors:
+            raise errors[0]
+
+
+class RedisBatcher(object):
+    """
+    Creates a RequestBatch for each request that uses Redis, and flushes
+    it when the request is torn down.
+
+    :param app: The Flask app.
+    :param redis: A synchronous Redis client.
+    :param prefetch: Keys to prefetch on every request.
+    """
+
+    def __init__(self, app, redis, prefetch=None):
+        self.app = app
+        self.redis = redis
+        self.prefetches = []
+        if prefetch:
+            self.prefetch(prefetch)
+        app.teardown_request(self.teardown)
+
+    def prefetch(self, keys):
+        """
+        Declare keys to fetch along with the session. Either a list of
+        keys, or a function called with the request which returns one.
+        Can be used as a decorator.
+        """
+        self.prefetches.append(keys)
+        return keys
+
+    def current(self):
+        """
+        Return the current request's batch, or None outside a request.
+        """
+        if not has_request_context():
+            return None
+        batch = getattr(g, '_redis_batch', None)
+        if batch is None:
+            batch = g._redis_batch = RequestBatch(self)
+        return batch
+
+    def get(self, key):
+        """
+        Return the value of a key through the current request's batch.
+        """
+        return self.current().get(key)
+
+    @property
+    def pipeline(self):
+        """
+        The current request's write pipeline.
+        """
+        return self.current().pipeline
+
+    def teardown(self, exc=None):
+        batch = getattr(g, '_redis_batch', None)
+        if batch is None:
+            return
+        g._redis_batch = None
+        try:
+            batch.flush()
+        except Exception:
+            # The response has already been built, so the error can only
+            # be logged.
+            self.app.logger.exception('Flushing queued Redis writes failed')
@@ -0,0 +1,219 @@
+"""
+Builds Redis clients from the app's config, with a bounded connection
+pool, timeouts and support for Unix sockets, Sentinel and Redis Cluster.
+
+Every option is read from config keys sharing a prefix, e.g. with the
+prefix ``REDIS_SESSIONS_``:
+
+- ``URL``: A redis:// rediss:// or unix:// URL. Overrides HOST, PORT,
+  DB and UNIX_SOCKET.
+- ``HOST``, ``PORT``, ``DB``, ``PASSWORD``
+- ``UNIX_SOCKET``: A Unix socket path, used instead of HOST and PORT.
+- ``MAX_CONNECTIONS``: The size of the connection pool.
+- ``POOL_TIMEOUT``: Seconds to wait for a free connection before
+  raising a ConnectionError. None waits forever.
+- ``SOCKET_CONNECT_TIMEOUT``, ``SOCKET_TIMEOUT``: Connect and read
+  timeouts in seconds.
+- ``HEALTH_CHECK_INTERVAL``: Seconds a connection may be idle before it
+  is checked with a PING when next used. 0 disables the check.
+- ``SENTINELS``: A list of (host, port) Sentinel addresses. The master
+  named by ``SENTINEL_MASTER`` is discovered through them.
+- ``CLUSTER``: Connect to a Redis Cluster. ``CLUSTER_NODES`` is a list of
+  (host, port) startup nodes, defaulting to HOST and PORT. A session and
+  its version counter and user index live in different hash slots, so
+  with a cluster the session interfaces write them with plain pipelines
+  instead of MULTI transactions, and keys are deleted one at a time.
+"""
+from importlib import import_module
+
+from redis import BlockingConnectionPool
+
+
+DEFAULTS = {
+    'URL': None,
+    'PASSWORD': None,
+    'UNIX_SOCKET': None,
+    'MAX_CONNECTIONS': 50,
+    'POOL_TIMEOUT': 5,
+    'SOCKET_CONNECT_TIMEOUT': 5,
+    'SOCKET_TIMEOUT': 5,
+    'HEALTH_CHECK_INTERVAL': 30,
+    'SENTINELS': None,
+    'SENTINEL_MASTER': 'mymaster',
+    'CLUSTER': False,
+    'CLUSTER_NODES': None,
+}
+
+
+class InstrumentedBlockingConnectionPool(BlockingConnectionPool):
+    """
+    A BlockingConnectionPool which keeps count of the connections in use,
+    the callers waiting for a connection and the connections created.
+    """
+
+    def reset(self):
+        super(InstrumentedBlockingConnectionPool, self).reset()
+        self._checked_out = set()
+        self.waiting = 0
+        self.created = 0
+
+    def make_connection(self):
+        self.created += 1
+        return super(InstrumentedBlockingConnectionPool, self).make_connection()
+
+    def get_connection(self, command_name, *keys, **options):
+        self.waiting += 1
+        try:
+            connection = super(InstrumentedBlockingConnectionPool, self) \
+                .get_connection(command_name, *keys, **options)
+        finally:
+            self.waiting -= 1
+        self._checked_out.add(id(connection))
+        return connection
+
+    def release(self, connection):
+        self._checked_out.discard(id(connection))
+        super(InstrumentedBlockingConnectionPool, self).release(connection)
+
+    @property
+    def in_use(self):
+        return len(self._checked_out)
+
+
+def init_config(config, prefix):
+    """
+    Set the default connection options for a config prefix.
+    """
+    for key, value in DEFAULTS.items():
+        config.setdefault(prefix + key, value)
+
+
+def create_redis(config, prefix='REDIS_SESSIONS_', asyncio=False):
+    """
+    Create a Redis client from config keys starting with prefix.
+
+    :param config: The app's config
+    :param prefix: The config key prefix, e.g. 'REDIS_SESSIONS_'
+    :param asyncio: Create a redis.asyncio client instead.
+    """
+    def option(name):
+        return config.get(prefix + name, DEFAULTS.get(name))
+
+    if asyncio:
+        client = import_module('redis.asyncio')
+        pool_class = client.BlockingConnectionPool
+    else:
+        client = import_module('redis')
+        pool_class = InstrumentedBlockingConnectionPool
+
+    timeouts = dict(
+        socket_connect_timeout=option('SOCKET_CONNECT_TIMEOUT'),
+        socket_timeout=option('SOCKET_TIMEOUT'),
+        health_check_interval=option('HEALTH_CHECK_INTERVAL'),
+    )
+
+    if option('CLUSTER'):
+        cluster = import_module(client.__name__ + '.cluster')
+        nodes = option('CLUSTER_NODES') or [
+            (option('HOST'), option('PORT'))]
+        return cluster.RedisCluster(
+            startup_nodes=[cluster.ClusterNode(host, port)
+                           for host, port in nodes],
+            password=option('PASSWORD'),
+            max_connections=option('MAX_CONNECTIONS'),
+            **timeouts)
+
+    if option('SENTINELS'):
+        sentinel = import_module(client.__name__ + '.sentinel')
+        manager = sentinel.Sentinel(
+            option('SENTINELS'),
+            socket_connect_timeout=timeouts['socket_connect_timeout'],
+            socket_timeout=timeouts['socket_timeout'])
+        return manager.master_for(
+            option('SENTINEL_MASTER'),
+            db=option('DB'),
+            password=option('PASSWORD'),
+            max_connections=option('MAX_CONNECTIONS'),
+            **timeouts)
+
+    pool_options = dict(
+        max_connections=option('MAX_CONNECTIONS'),
+        timeout=option('POOL_TIMEOUT'),
+        **timeouts)
+
+    if option('URL'):
+        pool = pool_class.from_url(option('URL'), **pool_options)
+    elif option('UNIX_SOCKET'):
+        pool_options.pop('socket_connect_timeout')
+        pool = pool_class(
+            connection_class=client.UnixDomainSocketConnection,
+            path=option('UNIX_SOCKET'),
+            db=option('DB'),
+            password=option('PASSWORD'),
+            **pool_options)
+    else:
+        pool = pool_class(
+            host=option('HOST'),
+            port=option('PORT'),
+            db=option('DB'),
+            password=option('PASSWORD'),
+            **pool_options)
+
+    return client.Redis(connection_pool=pool)
+
+
+def _pool_stats(pool):
+    if isinstance(pool, InstrumentedBlockingConnectionPool):
+        return {
+            'max': pool.max_connections,
+            'created': pool.created,
+            'in_use': pool.in_use,
+            'idle': len(pool._connections) - pool.in_use,
+            'waiting': pool.waiting,
+        }
+    # A plain ConnectionPool, as used by Sentinel and Cluster clients.
+    in_use = len(getattr(pool, '_in_use_connections', ()))
+    return {
+        'max': pool.max_connections,
+        'created': getattr(pool, '_created_connections', 0),
+        'in_use': in_use,
+        'idle': len(getattr(pool, '_available_connections', ())),
+        'waiting': 0,
+    }
+
+
+def is_cluster(redis):
+    """
+    Whether a client created by create_redis is a Redis Cluster client.
+    """
+    return hasattr(redis, 'get_nodes')
+
+
+def get_pool_stats(redis):
+    """
+    Return a dict of connection pool metrics for a client created by
+    create_redis: max, created, in_use, idle and waiting. For a cluster
+    client the values are summed over every node's pool.
+    """
+    if is_cluster(redis):
+        totals = dict(max=0, created=0, in_use=0, idle=0, waiting=0)
+        for node in redis.get_nodes():
+            if node.redis_connection is None:
+                continue
+            stats = _pool_stats(node.redis_connection.connection_pool)
+            for key, value in stats.items():
+                totals[key] += value
+        return totals
+    return _pool_stats(redis.connection_pool)
+
+
+def prometheus_pool_stats(redis, name='boilerplate_redis_pool'):
+    """
+    Return the pool metrics of get_pool_stats as a list of lines in the
+    Prometheus text format, one gauge per metric.
+    """
+    lines = []
+    for key, value in sorted(get_pool_stats(redis).items()):
+        lines.append('# TYPE %s_%s gauge' % (name, key))
+        lines.append('%s_%s %d' % (name, key, value))
+    return lines
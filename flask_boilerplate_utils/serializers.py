@@ -0,0 +1,751 @@
+"""
+Session serializers for the boilerplate's Redis session interfaces.
+
+Every payload is written with a small envelope so that the codec used
+to write it can always be determined when reading it back:
+
+    +-------+---------+-------+----------------+
+    | magic | version | codec | payload ...    |
+    +-------+---------+-------+----------------+
+      0xfb     1 byte   1 byte
+
+Compressed payloads use version 2 of the envelope, which adds the id of
+the compressor:
+
+    +-------+---------+-------+------------+------------------------+
+    | magic | version | codec | compressor | compressed payload ... |
+    +-------+---------+-------+------------+------------------------+
+      0xfb     1 byte   1 byte    1 byte
+
+0xfb is not a valid pickle opcode, so payloads written before envelopes
+existed (raw pickles) are still recognised and can be read during a
+rolling deploy.
+"""
+import datetime
+import json
+import pickle
+import struct
+import uuid
+import zlib
+from base64 import b64decode, b64encode
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+MAGIC = b'\xfb'
+ENVELOPE_VERSION = 1
+COMPRESSED_ENVELOPE_VERSION = 2
+
+
+class SerializationError(ValueError):
+    """
+    Raised when a payload cannot be encoded or decoded.
+    """
+
+
+class Serializer(object):
+    """
+    Base class for session serializers.
+
+    :attr name: The name used to select the serializer through
+                ``REDIS_SESSIONS_SERIALIZER``.
+    :attr codec_id: A unique byte stored in the envelope header.
+    """
+    name = None
+    codec_id = None
+
+    def dumps(self, data):
+        raise NotImplementedError()
+
+    def loads(self, payload):
+        raise NotImplementedError()
+
+
+class PickleSerializer(Serializer):
+    """
+    The original session format. Only use this if the Redis store is
+    fully trusted, as loading a pickle can execute arbitrary code.
+
+    :param protocol: The pickle protocol to write with.
+    """
+    name = 'pickle'
+    codec_id = 1
+
+    def __init__(self, protocol=None):
+        self.protocol = protocol
+
+    def dumps(self, data):
+        return pickle.dumps(data, protocol=self.protocol)
+
+    def loads(self, payload):
+        return pickle.loads(payload)
+
+
+class JSONSerializer(Serializer):
+    """
+    Compact JSON using the C accelerated encoder from the standard
+    library. bytes, datetimes, dates and UUIDs are tagged so that they
+    survive a round trip. Tuples are returned as lists and dictionary
+    keys as strings.
+
+    Tagged values are single key dicts with one of ``tags`` as the key,
+    so dicts of the session's own which look like one are escaped.
+    """
+    name = 'json'
+    codec_id = 2
+    tags = frozenset([' b', ' d', ' a', ' u', ' e'])
+
+    def __init__(self):
+        self._encoder = json.JSONEncoder(
+            separators=(',', ':'), ensure_ascii=False, default=self._tag)
+        self._decoder = json.JSONDecoder(object_hook=self._untag)
+
+    @staticmethod
+    def _tag(value):
+        if isinstance(value, bytes):
+            return {' b': b64encode(value).decode('ascii')}
+        if isinstance(value, datetime.datetime):
+            return {' d': value.isoformat()}
+        if isinstance(value, datetime.date):
+            return {' a': value.isoformat()}
+        if isinstance(value, uuid.UUID):
+            return {' u': value.hex}
+        raise TypeError('%r is not JSON serializable' % (value,))
+
+    @classmethod
+    def _escape(cls, value):
+        """
+        Return a copy of value with single key dicts whose key is a tag
+        rewritten as {' e': [key, value]}.
+        """
+        if isinstance(value, dict):
+            escaped = dict((key, cls._escape(item))
+                           for key, item in value.items())
+            if len(escaped) == 1:
+                key, item = next(iter(escaped.items()))
+                if key in cls.tags:
+                    return {' e': [key, item]}
+            return escaped
+        if isinstance(value, (list, tuple)):
+            return [cls._escape(item) for item in value]
+        return value
+
+    @staticmethod
+    def _untag(obj):
+        if len(obj) != 1:
+            return obj
+        key, value = next(iter(obj.items()))
+        if key == ' e':
+            return {value[0]: value[1]}
+        if key == ' b':
+            return b64decode(value)
+        if key == ' d':
+            return _parse_isoformat(value)
+        if key == ' a':
+            return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+        if key == ' u':
+            return uuid.UUID(hex=value)
+        return obj
+
+    def dumps(self, data):
+        text = self._encoder.encode(data)
+        if '{" ' in text:
+            # Only walk the data when something could need escaping,
+            # which tagged values also look like.
+            text = self._encoder.encode(self._escape(data))
+        return text.encode('utf-8')
+
+    def loads(self, payload):
+        return self._decoder.decode(payload.decode('utf-8'))
+
+
+class MsgpackSerializer(Serializer):
+    """
+    msgpack, using extension types for datetimes, dates and UUIDs.
+    Requires the ``msgpack`` package. Tuples are returned as lists.
+    """
+    name = 'msgpack'
+    codec_id = 3
+
+    EXT_DATETIME = 1
+    EXT_DATE = 2
+    EXT_UUID = 3
+
+    def __init__(self):
+        if msgpack is None:
+            raise SerializationError('The msgpack serializer requires '
+                                     'the msgpack package.')
+
+    def _default(self, value):
+        if isinstance(value, datetime.datetime):
+            return msgpack.ExtType(self.EXT_DATETIME,
+                                   value.isoformat().encode('ascii'))
+        if isinstance(value, datetime.date):
+            return msgpack.ExtType(self.EXT_DATE,
+                                   struct.pack('>I', value.toordinal()))
+        if isinstance(value, uuid.UUID):
+            return msgpack.ExtType(self.EXT_UUID, value.bytes)
+        raise TypeError('%r is not msgpack serializable' % (value,))
+
+    def _ext_hook(self, code, data):
+        if code == self.EXT_DATETIME:
+            return _parse_isoformat(data.decode('ascii'))
+        if code == self.EXT_DATE:
+            return datetime.date.fromordinal(struct.unpack('>I', data)[0])
+        if code == self.EXT_UUID:
+            return uuid.UUID(bytes=data)
+        return msgpack.ExtType(code, data)
+
+    def dumps(self, data):
+        return msgpack.packb(data, use_bin_type=True, default=self._default)
+
+    def loads(self, payload):
+        return msgpack.unpackb(payload, raw=False, ext_hook=self._ext_hook,
+                               strict_map_key=False)
+
+
+class TaggedBinarySerializer(Serializer):
+    """
+    A compact, dependency free binary format. Each value is a one byte
+    tag followed by its body. Integers and lengths are stored as
+    varints, so small sessions stay very small.
+
+    Supports None, bool, int, float, str, bytes, list, tuple, dict,
+    datetime (naive and aware), date and UUID.
+    """
+    name = 'binary'
+    codec_id = 4
+
+    def dumps(self, data):
+        out = bytearray()
+        self._encode(data, out)
+        return bytes(out)
+
+    def loads(self, payload):
+        value, offset = self._decode(payload, 0)
+        if offset != len(payload):
+            raise SerializationError('Trailing data in binary payload.')
+        return value
+
+    def _encode(self, value, out):
+        # bool must be checked before int, and datetime before date.
+        if value is None:
+            out += b'N'
+        elif value is True:
+            out += b'T'
+        elif value is False:
+            out += b'F'
+        elif isinstance(value, int):
+            out += b'i'
+            _write_varint(out, _zigzag(value))
+        elif isinstance(value, float):
+            out += b'f'
+            out += struct.pack('>d', value)
+        elif isinstance(value, str):
+            encoded = value.encode('utf-8')
+            out += b's'
+            _write_varint(out, len(encoded))
+            out += encoded
+        elif isinstance(value, (bytes, bytearray)):
+            out += b'b'
+            _write_varint(out, len(value))
+            out += value
+        elif isinstance(value, dict):
+            out += b'd'
+            _write_varint(out, len(value))
+            for key, item in value.items():
+                self._encode(key, out)
+                self._encode(item, out)
+        elif isinstance(value, (list, tuple)):
+            out += b'l' if isinstance(value, list) else b't'
+            _write_varint(out, len(value))
+            for item in value:
+                self._encode(item, out)
+        elif isinstance(value, datetime.datetime):
+            offset = value.utcoffset()
+            naive = value.replace(tzinfo=None)
+            micros = (naive - _EPOCH) // _MICROSECOND
+            if offset is None:
+                out += b'D'
+            else:
+                out += b'Z'
+                _write_varint(out, _zigzag(offset // _SECOND))
+            _write_varint(out, _zigzag(micros))
+        elif isinstance(value, datetime.date):
+            out += b'a'
+            _write_varint(out, value.toordinal())
+        elif isinstance(value, uuid.UUID):
+            out += b'u'
+            out += value.bytes
+        else:
+            raise SerializationError(
+                '%r cannot be stored by the binary serializer.' % (value,))
+
+    def _decode(self, payload, offset):
+        try:
+            tag = payload[offset:offset + 1]
+            offset += 1
+            if tag == b'N':
+                return None, offset
+            if tag == b'T':
+                return True, offset
+            if tag == b'F':
+                return False, offset
+            if tag == b'i':
+                value, offset = _read_varint(payload, offset)
+                return _unzigzag(value), offset
+            if tag == b'f':
+                return struct.unpack_from('>d', payload, offset)[0], offset + 8
+            if tag in (b's', b'b'):
+                length, offset = _read_varint(payload, offset)
+                end = offset + length
+                if end > len(payload):
+                    raise SerializationError('Truncated binary payload.')
+                chunk = payload[offset:end]
+                if tag == b's':
+                    return chunk.decode('utf-8'), end
+                return bytes(chunk), end
+            if tag == b'd':
+                length, offset = _read_varint(payload, offset)
+                result = {}
+                for _ in range(length):
+                    key, offset = self._decode(payload, offset)
+                    result[key], offset = self._decode(payload, offset)
+                return result, offset
+            if tag in (b'l', b't'):
+                length, offset = _read_varint(payload, offset)
+                result = []
+                for _ in range(length):
+                    item, offset = self._decode(payload, offset)
+                    result.append(item)
+                return (result if tag == b'l' else tuple(result)), offset
+            if tag in (b'D', b'Z'):
+                tzinfo = None
+                if tag == b'Z':
+                    seconds, offset = _read_varint(payload, offset)
+                    tzinfo = _fixed_timezone(_unzigzag(seconds))
+                micros, offset = _read_varint(payload, offset)
+                value = _EPOCH + datetime.timedelta(
+                    microseconds=_unzigzag(micros))
+                return value.replace(tzinfo=tzinfo), offset
+            if tag == b'a':
+                ordinal, offset = _read_varint(payload, offset)
+                return datetime.date.fromordinal(ordinal), offset
+            if tag == b'u':
+                if offset + 16 > len(payload):
+                    raise SerializationError('Truncated binary payload.')
+                return uuid.UUID(bytes=bytes(payload[offset:offset + 16])), \
+                    offset + 16
+        except (struct.error, ValueError, OverflowError) as e:
+            if isinstance(e, SerializationError):
+                raise
+            raise SerializationError('Invalid binary payload: %s' % e)
+        raise SerializationError('Unknown tag %r in binary payload.' % tag)
+
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+_SECOND = datetime.timedelta(seconds=1)
+_MICROSECOND = datetime.timedelta(microseconds=1)
+_timezones = {}
+
+
+def _fixed_timezone(seconds):
+    tz = _timezones.get(seconds)
+    if tz is None:
+        tz = _timezones[seconds] = datetime.timezone(
+            datetime.timedelta(seconds=seconds))
+    return tz
+
+
+def _parse_isoformat(value):
+    return datetime.datetime.fromisoformat(value)
+
+
+def _zigzag(value):
+    return value * 2 if value >= 0 else -value * 2 - 1
+
+
+def _unzigzag(value):
+    return value >> 1 if not value & 1 else -((value + 1) >> 1)
+
+
+def _write_varint(out, value):
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _read_varint(payload, offset):
+    result = 0
+    shift = 0
+    while True:
+        if offset >= len(payload):
+            raise SerializationError('Truncated varint in binary payload.')
+        byte = payload[offset]
+        offset += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, offset
+        shift += 7
+
+
+# Serializer Registry.
+_serializers_by_name = {}
+_serializers_by_codec = {}
+
+
+def register_serializer(cls):
+    """
+    Register a Serializer subclass so that it can be selected by name
+    and decoded by codec id. Can be used as a class decorator.
+    """
+    existing = _serializers_by_codec.get(cls.codec_id)
+    if existing is not None and existing is not cls:
+        raise ValueError('Codec id %r is already used by %r' % (
+            cls.codec_id, existing.name))
+    _serializers_by_name[cls.name] = cls
+    _serializers_by_codec[cls.codec_id] = cls
+    return cls
+
+
+def get_serializer(name, **options):
+    """
+    Return a new serializer instance for a registered name.
+
+    :param name: The registered name, e.g. 'msgpack'
+    :param options: Keyword arguments for the serializer's initialiser
+    """
+    try:
+        cls = _serializers_by_name[name]
+    except KeyError:
+        raise ValueError('Unknown session serializer %r. Choose one of: %s' % (
+            name, ', '.join(sorted(_serializers_by_name))))
+    return cls(**options)
+
+
+for _cls in (PickleSerializer, JSONSerializer, MsgpackSerializer,
+             TaggedBinarySerializer):
+    register_serializer(_cls)
+
+
+class Compressor(object):
+    """
+    Base class for session payload compressors.
+
+    :attr name: The name used to select the compressor through
+                ``REDIS_SESSIONS_COMPRESSION``.
+    :attr compressor_id: A unique byte stored in the envelope header.
+    """
+    name = None
+    compressor_id = None
+
+    def compress(self, payload):
+        raise NotImplementedError()
+
+    def decompress(self, payload):
+        raise NotImplementedError()
+
+
+class ZlibCompressor(Compressor):
+    """
+    zlib, from the standard library.
+
+    :param level: The compression level, 1 to 9.
+    """
+    name = 'zlib'
+    compressor_id = 1
+
+    def __init__(self, level=6):
+        self.level = level
+
+    def compress(self, payload):
+        return zlib.compress(payload, self.level)
+
+    def decompress(self, payload):
+        return zlib.decompress(payload)
+
+
+class LZ4Compressor(Compressor):
+    """
+    LZ4 frames. Very fast, with a lower ratio than zlib or zstd.
+    Requires the ``lz4`` package.
+
+    :param level: The compression level, 0 (fastest) to 16.
+    """
+    name = 'lz4'
+    compressor_id = 2
+
+    def __init__(self, level=0):
+        if lz4 is None:
+            raise SerializationError('The lz4 compressor requires the '
+                                     'lz4 package.')
+        self.level = level
+
+    def compress(self, payload):
+        return lz4.frame.compress(payload, compression_level=self.level)
+
+    def decompress(self, payload):
+        return lz4.frame.decompress(payload)
+
+
+class ZstdCompressor(Compressor):
+    """
+    Zstandard. Requires the ``zstandard`` package.
+
+    :param level: The compression level, 1 to 22.
+    """
+    name = 'zstd'
+    compressor_id = 3
+
+    def __init__(self, level=3):
+        if zstandard is None:
+            raise SerializationError('The zstd compressor requires the '
+                                     'zstandard package.')
+        self.level = level
+        self._compressor = zstandard.ZstdCompressor(level=level)
+        self._decompressor = zstandard.ZstdDecompressor()
+
+    def compress(self, payload):
+        return self._compressor.compress(payload)
+
+    def decompress(self, payload):
+        return self._decompressor.decompress(payload)
+
+
+class ZstdDictCompressor(Compressor):
+    """
+    Zstandard with a trained dictionary, which compresses small payloads
+    far better than plain zstd. The dictionary's id is stored in front of
+    every compressed payload, so payloads can always be matched with the
+    dictionary they were written with.
+
+    :param dictionary: The dictionary to compress with, as bytes (see
+                       train_zstd_dictionary).
+    :param level: The compression level, 1 to 22.
+    :param dictionaries: Other dictionaries which payloads may have been
+                         written with, e.g. while rotating dictionaries.
+    """
+    name = 'zstd-dict'
+    compressor_id = 4
+
+    def __init__(self, dictionary, level=3, dictionaries=()):
+        if zstandard is None:
+            raise SerializationError('The zstd compressor requires the '
+                                     'zstandard package.')
+        self.level = level
+        dictionary = zstandard.ZstdCompressionDict(dictionary)
+        self.dict_id = dictionary.dict_id()
+        # The dictionary id is written by compress(), so zstd need not
+        # write it again in the frame header.
+        self._compressor = zstandard.ZstdCompressor(
+            level=level, dict_data=dictionary, write_dict_id=False)
+        self._decompressors = {}
+        for data in (dictionary,) + tuple(dictionaries):
+            if not isinstance(data, zstandard.ZstdCompressionDict):
+                data = zstandard.ZstdCompressionDict(data)
+            self._decompressors[data.dict_id()] = \
+                zstandard.ZstdDecompressor(dict_data=data)
+
+    def compress(self, payload):
+        return struct.pack('>I', self.dict_id) + \
+            self._compressor.compress(payload)
+
+    def decompress(self, payload):
+        dict_id = struct.unpack('>I', payload[:4])[0]
+        try:
+            decompressor = self._decompressors[dict_id]
+        except KeyError:
+            raise SerializationError('zstd dictionary %d is not available'
+                                     % dict_id)
+        return decompressor.decompress(payload[4:])
+
+
+def train_zstd_dictionary(samples, size=16 * 1024):
+    """
+    Train a zstd dictionary from sample payloads, returning it as bytes.
+
+    :param samples: A list of uncompressed payloads, see
+                    SessionCodec.unwrap.
+    :param size: The maximum size of the dictionary in bytes.
+    """
+    if zstandard is None:
+        raise SerializationError('Training a dictionary requires the '
+                                 'zstandard package.')
+    return zstandard.train_dictionary(size, list(samples)).as_bytes()
+
+
+# Compressor Registry.
+_compressors_by_name = {}
+_compressors_by_id = {}
+
+
+def register_compressor(cls):
+    """
+    Register a Compressor subclass so that it can be selected by name
+    and used for decoding by id. Can be used as a class decorator.
+    """
+    existing = _compressors_by_id.get(cls.compressor_id)
+    if existing is not None and existing is not cls:
+        raise ValueError('Compressor id %r is already used by %r' % (
+            cls.compressor_id, existing.name))
+    _compressors_by_name[cls.name] = cls
+    _compressors_by_id[cls.compressor_id] = cls
+    return cls
+
+
+def get_compressor(name, **options):
+    """
+    Return a new compressor instance for a registered name.
+
+    :param name: The registered name, e.g. 'zlib'
+    :param options: Keyword arguments for the compressor's initialiser
+    """
+    try:
+        cls = _compressors_by_name[name]
+    except KeyError:
+        raise ValueError('Unknown session compressor %r. Choose one of: %s'
+                         % (name, ', '.join(sorted(_compressors_by_name))))
+    return cls(**options)
+
+
+for _cls in (ZlibCompressor, LZ4Compressor, ZstdCompressor,
+             ZstdDictCompressor):
+    register_compressor(_cls)
+
+
+class SessionCodec(object):
+    """
+    Wraps a serializer with the versioned envelope.
+
+    Payloads are always written with ``serializer``. Payloads written by
+    any other registered serializer or compressor are still readable, so
+    either can be changed without invalidating existing sessions.
+
+    :param serializer: A Serializer instance to write with.
+    :param legacy_pickle: Whether payloads written by pickle (both raw
+                          pre-envelope pickles and enveloped pickles)
+                          may be read. Disable this once a migration
+                          away from pickle is complete.
+    :param compressor: A Compressor instance, or None to store payloads
+                       uncompressed.
+    :param compression_threshold: Payloads smaller than this many bytes
+                                  are stored uncompressed.
+    """
+
+    def __init__(self, serializer, legacy_pickle=True, compressor=None,
+                 compression_threshold=1024):
+        self.serializer = serializer
+        self.legacy_pickle = legacy_pickle
+        self.compressor = compressor
+        self.compression_threshold = compression_threshold
+        self.header = MAGIC + bytes(bytearray(
+            [ENVELOPE_VERSION, serializer.codec_id]))
+        self._readers = {serializer.codec_id: serializer}
+        self._decompressors = {}
+        if compressor is not None:
+            self.compressed_header = MAGIC + bytes(bytearray(
+                [COMPRESSED_ENVELOPE_VERSION, serializer.codec_id,
+                 compressor.compressor_id]))
+            self._decompressors[compressor.compressor_id] = compressor
+
+    def encode(self, data):
+        try:
+            payload = self.serializer.dumps(data)
+        except (TypeError, ValueError) as e:
+            if isinstance(e, SerializationError):
+                raise
+            raise SerializationError(str(e))
+
+        if (self.compressor is not None and
+                len(payload) >= self.compression_threshold):
+            compressed = self.compressor.compress(payload)
+            # Incompressible payloads are stored as they are.
+            if len(compressed) < len(payload):
+                return self.compressed_header + compressed
+        return self.header + payload
+
+    def unwrap(self, raw):
+        """
+        Return a tuple of (codec id, payload) for a stored value, with the
+        envelope removed and the payload decompressed. Legacy pickles have
+        a codec id of None.
+        """
+        if raw[:1] != MAGIC:
+            return None, raw
+
+        header = bytearray(raw[1:3])
+        if len(header) != 2:
+            raise SerializationError('Truncated envelope header.')
+        version, codec_id = header
+        if version == ENVELOPE_VERSION:
+            return codec_id, raw[3:]
+        if version != COMPRESSED_ENVELOPE_VERSION:
+            raise SerializationError('Unsupported envelope version %d' %
+                                     version)
+
+        if len(raw) < 4:
+            raise SerializationError('Truncated envelope header.')
+        decompressor = self._get_decompressor(bytearray(raw[3:4])[0])
+        try:
+            return codec_id, decompressor.decompress(raw[4:])
+        except SerializationError:
+            raise
+        except Exception as e:
+            raise SerializationError('Invalid %s payload: %s' % (
+                decompressor.name, e))
+
+    def decode(self, raw):
+        codec_id, payload = self.unwrap(raw)
+        if codec_id is None:
+            if not self.legacy_pickle:
+                raise SerializationError('Refusing to load a legacy pickle.')
+            try:
+                return pickle.loads(payload)
+            except Exception as e:
+                raise SerializationError('Invalid legacy payload: %s' % e)
+
+        reader = self._get_reader(codec_id)
+        try:
+            return reader.loads(payload)
+        except SerializationError:
+            raise
+        except Exception as e:
+            raise SerializationError('Invalid %s payload: %s' % (
+                reader.name, e))
+
+    def _get_decompressor(self, compressor_id):
+        decompressor = self._decompressors.get(compressor_id)
+        if decompressor is None:
+            cls = _compressors_by_id.get(compressor_id)
+            if cls is None:
+                raise SerializationError('Unknown compressor id %d' %
+                                         compressor_id)
+            if cls is ZstdDictCompressor:
+                raise SerializationError('No zstd dictionary is configured.')
+            decompressor = self._decompressors[compressor_id] = cls()
+        return decompressor
+
+    def _get_reader(self, codec_id):
+        reader = self._readers.get(codec_id)
+        if reader is None:
+            cls = _serializers_by_codec.get(codec_id)
+            if cls is None:
+                raise SerializationError('Unknown codec id %d' % codec_id)
+            if cls is PickleSerializer and not self.legacy_pickle:
+                raise SerializationError('Refusing to load a pickle.')
+            reader = self._readers[codec_id] = cls()
+        return reader
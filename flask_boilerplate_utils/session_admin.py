@@ -0,0 +1,177 @@
+"""
+Enumerate and revoke the sessions stored by the Redis session interfaces
+without blocking Redis.
+
+Sessions are walked with SCAN, and their TTLs, sizes and deletions are
+sent in pipelined batches. When the interface has a ``user_key``, the
+sessions of one user are found through their index set instead of a
+scan, so logging a user out everywhere only touches their own sessions.
+"""
+from collections import namedtuple
+
+from redis.exceptions import ResponseError
+
+
+SessionInfo = namedtuple('SessionInfo', ['sid', 'ttl', 'memory'])
+
+
+class SessionAdmin(object):
+    """
+    Management operations on the sessions of a session interface.
+
+    :param interface: A RedisSessionInterface, RedisHashSessionInterface
+                      or AsyncRedisSessionInterface.
+    :param redis: A synchronous Redis client for the interface's store.
+                  Defaults to the interface's own client, and must be
+                  given for an AsyncRedisSessionInterface.
+    :param batch_size: The number of keys fetched per SCAN and sent per
+                       pipeline.
+    :param unlink: Delete sessions with UNLINK, which frees their memory
+                   in the background. Disable this for Redis < 4.0.
+    """
+
+    def __init__(self, interface, redis=None, batch_size=500, unlink=True):
+        self.interface = interface
+        self.redis = redis or interface.redis
+        self.batch_size = batch_size
+        self.unlink = unlink
+
+    def iter_sids(self, match='*'):
+        """
+        Yield the id of every stored session whose id matches a glob
+        pattern.
+        """
+        prefix = self.interface.prefix
+        for key in self.redis.scan_iter(match=prefix + match,
+                                        count=self.batch_size):
+            if isinstance(key, bytes):
+                key = key.decode('utf-8')
+            yield key[len(prefix):]
+
+    def iter_sessions(self, match='*', memory=False):
+        """
+        Yield a SessionInfo of (sid, ttl, memory) for every stored session
+        whose id matches a glob pattern. Sessions which expire while being
+        listed are skipped.
+
+        :param memory: Fetch each session's size in bytes with MEMORY
+                       USAGE. Otherwise memory is None.
+        """
+        for sids in self._batches(self.iter_sids(match)):
+            pipe = self.redis.pipeline(transaction=False)
+            for sid in sids:
+                pipe.ttl(self.interface.prefix + sid)
+                if memory:
+                    pipe.memory_usage(self.interface.prefix + sid)
+            results = iter(pipe.execute())
+            for sid in sids:
+                ttl = next(results)
+                usage = next(results) if memory else None
+                if ttl != -2:
+                    yield SessionInfo(sid, ttl, usage)
+
+    def get_session(self, sid):
+        """
+        Return the data of a session, or None if it does not exist.
+        """
+        return self.interface.read_sessions([sid], redis=self.redis)[0]
+
+    def delete(self, sids):
+        """
+        Delete sessions in pipelined batches, invalidating any locally
+        cached copies. Returns the number of sessions deleted.
+        """
+        deleted = 0
+        for batch in self._batches(sids):
+            pipe = self.redis.pipeline(transaction=False)
+            # One key per command, as the keys of a batch can be in
+            # different slots of a Redis Cluster.
+            for sid in batch:
+                if self.unlink:
+                    pipe.unlink(self.interface.prefix + sid)
+                else:
+                    pipe.delete(self.interface.prefix + sid)
+            if self.interface.invalidates:
+                for sid in batch:
+                    self.interface.queue_invalidation(
+                        pipe, sid, self.interface.max_lifetime)
+            try:
+                deleted += sum(pipe.execute()[:len(batch)])
+            except ResponseError:
+                if not self.unlink:
+                    raise
+                # UNLINK is not supported by this server.
+                self.unlink = False
+                deleted += self.delete(batch)
+        return deleted
+
+    def purge(self, match='*'):
+        """
+        Delete every session whose id matches a glob pattern. Returns the
+        number of sessions deleted.
+        """
+        return self.delete(self.iter_sids(match))
+
+    def _user_index(self, user_id):
+        if self.interface.user_key is None:
+            raise ValueError('The session interface has no user_key, so '
+                             'sessions are not indexed by user.')
+        return self.interface.user_index_prefix + str(user_id)
+
+    def user_sessions(self, user_id):
+        """
+        Return the ids of a user's live sessions, pruning expired ones
+        from the user's index.
+        """
+        index = self._user_index(user_id)
+        sids = self._decode(self.redis.smembers(index))
+        live, stale = self._check_owner(user_id, sids)
+        if stale:
+            self.redis.srem(index, *stale)
+        return live
+
+    def revoke_user(self, user_id):
+        """
+        Delete every session of a user, e.g. to log them out everywhere.
+        Returns the number of sessions deleted.
+        """
+        index = self._user_index(user_id)
+        sids = self._decode(self.redis.smembers(index))
+        live, stale = self._check_owner(user_id, sids)
+        deleted = self.delete(live)
+        # Only the members read above are removed, so a session created
+        # meanwhile stays indexed.
+        if sids:
+            self.redis.srem(index, *sids)
+        return deleted
+
+    def _check_owner(self, user_id, sids):
+        # A session stays in the index after it expires or its user logs
+        # out, so each one is checked to still belong to the user.
+        live = []
+        stale = []
+        user_id = str(user_id)
+        for batch in self._batches(sids):
+            sessions = self.interface.read_sessions(batch, redis=self.redis)
+            for sid, data in zip(batch, sessions):
+                if (data is not None and
+                        str(data.get(self.interface.user_key)) == user_id):
+                    live.append(sid)
+                else:
+                    stale.append(sid)
+        return live, stale
+
+    def _batches(self, iterable):
+        batch = []
+        for item in iterable:
+            batch.append(item)
+            if len(batch) >= self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    @staticmethod
+    def _decode(values):
+        return [v.decode('utf-8') if isinstance(v, bytes) else v
+                for v in values]
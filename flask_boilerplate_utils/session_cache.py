@@ -0,0 +1,122 @@
+"""
+An in-process cache of decoded sessions, used by RedisSessionInterface
+to skip fetching and deserializing sessions which have not changed
+since this process last saw them.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class CacheEntry(object):
+    __slots__ = ('data', 'version', 'size', 'digest', 'expires_at',
+                 'redis_expires_at')
+
+    def __init__(self, data, version, size, digest, expires_at,
+                 redis_expires_at):
+        self.data = data
+        self.version = version
+        self.size = size
+        self.digest = digest
+        self.expires_at = expires_at
+        self.redis_expires_at = redis_expires_at
+
+    def remaining_ttl(self):
+        """
+        The remaining TTL of the session in Redis, as last known.
+        """
+        if self.redis_expires_at is None:
+            return -1
+        return max(int(self.redis_expires_at - time.monotonic()), 0)
+
+
+class LocalSessionCache(object):
+    """
+    A thread safe LRU cache of decoded sessions keyed by session id,
+    bounded by entry count, total payload size and entry age.
+
+    Entries are taken out of the cache while a request uses them and put
+    back when the session is saved, so a request which fails before
+    saving cannot leave a mutated session behind in the cache.
+
+    :param max_entries: The maximum number of cached sessions.
+    :param max_bytes: The maximum total size of the cached sessions'
+                      serialized payloads.
+    :param max_age: The maximum number of seconds a session is cached
+                    for without being saved.
+    """
+
+    def __init__(self, max_entries=1000, max_bytes=16 * 1024 * 1024,
+                 max_age=300):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.size = 0
+        # Maintained by the session interface, as only it knows whether
+        # an entry was still valid.
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def take(self, sid):
+        """
+        Remove and return the entry for a session id, or None if there is
+        no usable entry.
+        """
+        with self._lock:
+            entry = self._entries.pop(sid, None)
+            if entry is not None:
+                self.size -= entry.size
+                if entry.expires_at <= time.monotonic():
+                    entry = None
+            return entry
+
+    def put(self, sid, data, version, size, digest=None, ttl=None):
+        """
+        Cache a session's data.
+
+        :param version: The session's version when data was stored.
+        :param size: The size of the serialized data.
+        :param digest: The digest of the serialized data.
+        :param ttl: The session's remaining TTL in Redis. A negative or
+                    None value means the session does not expire.
+        """
+        if size > self.max_bytes:
+            return
+        now = time.monotonic()
+        expires_at = now + self.max_age
+        redis_expires_at = None
+        if ttl is not None and ttl >= 0:
+            redis_expires_at = now + ttl
+            expires_at = min(expires_at, redis_expires_at)
+        entry = CacheEntry(data, version, size, digest, expires_at,
+                           redis_expires_at)
+
+        with self._lock:
+            previous = self._entries.pop(sid, None)
+            if previous is not None:
+                self.size -= previous.size
+            self._entries[sid] = entry
+            self.size += size
+            while (len(self._entries) > self.max_entries or
+                    self.size > self.max_bytes):
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= evicted.size
+
+    def discard(self, sid):
+        """
+        Drop the entry for a session id, if there is one.
+        """
+        with self._lock:
+            entry = self._entries.pop(sid, None)
+            if entry is not None:
+                self.size -= entry.size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
@@ -0,0 +1,15 @@
+(function () {
+    var meta = document.querySelector('meta[name="csrf-token"]');
+    if (!meta) {
+        return;
+    }
+    var csrftoken = meta.getAttribute('content');
+
+    $.ajaxSetup({
+        beforeSend: function(xhr, settings) {
+            if (!/^(GET|HEAD|OPTIONS|TRACE)$/i.test(settings.type) && !this.crossDomain) {
+                xhr.setRequestHeader("X-CSRFToken", csrftoken)
+            }
+        }
+    });
+})();
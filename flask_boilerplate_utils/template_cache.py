@@ -0,0 +1,114 @@
+"""
+Compile Jinja templates ahead of time, so that the first requests after a
+deploy or worker restart don't pay for parsing and compiling them.
+
+With ``TEMPLATE_CACHE_DIR`` set, compiled templates are kept in a Jinja
+bytecode cache in that directory. The ``precompile`` command fills it
+for every template of the app and its blueprints, and workers load from
+it instead of compiling. Cached templates are checked against their
+source, so a stale cache is never used.
+
+``TEMPLATE_PRELOAD`` lists templates (or True for all of them) to load
+into memory before a worker accepts traffic. ``commands.Host`` does this
+itself; other servers should call :func:`preload_templates` once the app
+is fully set up.
+"""
+import os
+
+from jinja2 import FileSystemBytecodeCache, TemplateSyntaxError
+
+
+def init_template_cache(app):
+    """
+    Install the bytecode cache configured by TEMPLATE_CACHE_DIR.
+    """
+    directory = app.config.get('TEMPLATE_CACHE_DIR')
+    if not directory:
+        return None
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(directory)
+    return app.jinja_env.bytecode_cache
+
+
+def list_templates(app):
+    """
+    Return the names of all the app's and its blueprints' templates.
+    """
+    return sorted(set(app.jinja_env.list_templates()))
+
+
+def compile_templates(app, names=None):
+    """
+    Compile templates, storing them in the bytecode cache if there is
+    one. Returns a tuple of (compiled, errors) where errors is a list of
+    (name, exception) tuples for templates which failed to compile.
+
+    :param names: The templates to compile. Defaults to all of them.
+    """
+    env = app.jinja_env
+    compiled = 0
+    errors = []
+    for name in names or list_templates(app):
+        try:
+            # Loading stores the compiled template in the bytecode cache.
+            env.get_template(name)
+        except (TemplateSyntaxError, UnicodeDecodeError) as e:
+            errors.append((name, e))
+        else:
+            compiled += 1
+    return compiled, errors
+
+
+def compile_to_modules(app, target, names=None):
+    """
+    Compile templates into a directory of Python modules, loadable with
+    jinja2.ModuleLoader. Returns a tuple of (compiled, errors) like
+    :func:`compile_templates`.
+
+    :param target: The directory to write the modules to.
+    :param names: The templates to compile. Defaults to all of them.
+    """
+    from jinja2 import ModuleLoader
+
+    env = app.jinja_env
+    if not os.path.isdir(target):
+        os.makedirs(target)
+    compiled = 0
+    errors = []
+    for name in names or list_templates(app):
+        # The same steps as Environment.compile_templates, which only
+        # logs the templates it fails to compile.
+        try:
+            source, filename, _ = env.loader.get_source(env, name)
+            code = env.compile(source, name, filename, raw=True,
+                               defer_init=True)
+        except (TemplateSyntaxError, UnicodeDecodeError) as e:
+            errors.append((name, e))
+            continue
+        path = os.path.join(target, ModuleLoader.get_module_filename(name))
+        with open(path, 'wb') as fh:
+            fh.write(code.encode('utf8'))
+        compiled += 1
+    return compiled, errors
+
+
+def preload_templates(app, names=None):
+    """
+    Load templates into the Jinja environment's cache, e.g. before a
+    worker starts accepting requests.
+
+    :param names: The templates to load. Defaults to TEMPLATE_PRELOAD,
+                  where True means every template.
+    """
+    if names is None:
+        names = app.config.get('TEMPLATE_PRELOAD')
+    if not names:
+        return 0
+    if names is True:
+        names = list_templates(app)
+    capacity = getattr(app.jinja_env.cache, 'capacity', None)
+    if capacity is not None and len(names) > capacity:
+        # Preloaded templates would only be evicted again.
+        names = names[:capacity]
+    return compile_templates(app, names)[0]
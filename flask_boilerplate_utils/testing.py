@@ -0,0 +1,360 @@
+"""
+Run the app's unittest suite, optionally sharded across a pool of
+forked worker processes.
+
+Tests are sharded by TestCase class, so that setUpClass runs once per
+class. Shards are balanced by the durations of the previous run, when
+they are cached in a JSON file, by assigning the slowest classes first,
+each to the shard with the least work so far.
+
+Each worker sets the ``TEST_WORKER`` environment variable to its index,
+e.g. to use a database of its own, and with an app factory it creates
+its own app, with ``TEST_WORKER`` in its config, and runs its tests in
+that app's context.
+"""
+import json
+import os
+import sys
+from queue import Empty
+import time
+import traceback
+import unittest
+from collections import OrderedDict
+
+
+def load_tests(module=None, start_dirs=None, pattern='test*.py',
+               top_level_dir=None):
+    """
+    Load a test suite from a module, or by discovering test modules in
+    directories or packages.
+
+    :param module: A module, whose tests are loaded. A package's tests
+                   are discovered.
+    :param start_dirs: A list of directories or importable package names
+                       to discover tests in.
+    :param pattern: The filename pattern of test modules.
+    """
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite()
+    if module is not None:
+        if hasattr(module, '__path__'):
+            for path in module.__path__:
+                suite.addTests(loader.discover(path, pattern, top_level_dir
+                                               or _top_level(module, path)))
+        else:
+            suite.addTests(loader.loadTestsFromModule(module))
+    for start in start_dirs or ():
+        if not os.path.isdir(start):
+            # A package name.
+            package = __import__(start, fromlist=['__path__'])
+            suite.addTests(load_tests(package, pattern=pattern))
+            continue
+        suite.addTests(loader.discover(start, pattern, top_level_dir))
+    return suite
+
+
+def _top_level(package, path):
+    # The directory the package is imported from.
+    for _ in package.__name__.split('.'):
+        path = os.path.dirname(path)
+    return path
+
+
+def iter_tests(suite):
+    for test in suite:
+        if isinstance(test, unittest.TestSuite):
+            for child in iter_tests(test):
+                yield child
+        else:
+            yield test
+
+
+def group_tests(suite):
+    """
+    Return an OrderedDict of the suite's tests by their TestCase class.
+    """
+    groups = OrderedDict()
+    for test in iter_tests(suite):
+        key = '%s.%s' % (type(test).__module__, type(test).__name__)
+        groups.setdefault(key, []).append(test)
+    return groups
+
+
+def shard_groups(groups, count, timings=None):
+    """
+    Split groups of tests into count shards of about equal duration.
+
+    :param groups: An OrderedDict of lists of tests, from group_tests.
+    :param timings: A dict of test ids to their durations in seconds. The
+                    tests without one are assumed to take the mean time.
+    :return: A list of count lists of group keys.
+    """
+    timings = timings or {}
+    default = sum(timings.values()) / len(timings) if timings else 1.0
+    costs = dict((key, sum(timings.get(test.id(), default) for test in tests))
+                 for key, tests in groups.items())
+    shards = [[] for _ in range(count)]
+    loads = [0.0] * count
+    for key in sorted(groups, key=lambda key: -costs[key]):
+        index = loads.index(min(loads))
+        shards[index].append(key)
+        loads[index] += costs[key]
+    return shards
+
+
+def load_timings(path):
+    if not path or not os.path.exists(path):
+        return {}
+    try:
+        with open(path) as fh:
+            return json.load(fh)
+    except (IOError, ValueError):
+        return {}
+
+
+def save_timings(path, durations):
+    """
+    Merge test durations into the timings file, keeping the durations of
+    tests which were not run.
+    """
+    timings = load_timings(path)
+    timings.update(durations)
+    with open(path, 'w') as fh:
+        json.dump(timings, fh, indent=0, sort_keys=True)
+
+
+class TimedTestResult(unittest.TextTestResult):
+    """
+    A TextTestResult which records the duration of each test, and stops
+    when stop_event is set, e.g. by a failure in another worker.
+    """
+
+    stop_event = None
+
+    def __init__(self, *args, **kwargs):
+        self._should_stop = False
+        super(TimedTestResult, self).__init__(*args, **kwargs)
+        self.durations = {}
+        self._started = None
+
+    @property
+    def shouldStop(self):
+        # TestSuite checks this before running each test, so no test starts
+        # once another worker has failed.
+        return self._should_stop or (self.stop_event is not None and
+                                     self.stop_event.is_set())
+
+    @shouldStop.setter
+    def shouldStop(self, value):
+        self._should_stop = value
+
+    def startTest(self, test):
+        self._started = time.perf_counter()
+        super(TimedTestResult, self).startTest(test)
+
+    def stopTest(self, test):
+        super(TimedTestResult, self).stopTest(test)
+        self.durations[test.id()] = time.perf_counter() - self._started
+
+    def _failed(self):
+        if self.failfast and self.stop_event is not None:
+            self.stop_event.set()
+
+    def addError(self, test, err):
+        super(TimedTestResult, self).addError(test, err)
+        self._failed()
+
+    def addFailure(self, test, err):
+        super(TimedTestResult, self).addFailure(test, err)
+        self._failed()
+
+    def summary(self):
+        """
+        Return the result as a dict which can be sent between processes.
+        """
+        return {
+            'run': self.testsRun,
+            'failures': [(str(test), error) for test, error in self.failures],
+            'errors': [(str(test), error) for test, error in self.errors],
+            'skipped': len(self.skipped),
+            'expected_failures': len(self.expectedFailures),
+            'unexpected_successes': len(self.unexpectedSuccesses),
+            'durations': self.durations,
+        }
+
+
+class TestRun(object):
+    """
+    Runs a test suite in one process, or sharded across worker processes.
+
+    :param suite: The TestSuite to run.
+    :param workers: The number of worker processes, or 1 to run in this
+                    process.
+    :param failfast: Stop at the first failure or error.
+    :param timings_path: The file of cached test durations used to
+                         balance the shards, updated after the run.
+    :param app_factory: A function taking a dict of config overrides and
+                        returning a new app, called in each worker.
+    :param verbosity: The unittest verbosity.
+    """
+
+    def __init__(self, suite, workers=1, failfast=False, timings_path=None,
+                 app_factory=None, verbosity=2):
+        self.suite = suite
+        self.workers = workers
+        self.failfast = failfast
+        self.timings_path = timings_path
+        self.app_factory = app_factory
+        self.verbosity = verbosity
+
+    def run(self):
+        """
+        Run the tests, returning a list of the summary dict of each shard.
+        """
+        groups = group_tests(self.suite)
+        workers = max(1, min(self.workers, len(groups)))
+        started = time.time()
+        if workers == 1:
+            summaries = [self.run_shard(0, list(groups.values()),
+                                        self.verbosity)]
+        else:
+            summaries = self.run_parallel(groups, workers)
+        self.elapsed = time.time() - started
+
+        if self.timings_path:
+            durations = {}
+            for summary in summaries:
+                durations.update(summary['durations'])
+            save_timings(self.timings_path, durations)
+        return summaries
+
+    def run_parallel(self, groups, workers):
+        import multiprocessing
+        context = multiprocessing.get_context('fork')
+        shards = shard_groups(groups, workers,
+                              load_timings(self.timings_path))
+        queue = context.Queue()
+        stop_event = context.Event()
+        processes = []
+        for index, keys in enumerate(shards):
+            process = context.Process(target=self._worker, args=(
+                index, [groups[key] for key in keys], queue, stop_event))
+            process.start()
+            processes.append(process)
+
+        summaries = {}
+        died = set()
+
+        def receive(block):
+            index, summary = queue.get(timeout=1.0) if block \
+                else queue.get_nowait()
+            # A summary read late replaces the error recorded for it.
+            died.discard(index)
+            summaries[index] = summary
+            sys.stderr.write(' * Worker %d ran %d tests\n' % (
+                index, summary['run']))
+
+        while len(summaries) < len(processes):
+            try:
+                receive(True)
+                continue
+            except Empty:
+                pass
+            # A worker which dies, e.g. killed for using too much memory,
+            # never sends its summary. Workers send their summary before
+            # they exit, so one read now is from a worker which finished.
+            exited = [index for index, process in enumerate(processes)
+                      if index not in summaries and not process.is_alive()]
+            try:
+                while exited:
+                    receive(False)
+            except Empty:
+                pass
+            for index in exited:
+                if index in summaries:
+                    continue
+                died.add(index)
+                summaries[index] = _error_summary(
+                    index, 'Worker %d exited with code %s before '
+                    'reporting its results' % (
+                        index, processes[index].exitcode))
+                if self.failfast:
+                    stop_event.set()
+        for process in processes:
+            process.join()
+        try:
+            while died:
+                receive(False)
+        except Empty:
+            pass
+        for index in sorted(died):
+            sys.stderr.write(' ! Worker %d died\n' % index)
+        return [summaries[index] for index in sorted(summaries)]
+
+    def _worker(self, index, groups, queue, stop_event):
+        try:
+            with open(os.devnull, 'w') as stream:
+                # The parent reports the results of every worker.
+                summary = self.run_shard(index, groups, 0, stop_event,
+                                         stream)
+        except BaseException:
+            summary = _error_summary(index, traceback.format_exc())
+        queue.put((index, summary))
+
+    def run_shard(self, index, groups, verbosity, stop_event=None,
+                  stream=None):
+        os.environ['TEST_WORKER'] = str(index)
+        suite = unittest.TestSuite()
+        for tests in groups:
+            suite.addTests(tests)
+
+        result_class = type('TimedTestResult', (TimedTestResult,),
+                            {'stop_event': stop_event})
+        runner = unittest.TextTestRunner(
+            stream=stream or sys.stderr, verbosity=verbosity,
+            failfast=self.failfast, resultclass=result_class)
+        if self.app_factory is None:
+            return runner.run(suite).summary()
+        app = self.app_factory({'TESTING': True, 'TEST_WORKER': index})
+        with app.app_context():
+            return runner.run(suite).summary()
+
+
+def _error_summary(index, error):
+    return {'run': 0, 'failures': [],
+            'errors': [('worker %d' % index, error)],
+            'skipped': 0, 'expected_failures': 0,
+            'unexpected_successes': 0, 'durations': {}}
+
+
+def report(summaries, elapsed, slowest=0, stream=sys.stderr):
+    """
+    Write the failures of sharded runs, the slowest tests and a summary
+    line. Returns True if every test passed.
+    """
+    run = sum(summary['run'] for summary in summaries)
+    failures = [item for summary in summaries for item in summary['failures']]
+    errors = [item for summary in summaries for item in summary['errors']]
+
+    if len(summaries) > 1:
+        # A single shard's runner has already written its failures.
+        for kind, items in (('ERROR', errors), ('FAIL', failures)):
+            for test, error in items:
+                stream.write('=' * 70 + '\n%s: %s\n' % (kind, test) +
+                             '-' * 70 + '\n%s\n' % error)
+
+    if slowest:
+        durations = {}
+        for summary in summaries:
+            durations.update(summary['durations'])
+        stream.write('\nSlowest %d tests:\n' % slowest)
+        for test, seconds in sorted(durations.items(),
+                                    key=lambda item: -item[1])[:slowest]:
+            stream.write('%8.3fs %s\n' % (seconds, test))
+
+    if len(summaries) > 1:
+        stream.write('\nRan %d tests in %.3fs across %d workers\n' % (
+            run, elapsed, len(summaries)))
+        stream.write('FAILED (failures=%d, errors=%d)\n' % (
+            len(failures), len(errors)) if failures or errors else 'OK\n')
+    return not failures and not errors
@@ -0,0 +1,260 @@
+"""
+Validate file uploads while Werkzeug streams them from the request, so
+that oversized or mislabelled files are rejected before the rest of the
+body is read, rather than after they have been buffered.
+
+With ``UPLOAD_GUARD_ENABLED``, every uploaded file is checked against the
+``UPLOAD_MAX_FILE_SIZE``, ``UPLOAD_ALLOWED_TYPES`` and ``UPLOAD_HASH``
+config keys, which a view can override with :func:`upload_limits`::
+
+    @app.route('/avatar', methods=['POST'])
+    @upload_limits(max_size=2 * 1024 * 1024, types=['image/*'])
+    def avatar():
+        ...
+
+A file over the size limit is rejected with a 413, and a file whose
+content is not one of the allowed types with a 415. The size, sniffed
+type and digest of accepted files are kept on their stream, where the
+upload validators in :mod:`flask_boilerplate_utils.forms` read them
+instead of reading the file again.
+"""
+import hashlib
+from fnmatch import fnmatch
+
+from flask import Request, current_app
+from werkzeug.exceptions import RequestEntityTooLarge, UnsupportedMediaType
+
+# The number of bytes read from the start of a file to sniff its type.
+SNIFF_SIZE = 512
+
+# (offset, magic bytes, mimetype), checked in order.
+MAGIC_NUMBERS = (
+    (0, b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (0, b'\xff\xd8\xff', 'image/jpeg'),
+    (0, b'GIF87a', 'image/gif'),
+    (0, b'GIF89a', 'image/gif'),
+    (8, b'WEBP', 'image/webp'),
+    (0, b'BM', 'image/bmp'),
+    (0, b'II*\x00', 'image/tiff'),
+    (0, b'MM\x00*', 'image/tiff'),
+    (0, b'\x00\x00\x01\x00', 'image/x-icon'),
+    (0, b'%PDF-', 'application/pdf'),
+    (0, b'PK\x03\x04', 'application/zip'),
+    (0, b'PK\x05\x06', 'application/zip'),
+    (0, b'\x1f\x8b', 'application/gzip'),
+    (0, b'BZh', 'application/x-bzip2'),
+    (0, b'\xfd7zXZ\x00', 'application/x-xz'),
+    (0, b'7z\xbc\xaf\x27\x1c', 'application/x-7z-compressed'),
+    (0, b'Rar!\x1a\x07', 'application/vnd.rar'),
+    (0, b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1', 'application/x-ole-storage'),
+    (0, b'ID3', 'audio/mpeg'),
+    (0, b'OggS', 'audio/ogg'),
+    (0, b'fLaC', 'audio/flac'),
+    (8, b'WAVE', 'audio/wav'),
+    (4, b'ftyp', 'video/mp4'),
+    (0, b'\x1aE\xdf\xa3', 'video/webm'),
+)
+
+
+def sniff_mimetype(head):
+    """
+    Return the mimetype of a file from its first bytes, ie its magic
+    number, 'text/plain' for UTF-8 text, or 'application/octet-stream'.
+
+    :param head: At least the first SNIFF_SIZE bytes of the file, or the
+                 whole file if it is shorter.
+    """
+    for offset, magic, mimetype in MAGIC_NUMBERS:
+        if head.startswith(magic, offset):
+            return mimetype
+    if head and b'\x00' not in head:
+        try:
+            head.decode('utf-8')
+        except UnicodeDecodeError as e:
+            # The head may end part way through a character.
+            if e.start < len(head) - 3:
+                return 'application/octet-stream'
+        return 'text/plain'
+    return 'application/octet-stream'
+
+
+def mimetype_allowed(mimetype, types):
+    """
+    Whether a mimetype matches one of a list of types, which may use
+    wildcards, ie 'image/*'.
+    """
+    return any(fnmatch(mimetype, allowed) for allowed in types)
+
+
+class UploadLimits(object):
+    """
+    The checks made on uploaded files while they are streamed.
+
+    :param max_size: The largest file size allowed, in bytes.
+    :param types: A list of allowed mimetypes, which may use wildcards.
+    :param hash: The name of a hashlib algorithm to digest files with.
+    """
+
+    def __init__(self, max_size=None, types=None, hash=None):
+        self.max_size = max_size
+        self.types = types
+        self.hash = hash
+
+    def __bool__(self):
+        return bool(self.max_size or self.types or self.hash)
+    __nonzero__ = __bool__
+
+
+def upload_limits(max_size=None, types=None, hash=None):
+    """
+    A view decorator which sets the limits of the files uploaded to it,
+    in place of the UPLOAD_ config. Limits are looked up by endpoint when
+    the form is parsed, so they apply even if a before_request handler
+    reads the form before the view is called.
+
+    :param max_size: The largest file size allowed, in bytes.
+    :param types: A list of allowed mimetypes, which may use wildcards.
+    :param hash: The name of a hashlib algorithm to digest files with.
+    """
+    def decorator(view):
+        view.upload_limits = UploadLimits(max_size, types, hash)
+        return view
+    return decorator
+
+
+class GuardedStream(object):
+    """
+    Wraps the stream an uploaded file is written to, checking its size
+    and type and hashing it as it is written.
+
+    :attr size: The number of bytes written.
+    :attr mimetype: The sniffed mimetype, once the first SNIFF_SIZE bytes
+                    or the whole file have been written.
+    :attr digest: The hex digest of the file, if it was hashed.
+    """
+
+    def __init__(self, stream, limits, filename=None):
+        self.stream = stream
+        self.limits = limits
+        self.filename = filename
+        self.size = 0
+        self.mimetype = None
+        self.hash_name = limits.hash
+        self._hash = hashlib.new(limits.hash) if limits.hash else None
+        self._head = b''
+        self._complete = False
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+    def __iter__(self):
+        return iter(self.stream)
+
+    def write(self, data):
+        self.size += len(data)
+        if self.limits.max_size is not None and \
+                self.size > self.limits.max_size:
+            raise RequestEntityTooLarge()
+        if self.mimetype is None:
+            self._head += data[:SNIFF_SIZE - len(self._head)]
+            if len(self._head) >= SNIFF_SIZE:
+                self._sniff()
+        if self._hash is not None:
+            self._hash.update(data)
+        return self.stream.write(data)
+
+    def seek(self, *args):
+        # Werkzeug rewinds the stream once the whole file is written.
+        if not self._complete:
+            self._complete = True
+            if self.mimetype is None:
+                self._sniff()
+        return self.stream.seek(*args)
+
+    def _sniff(self):
+        self.mimetype = sniff_mimetype(self._head)
+        self._head = b''
+        if self.limits.types and \
+                not mimetype_allowed(self.mimetype, self.limits.types):
+            raise UnsupportedMediaType()
+
+    @property
+    def digest(self):
+        if self._hash is None:
+            return None
+        return self._hash.hexdigest()
+
+
+class GuardedRequest(Request):
+    """
+    A request class which checks uploaded files against the view's
+    upload_limits, or the UPLOAD_ config, while they are streamed.
+    """
+
+    def get_upload_limits(self):
+        view = current_app.view_functions.get(self.endpoint)
+        limits = getattr(view, 'upload_limits', None)
+        if limits is None:
+            config = current_app.config
+            limits = UploadLimits(config.get('UPLOAD_MAX_FILE_SIZE'),
+                                  config.get('UPLOAD_ALLOWED_TYPES'),
+                                  config.get('UPLOAD_HASH'))
+        return limits
+
+    def _get_file_stream(self, total_content_length, content_type,
+                         filename=None, content_length=None):
+        stream = super(GuardedRequest, self)._get_file_stream(
+            total_content_length, content_type, filename, content_length)
+        limits = self.get_upload_limits()
+        if not limits:
+            return stream
+        if limits.max_size is not None and content_length and \
+                content_length > limits.max_size:
+            raise RequestEntityTooLarge()
+        return GuardedStream(stream, limits, filename)
+
+
+def get_upload_info(storage, hash=None):
+    """
+    Return a tuple of (size, mimetype, digest) for an uploaded file. The
+    values recorded while it was streamed are used when there are any,
+    otherwise the file is read in chunks and rewound.
+
+    :param storage: A werkzeug FileStorage.
+    :param hash: The name of a hashlib algorithm to digest the file with,
+                 or None for no digest.
+    """
+    stream = storage.stream
+    if isinstance(stream, GuardedStream) and stream.mimetype is not None \
+            and (hash is None or hash == stream.hash_name):
+        return stream.size, stream.mimetype, \
+            stream.digest if hash else None
+
+    position = stream.tell()
+    stream.seek(0)
+    head = stream.read(SNIFF_SIZE)
+    size = len(head)
+    digest = None
+    if hash:
+        hasher = hashlib.new(hash)
+        hasher.update(head)
+        for chunk in iter(lambda: stream.read(64 * 1024), b''):
+            size += len(chunk)
+            hasher.update(chunk)
+        digest = hasher.hexdigest()
+    else:
+        stream.seek(0, 2)
+        size = stream.tell()
+    stream.seek(position)
+    return size, sniff_mimetype(head), digest
+
+
+def init_upload_guard(app):
+    """
+    Use GuardedRequest for the app's requests.
+    """
+    if not issubclass(app.request_class, GuardedRequest):
+        app.request_class = type('GuardedRequest',
+                                 (GuardedRequest, app.request_class), {})
+    return app.request_class
+
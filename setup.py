@@ -24,14 +24,15 @@ setup(
   url='https://github.com/nickw444/flask-boilerplate-utils',
   include_package_data=True,
   package_data={
-    'templates':['*']
+    'templates':['*'],
+    'static':['*']
   },
   zip_safe=False,
   install_requires=[
     "Flask",
     "raven",
     "flask-wtf",
-    "flask-babel",
+    "flask-babel>=0.12,<5",
     "flask-script",
     "meinheld",
     "flask-classy",
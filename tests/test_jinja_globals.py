@@ -0,0 +1,83 @@
+import unittest
+
+from flask import Flask
+from werkzeug.datastructures import MultiDict
+from wtforms import Form, BooleanField, DateField, HiddenField, \
+    IntegerField, PasswordField, SelectField, StringField, SubmitField, \
+    TextAreaField
+from wtforms.validators import DataRequired, Length, NumberRange, Optional
+from wtforms_webwidgets import FieldRenderer
+from wtforms_webwidgets.bootstrap import default_widgets
+
+from flask_boilerplate_utils.jinja_globals import CompiledFieldRenderer
+
+
+class ExampleForm(Form):
+    name = StringField('Name <b>', [DataRequired()], description='desc')
+    password = PasswordField('Password')
+    area = TextAreaField('Area')
+    hidden = HiddenField()
+    select = SelectField('Select', choices=[('a', 'A'), ('b', 'B')])
+    check = BooleanField('Check')
+    date = DateField('Date')
+    submit = SubmitField('Go')
+    placeholder = StringField('Placeholder', render_kw={'placeholder': 'x'})
+
+
+class LimitedForm(Form):
+    # The same names as ExampleForm, but with validators setting flags.
+    name = StringField('Name <b>', [DataRequired(), Length(max=10)],
+                       description='desc')
+    area = TextAreaField('Area', [Length(min=2, max=20)])
+    count = IntegerField('Count', [Optional(), NumberRange(min=1, max=5)])
+
+
+class CompiledFieldRendererTest(unittest.TestCase):
+
+    formdata = [
+        MultiDict(),
+        MultiDict({'name': 'a"<>&\'b', 'password': 's', 'area': 'l\n<x>"',
+                   'hidden': 'h"', 'select': 'b', 'check': 'y',
+                   'date': '2020-01-02', 'placeholder': 'q', 'count': '3'}),
+        MultiDict({'date': 'bad', 'count': 'bad'}),
+    ]
+
+    def setUp(self):
+        self.app = Flask('tests')
+        self.context = self.app.test_request_context()
+        self.context.push()
+        self.plain = FieldRenderer(default_widgets)
+        self.compiled = CompiledFieldRenderer(default_widgets)
+
+    def tearDown(self):
+        self.context.pop()
+
+    def assertSameMarkup(self, form_class):
+        for data in self.formdata:
+            for validate in (False, True):
+                expected_form = form_class(formdata=data)
+                compiled_form = form_class(formdata=data)
+                if validate:
+                    expected_form.validate()
+                    compiled_form.validate()
+                for name in expected_form._fields:
+                    for kwargs in ({}, {'class_': 'x'}, {'placeholder': 'p'}):
+                        self.assertEqual(
+                            str(self.compiled(compiled_form[name], **kwargs)),
+                            str(self.plain(expected_form[name], **kwargs)),
+                            '%s rendered with %r' % (name, kwargs))
+
+    def test_field_types(self):
+        # Render twice, so the second pass renders from the cache.
+        self.assertSameMarkup(ExampleForm)
+        self.assertSameMarkup(ExampleForm)
+
+    def test_flags(self):
+        # Fields which differ only in their flags don't share markup.
+        self.assertSameMarkup(ExampleForm)
+        self.assertSameMarkup(LimitedForm)
+        self.assertSameMarkup(ExampleForm)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,31 @@
+import datetime
+import unittest
+import uuid
+
+from flask_boilerplate_utils.serializers import JSONSerializer
+
+
+class JSONSerializerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.serializer = JSONSerializer()
+
+    def round_trip(self, data):
+        return self.serializer.loads(self.serializer.dumps(data))
+
+    def test_tagged_values(self):
+        data = {'bytes': b'\x00\xff', 'uuid': uuid.UUID(int=1),
+                'date': datetime.date(2020, 1, 2),
+                'datetime': datetime.datetime(2020, 1, 2, 3, 4, 5, 6),
+                'nested': [{'at': datetime.date(2020, 1, 2)}]}
+        self.assertEqual(self.round_trip(data), data)
+
+    def test_dicts_like_tags(self):
+        data = {'t': {' t': 1}, 'b': {' b': 'AA=='}, 'e': {' e': ['x', 1]},
+                'nested': [{' d': {' u': b'x'}}], 'many': {' b': 1, ' d': 2}}
+        self.assertEqual(self.round_trip(data), data)
+        self.assertEqual(self.round_trip({' b': 'AA=='}), {' b': 'AA=='})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import unittest
+
+from flask import Flask, session
+
+from flask_boilerplate_utils.RedisSessionInterface import \
+    LazyRedisSession, RedisSessionInterface
+
+
+class UnavailableRedis(object):
+    """
+    A Redis client which is down for reads, recording what is written.
+    """
+
+    def __init__(self):
+        self.deleted = []
+
+    def get(self, key):
+        raise ConnectionError('Redis is unavailable')
+
+    def delete(self, *keys):
+        self.deleted.extend(keys)
+
+
+class LazySessionTest(unittest.TestCase):
+
+    def test_failed_load_is_retried(self):
+        calls = []
+
+        def loader(session):
+            calls.append(session.sid)
+            if len(calls) == 1:
+                raise ConnectionError('Redis is unavailable')
+            dict.update(session, {'user': 1})
+
+        session = LazyRedisSession(sid='sid', loader=loader)
+        with self.assertRaises(ConnectionError):
+            session.get('user')
+        self.assertFalse(session.loaded)
+        self.assertEqual(session.get('user'), 1)
+        self.assertTrue(session.loaded)
+
+    def test_failed_load_keeps_stored_session(self):
+        app = Flask('tests')
+        redis = UnavailableRedis()
+        app.session_interface = RedisSessionInterface(redis=redis, lazy=True)
+
+        @app.route('/')
+        def index():
+            return str(session.get('user'))
+
+        @app.errorhandler(ConnectionError)
+        def unavailable(error):
+            return 'Unavailable', 503
+
+        client = app.test_client()
+        client.set_cookie('localhost', app.session_cookie_name, 'sid')
+        response = client.get('/')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(redis.deleted, [])
+
+
+if __name__ == '__main__':
+    unittest.main()